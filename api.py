@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from typing import List, Optional
@@ -14,6 +14,7 @@ from pathlib import Path
 # Add project root to path
 sys.path.append('.')
 
+from concern.track import trace, span
 from training.config import get_config
 from training.inference import Inference
 
@@ -26,6 +27,9 @@ app = FastAPI(
 # Global model instance
 model_instance = None
 
+# Folder for per-request Chrome trace JSON files (disabled when unset)
+TRACE_DIR = os.environ.get('TRACE_DIR')
+
 class MakeupRequest(BaseModel):
     source_images: List[str]  # Danh sách đường dẫn ảnh source
     reference_image: str  # Đường dẫn ảnh reference
@@ -103,6 +107,13 @@ def load_preset_config(preset_path):
     
     return reference_img, config
 
+def finish_trace(request_trace, response: Response, session_id: str):
+    """Attach the Server-Timing summary and export the Chrome trace if enabled"""
+    response.headers['Server-Timing'] = request_trace.server_timing()
+    if TRACE_DIR:
+        trace_name = f"{session_id}_{request_trace.name}_{int(time.time() * 1000)}.json"
+        request_trace.save(os.path.join(TRACE_DIR, trace_name))
+
 @app.on_event("startup")
 async def startup_event():
     """Load model when server starts"""
@@ -124,7 +135,7 @@ async def root():
     }
 
 @app.post("/transfer", response_model=MakeupResponse)
-async def transfer_makeup(request: MakeupRequest):
+async def transfer_makeup(request: MakeupRequest, response: Response):
     """
     Transfer makeup from reference image to source images
     
@@ -137,11 +148,19 @@ async def transfer_makeup(request: MakeupRequest):
     - skin_intensity: Skin makeup intensity (0.0 - 1.5, default: 1.0)
     - eye_intensity: Eye makeup intensity (0.0 - 1.5, default: 1.0)
     - save_face_only: If True, save only face region; if False, save full image (default: False)
+
+    The response carries a `Server-Timing` header with the time spent per pipeline stage.
     """
     
     if model_instance is None:
         raise HTTPException(status_code=500, detail="Model not loaded")
-    
+
+    with trace('transfer', session_id=request.session_id) as request_trace:
+        result = run_transfer(request)
+    finish_trace(request_trace, response, request.session_id)
+    return result
+
+def run_transfer(request: MakeupRequest):
     # Validate reference image
     if not os.path.exists(request.reference_image):
         raise HTTPException(status_code=404, detail=f"Reference image not found: {request.reference_image}")
@@ -182,12 +201,13 @@ async def transfer_makeup(request: MakeupRequest):
             
             # Process image
             img_start = time.time()
-            result_face, result_full = model_instance.transfer_all_faces(
-                source_img,
-                reference_img,
-                postprocess=True,
-                return_full_image=True
-            )
+            with span('image', index=idx, image_size=source_img.size):
+                result_face, result_full = model_instance.transfer_all_faces(
+                    source_img,
+                    reference_img,
+                    postprocess=True,
+                    return_full_image=True
+                )
             img_time = time.time() - img_start
             
             if result_face is None:
@@ -242,7 +262,7 @@ async def transfer_makeup(request: MakeupRequest):
     )
 
 @app.post("/transfer-preset", response_model=MakeupResponse)
-async def transfer_makeup_preset(request: PresetTransferRequest):
+async def transfer_makeup_preset(request: PresetTransferRequest, response: Response):
     """
     Transfer makeup using a preset configuration
     
@@ -260,7 +280,13 @@ async def transfer_makeup_preset(request: PresetTransferRequest):
     
     if model_instance is None:
         raise HTTPException(status_code=500, detail="Model not loaded")
-    
+
+    with trace('transfer_preset', session_id=request.session_id) as request_trace:
+        result = run_transfer_preset(request)
+    finish_trace(request_trace, response, request.session_id)
+    return result
+
+def run_transfer_preset(request: PresetTransferRequest):
     # Load preset configuration and reference image
     try:
         reference_img, config = load_preset_config(request.preset_path)
@@ -304,12 +330,13 @@ async def transfer_makeup_preset(request: PresetTransferRequest):
             
             # Process image
             img_start = time.time()
-            result_face, result_full = model_instance.transfer_all_faces(
-                source_img,
-                reference_img,
-                postprocess=True,
-                return_full_image=True
-            )
+            with span('image', index=idx, image_size=source_img.size):
+                result_face, result_full = model_instance.transfer_all_faces(
+                    source_img,
+                    reference_img,
+                    postprocess=True,
+                    return_full_image=True
+                )
             img_time = time.time() - img_start
             
             if result_face is None:
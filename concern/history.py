@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import time
+
+import torch
+
+DEFAULT_HISTORY = 'results/benchmark_history.jsonl'
+
+
+def git_info(cwd='.'):
+    """Revision, branch and dirty flag of the working tree; empty values outside git"""
+    def run(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=cwd, capture_output=True, text=True,
+                                  timeout=10).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ''
+    return {
+        'revision': run('rev-parse', 'HEAD'),
+        'branch': run('rev-parse', '--abbrev-ref', 'HEAD'),
+        'subject': run('log', '-1', '--format=%s'),
+        'dirty': bool(run('status', '--porcelain', '--untracked-files=no'))
+    }
+
+
+def _cpu_model():
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def _total_memory_gb():
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return round(int(line.split()[1]) / 1024 / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def host_info():
+    """
+    Description of the machine; `fingerprint` hashes the fields that affect timings
+    so runs are only compared against runs from equivalent hardware.
+    """
+    info = {
+        'hostname': socket.gethostname(),
+        'cpu': _cpu_model(),
+        'cpu_count': os.cpu_count(),
+        'memory_gb': _total_memory_gb(),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None
+    }
+    key = json.dumps([info[k] for k in ('cpu', 'cpu_count', 'memory_gb', 'machine', 'torch', 'cuda')])
+    info['fingerprint'] = hashlib.sha1(key.encode()).hexdigest()[:12]
+    return info
+
+
+def thread_settings():
+    return {
+        'torch_threads': torch.get_num_threads(),
+        'interop_threads': torch.get_num_interop_threads(),
+        'OMP_NUM_THREADS': os.environ.get('OMP_NUM_THREADS'),
+        'MKL_NUM_THREADS': os.environ.get('MKL_NUM_THREADS')
+    }
+
+
+def record_run(kind, options, metrics, samples, path=DEFAULT_HISTORY):
+    """
+    Append one run to the JSONL history store.
+    kind: e.g. 'benchmark'
+    options: the settings the run depends on (device, use_cache, optimize, ...)
+    metrics: summary numbers of the run
+    samples: dict, sample name -> list of raw measurements (kept for significance tests)
+    return: the stored record
+    """
+    git = git_info()
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    record = {
+        'id': '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), git['revision'][:7] or 'nogit'),
+        'timestamp': timestamp,
+        'kind': kind,
+        'git': git,
+        'host': host_info(),
+        'threads': thread_settings(),
+        'options': options,
+        'metrics': metrics,
+        'samples': samples
+    }
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+
+def load_runs(path=DEFAULT_HISTORY, kind=None, host=None, options=None):
+    """
+    Read runs in the order they were recorded.
+    host: fingerprint (or prefix) to keep
+    options: dict of option values that must match
+    """
+    if not os.path.exists(path):
+        return []
+    runs = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            run = json.loads(line)
+            if kind is not None and run['kind'] != kind:
+                continue
+            if host is not None and not run['host']['fingerprint'].startswith(host):
+                continue
+            if options and any(run['options'].get(k) != v for k, v in options.items()):
+                continue
+            runs.append(run)
+    return runs
+
+
+def find_run(runs, key):
+    """
+    key: run id (or unique prefix), git revision prefix (latest run of it),
+         'latest' or a negative index such as '-2'
+    """
+    if key == 'latest':
+        key = '-1'
+    if key.lstrip('-').isdigit() and key.startswith('-'):
+        index = int(key)
+        if -index > len(runs):
+            raise KeyError(f'only {len(runs)} runs in history')
+        return runs[index]
+    matches = [run for run in runs if run['id'].startswith(key)]
+    if len(matches) == 1:
+        return matches[0]
+    if len(matches) > 1:
+        raise KeyError(f'run id prefix {key} is ambiguous')
+    matches = [run for run in runs if run['git']['revision'].startswith(key)]
+    if matches:
+        return matches[-1]
+    raise KeyError(f'no run matches {key}')
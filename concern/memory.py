@@ -0,0 +1,188 @@
+import ctypes
+import gc
+import os
+import threading
+import time
+
+import torch
+
+MB = 1024 * 1024
+
+
+def read_rss(pid=None):
+    """
+    Resident set size of a process (default: this one) in bytes, 0 if unavailable.
+    Unlike tracemalloc this includes torch tensors, OpenCV buffers and dlib memory.
+    """
+    return _read_status_field('VmRSS', pid)
+
+
+def read_peak_rss(pid=None):
+    """High-water mark of the resident set size in bytes (VmHWM), 0 if unavailable"""
+    return _read_status_field('VmHWM', pid)
+
+
+def _read_status_field(field, pid=None):
+    path = '/proc/{}/status'.format(pid or 'self')
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process(pid or os.getpid()).memory_info()
+        return info.rss if field == 'VmRSS' else getattr(info, 'peak_wset', info.rss)
+    except Exception:
+        return 0
+
+
+def release_memory():
+    """
+    Collect garbage and hand freed heap pages back to the OS (glibc only),
+    so the RSS growth of the next measured block does not depend on what ran before.
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class RSSSampler:
+    """
+    Sample the RSS of this process from a background thread.
+    Timestamps use `time.perf_counter_ns`, the same clock as `concern.track.span`,
+    so samples can be attributed to the spans of a trace with `stage_memory`.
+
+        with RSSSampler(interval=0.01) as sampler:
+            ...
+        sampler.peak()
+    """
+    def __init__(self, interval=0.01, pid=None):
+        self.interval = interval
+        self.pid = pid
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        rss = read_rss(self.pid)
+        self.samples.append((time.perf_counter_ns(), rss))
+        return rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+        return False
+
+    def peak(self, start=None, end=None):
+        """Peak RSS in bytes among the samples taken in [start, end] (perf_counter_ns)"""
+        values = [rss for t, rss in self.samples
+                  if (start is None or t >= start) and (end is None or t <= end)]
+        return max(values) if values else 0
+
+    def at(self, t):
+        """RSS of the last sample taken at or before `t`"""
+        value = self.samples[0][1] if self.samples else 0
+        for sample_t, rss in self.samples:
+            if sample_t > t:
+                break
+            value = rss
+        return value
+
+
+def stage_memory(trace, sampler):
+    """
+    Attribute sampled RSS to the spans of a trace.
+    return: dict, span name -> {'count', 'peak_rss_mb', 'growth_mb'}, where growth
+    is the largest rise of RSS above its value when a span of that name started.
+    """
+    stages = {}
+    for name, start, end, _, _ in trace.spans:
+        peak = max(sampler.peak(start, end), sampler.at(end))
+        growth = peak - sampler.at(start)
+        item = stages.setdefault(name, {'count': 0, 'peak_rss_mb': 0.0, 'growth_mb': 0.0})
+        item['count'] += 1
+        item['peak_rss_mb'] = max(item['peak_rss_mb'], peak / MB)
+        item['growth_mb'] = max(item['growth_mb'], growth / MB)
+    return stages
+
+
+class TorchMemoryStats:
+    """
+    Torch allocator statistics for the enclosed block.
+    On CUDA this reads the caching allocator counters; on CPU it records
+    allocator events with the autograd profiler (this adds overhead to timings).
+
+    return (after exit) via `.stats`: {'peak_mb', 'allocated_mb', 'allocations'}
+    """
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.stats = {}
+        self._profiler = None
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._start = torch.cuda.memory_stats(self.device)
+        else:
+            self._profiler = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True
+            )
+            self._profiler.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            end = torch.cuda.memory_stats(self.device)
+            self.stats = {
+                'peak_mb': end.get('allocated_bytes.all.peak', 0) / MB,
+                'allocated_mb': (end.get('allocated_bytes.all.allocated', 0) -
+                                 self._start.get('allocated_bytes.all.allocated', 0)) / MB,
+                'allocations': end.get('allocation.all.allocated', 0) -
+                               self._start.get('allocation.all.allocated', 0)
+            }
+        else:
+            self._profiler.__exit__(exc_type, exc_value, tb)
+            self.stats = _profiler_memory_stats(self._profiler.events())
+        return False
+
+
+def _profiler_memory_stats(events):
+    # Each event carries the net bytes it allocated itself (negative for frees);
+    # replaying them in start order gives the live tensor bytes over time.
+    live = peak = allocated = 0
+    allocations = 0
+    for event in sorted(events, key=lambda e: e.time_range.start):
+        usage = getattr(event, 'self_cpu_memory_usage', 0)
+        if usage == 0:
+            continue
+        live += usage
+        peak = max(peak, live)
+        if usage > 0:
+            allocated += usage
+            allocations += 1
+    return {'peak_mb': peak / MB, 'allocated_mb': allocated / MB, 'allocations': allocations}
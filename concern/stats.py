@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+
+try:
+    from scipy import stats as scipy_stats
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
+
+def summarize(samples, confidence=0.95):
+    """
+    samples: list of timings (any unit)
+    return: dict with mean, std, median, min and the confidence interval of the mean
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    n = len(samples)
+    mean = float(samples.mean())
+    std = float(samples.std(ddof=1)) if n > 1 else 0.0
+    half_width = _t_quantile(confidence, n - 1) * std / math.sqrt(n) if n > 1 else 0.0
+    return {
+        'n': n,
+        'mean': mean,
+        'std': std,
+        'median': float(np.median(samples)),
+        'min': float(samples.min()),
+        'ci_low': mean - half_width,
+        'ci_high': mean + half_width,
+        'confidence': confidence
+    }
+
+
+def welch_t_test(a, b):
+    """
+    Two-sided Welch's t-test for a difference in means of two samples
+    with possibly unequal variances.
+    return: (t statistic, p value); t > 0 means mean(b) > mean(a)
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    if len(a) < 2 or len(b) < 2:
+        return 0.0, 1.0
+    var_a = a.var(ddof=1) / len(a)
+    var_b = b.var(ddof=1) / len(b)
+    se = math.sqrt(var_a + var_b)
+    diff = float(b.mean() - a.mean())
+    if se == 0:
+        return (0.0, 1.0) if diff == 0 else (math.copysign(math.inf, diff), 0.0)
+    t = diff / se
+    dof = (var_a + var_b) ** 2 / (var_a ** 2 / (len(a) - 1) + var_b ** 2 / (len(b) - 1))
+    return t, 2 * _t_sf(abs(t), dof)
+
+
+def compare_samples(baseline, current, alpha=0.05, tolerance=0.05):
+    """
+    Decide whether `current` is a statistically significant change against `baseline`.
+    A regression must be significant at `alpha` AND slower by more than `tolerance` (relative).
+    """
+    t, p = welch_t_test(baseline, current)
+    base_mean = float(np.mean(baseline))
+    cur_mean = float(np.mean(current))
+    change = (cur_mean - base_mean) / base_mean if base_mean > 0 else 0.0
+    significant = p < alpha
+    if significant and change > tolerance:
+        verdict = 'regression'
+    elif significant and change < -tolerance:
+        verdict = 'improvement'
+    else:
+        verdict = 'unchanged'
+    return {
+        'baseline_mean': base_mean,
+        'current_mean': cur_mean,
+        'change': change,
+        't': t,
+        'p_value': p,
+        'verdict': verdict
+    }
+
+
+def _t_quantile(confidence, dof):
+    if HAS_SCIPY:
+        return float(scipy_stats.t.ppf(0.5 + confidence / 2, dof))
+    # normal approximation, slightly optimistic for small samples
+    return _normal_quantile(0.5 + confidence / 2)
+
+
+def _t_sf(t, dof):
+    if HAS_SCIPY:
+        return float(scipy_stats.t.sf(t, dof))
+    return 0.5 * math.erfc(t / math.sqrt(2))
+
+
+def _normal_quantile(q):
+    # bisection on the normal cdf, enough for confidence intervals
+    low, high = -10.0, 10.0
+    for _ in range(100):
+        mid = (low + high) / 2
+        if 0.5 * math.erfc(-mid / math.sqrt(2)) < q:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
@@ -1,4 +1,8 @@
+import json
+import os
+import threading
 import time
+from contextvars import ContextVar
 
 import torch
 
@@ -17,3 +21,175 @@ class Track:
             print("{} memory:".format(mark), torch.cuda.memory_allocated() / 1024 / 1024, "M")
         print("{} time cost:".format(mark), time.time() - self.log_point)
         self.log_point = time.time()
+
+
+############################## Span Tracing ##############################
+# A trace is opened around a unit of work (an API request, a benchmark image)
+# with `trace(...)`; code anywhere below it records timed regions with
+# `span(...)`. When no trace is active, `span` costs one context-variable lookup.
+
+_current_trace = ContextVar('elegant_trace', default=None)
+_current_tags = ContextVar('elegant_trace_tags', default={})
+
+if hasattr(torch, 'compiler') and hasattr(torch.compiler, 'is_compiling'):
+    _is_compiling = torch.compiler.is_compiling
+else:
+    def _is_compiling():
+        return False
+
+
+class Trace:
+    """
+    Collects the spans recorded while it is active.
+    Exported as Chrome trace JSON (chrome://tracing, Perfetto) or
+    summarized into a `Server-Timing` header.
+    """
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+        self.spans = []
+        self.origin = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, tags):
+        with self._lock:
+            self.spans.append((name, start, end, threading.get_ident(), tags))
+
+    def summary(self):
+        """
+        return: dict, span name -> {'count', 'total_ms'}, in order of first appearance
+        """
+        summary = {}
+        with self._lock:
+            spans = list(self.spans)
+        for name, start, end, _, _ in spans:
+            item = summary.setdefault(name, {'count': 0, 'total_ms': 0.0})
+            item['count'] += 1
+            item['total_ms'] += (end - start) / 1e6
+        return summary
+
+    def server_timing(self, names=None):
+        """
+        Aggregate span durations by name into a `Server-Timing` header value,
+        e.g. 'detect;dur=12.3;desc="x2", parse;dur=40.1'.
+        names: optional list restricting which spans are reported
+        """
+        metrics = []
+        for name, item in self.summary().items():
+            if names is not None and name not in names:
+                continue
+            metric = '{};dur={:.1f}'.format(name, item['total_ms'])
+            if item['count'] > 1:
+                metric += ';desc="x{:d}"'.format(item['count'])
+            metrics.append(metric)
+        return ', '.join(metrics)
+
+    def to_chrome_trace(self):
+        events = []
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        for name, start, end, tid, tags in spans:
+            events.append({
+                'name': name,
+                'cat': 'elegant',
+                'ph': 'X',
+                'ts': (start - self.origin) / 1e3, # microseconds
+                'dur': (end - start) / 1e3,
+                'pid': pid,
+                'tid': tid,
+                'args': {k: _jsonable(v) for k, v in tags.items()}
+            })
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {k: _jsonable(v) for k, v in self.tags.items()}
+        }
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+        return path
+
+
+class span:
+    """
+    Time the enclosed block as a span of the active trace.
+    Tags are inherited by nested spans, so a `face` tag set on the per-face
+    span also shows up on the detection/parsing spans below it.
+
+        with span('parse', size=image.size):
+            ...
+    """
+    __slots__ = ('name', 'tags', 'trace', 'start', 'token')
+
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+        # spans inside torch.compile'd code are not recorded, their timing would be meaningless
+        self.trace = None if _is_compiling() else _current_trace.get()
+
+    def tag(self, **tags):
+        """Attach tags discovered inside the span, e.g. the number of faces."""
+        self.tags.update(tags)
+        return self
+
+    def __enter__(self):
+        if self.trace is not None:
+            parent_tags = _current_tags.get()
+            if parent_tags:
+                self.tags = dict(parent_tags, **self.tags)
+            self.token = _current_tags.set(self.tags)
+            self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.trace is None:
+            return False
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        end = time.perf_counter_ns()
+        _current_tags.reset(self.token)
+        if exc_type is not None:
+            self.tags['error'] = exc_type.__name__
+        self.trace.add(self.name, self.start, end, dict(self.tags))
+        return False
+
+
+class trace:
+    """
+    Open a trace for the enclosed block; the block itself is recorded as the root span.
+
+        with trace('transfer', session=session_id) as t:
+            ...
+        t.save('traces/request.json')
+    """
+    def __init__(self, name, **tags):
+        self.trace = Trace(name, **tags)
+        self.root = None
+
+    def __enter__(self):
+        self.token = _current_trace.set(self.trace)
+        self.root = span(self.trace.name, **self.trace.tags)
+        self.root.__enter__()
+        return self.trace
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.root.__exit__(exc_type, exc_value, tb)
+        finally:
+            _current_trace.reset(self.token)
+        return False
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def _jsonable(value):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, (tuple, list)):
+        return [_jsonable(v) for v in value]
+    return str(value)
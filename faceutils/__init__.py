@@ -3,3 +3,4 @@
 #from . import faceplusplus as fpp
 from . import dlibutils as dlib
 from . import mask
+from . import detector
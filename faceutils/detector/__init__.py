@@ -0,0 +1,3 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+from .main import FaceDetector, DlibHOGDetector, OpenCVDNNDetector, CascadeDetector, DETECTORS, get_detector
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+import os
+import os.path as osp
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from PIL import Image
+import dlib
+import cv2
+
+from .. import dlibutils
+
+
+class FaceDetector:
+    """
+    Finds the faces of an image. Boxes are dlib rectangles in image coordinates, so they go
+    straight to dlibutils.crop and dlibutils.landmarks.
+    """
+    name = None
+
+    def detect(self, image: Image) -> 'faces':
+        raise NotImplementedError
+
+    def __call__(self, image: Image) -> 'faces':
+        return self.detect(image)
+
+
+class DlibHOGDetector(FaceDetector):
+    """dlib's HOG frontal face detector on the image downsized to max_side"""
+    name = 'dlib'
+
+    def __init__(self, max_side=361, upsample=1):
+        self.max_side = max_side
+        self.upsample = upsample
+
+    def detect(self, image: Image) -> 'faces':
+        return dlibutils.detect(image, self.max_side, self.upsample)
+
+
+class OpenCVDNNDetector(FaceDetector):
+    """
+    An SSD face detector on OpenCV's dnn module, e.g. res10_300x300_ssd_iter_140000.caffemodel
+    with its deploy.prototxt, or the same model as .onnx / .pb, loaded from local files.
+    """
+    name = 'opencv_dnn'
+
+    def __init__(self, model_path, config_path='', input_size=300, confidence=0.5,
+                 mean=(104.0, 177.0, 123.0)):
+        for path in (model_path, config_path):
+            if path and not osp.exists(path):
+                raise FileNotFoundError('OpenCV face detector file not found: {}'.format(path))
+        self.net = cv2.dnn.readNet(model_path, config_path)
+        self.input_size = input_size
+        self.confidence = confidence
+        self.mean = mean
+
+    def detect(self, image: Image) -> 'faces':
+        image = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR)
+        h, w = image.shape[:2]
+        blob = cv2.dnn.blobFromImage(image, 1.0, (self.input_size, self.input_size), self.mean)
+        self.net.setInput(blob)
+        detections = self.net.forward().reshape(-1, 7) # image id, label, confidence, x1, y1, x2, y2
+        detections = detections[detections[:, 2] >= self.confidence]
+        # most confident first, preprocess uses the first face
+        detections = detections[np.argsort(-detections[:, 2])]
+        faces = dlib.rectangles()
+        for _, _, _, x1, y1, x2, y2 in detections:
+            left, top = int(max(0., x1) * w + 0.5), int(max(0., y1) * h + 0.5)
+            right, bottom = int(min(1., x2) * w + 0.5), int(min(1., y2) * h + 0.5)
+            if right > left and bottom > top:
+                faces.append(dlib.rectangle(left, top, right, bottom))
+        return faces
+
+
+class CascadeDetector(FaceDetector):
+    """
+    A fast detector proposes faces on the whole image; the confirming detector then runs only
+    on a crop around each proposal. Confirmed faces keep the confirming detector's box, so with
+    dlib confirming, crop ratios and landmarks see the boxes they were tuned for.
+    """
+    name = 'cascade'
+
+    def __init__(self, propose: FaceDetector, confirm: FaceDetector, margin=0.5):
+        self.propose = propose
+        self.confirm = confirm
+        self.margin = margin
+
+    def detect(self, image: Image) -> 'faces':
+        width, height = image.size
+        confirmed = []
+        for proposal in self.propose.detect(image):
+            margin_w, margin_h = self.margin * proposal.width(), self.margin * proposal.height()
+            left = int(max(0, proposal.left() - margin_w))
+            top = int(max(0, proposal.top() - margin_h))
+            right = int(min(width, proposal.right() + margin_w))
+            bottom = int(min(height, proposal.bottom() + margin_h))
+            candidates = [dlib.rectangle(face.left() + left, face.top() + top, face.right() + left, face.bottom() + top)
+                          for face in self.confirm.detect(image.crop((left, top, right, bottom)))]
+            if not candidates:
+                continue
+            best = max(candidates, key=lambda face: face.intersect(proposal).area())
+            # overlapping proposals of one face are confirmed by the same box
+            if best.intersect(proposal).area() > 0 and best not in confirmed:
+                confirmed.append(best)
+        faces = dlib.rectangles()
+        for face in confirmed:
+            faces.append(face)
+        return faces
+
+
+# smallest face dlib's HOG detector finds without upsampling, in pixels
+HOG_MIN_FACE = 80
+
+
+# HOG detector of a tile worker process, set by init_tile_worker
+tile_detector = None
+
+
+def init_tile_worker():
+    global tile_detector
+    tile_detector = dlib.get_frontal_face_detector()
+
+
+def detect_tile(tile, upsample, deadline=None):
+    '''
+    HOG detection on one tile, in a worker process or inline.
+    deadline: time.time() after which the tile is skipped
+    return: list of (left, top, right, bottom, score) in tile coordinates, None if skipped
+    '''
+    if deadline is not None and time.time() >= deadline:
+        return None
+    faces, scores, _ = (tile_detector or dlibutils.detector).run(tile, upsample)
+    return [(face.left(), face.top(), face.right(), face.bottom(), score) for face, score in zip(faces, scores)]
+
+
+def nms(boxes, threshold):
+    '''
+    boxes: list of (left, top, right, bottom, score)
+    Overlap is the intersection over the smaller box, so a face cut by a tile border is
+    suppressed by the whole face found in the neighbouring tile or on a coarser level.
+    return: the kept boxes, highest score first
+    '''
+    kept = []
+    for box in sorted(boxes, key=lambda box: -box[4]):
+        left, top, right, bottom, _ = box
+        area = (right - left) * (bottom - top)
+        for k_left, k_top, k_right, k_bottom, _ in kept:
+            inter_w = min(right, k_right) - max(left, k_left)
+            inter_h = min(bottom, k_bottom) - max(top, k_top)
+            k_area = (k_right - k_left) * (k_bottom - k_top)
+            if inter_w > 0 and inter_h > 0 and inter_w * inter_h > threshold * min(area, k_area):
+                break
+        else:
+            kept.append(box)
+    return kept
+
+
+class TiledDetector(FaceDetector):
+    """
+    dlib's HOG detector over overlapping tiles of an image pyramid, for group photos where
+    downsizing the whole image loses the small faces. Every level finds faces from the smallest
+    HOG face up to the tile overlap (scaled back to the image); the next level is downsized so
+    it starts where the previous one ends, until max_face is covered. Tiles run in a pool of
+    worker processes, coarse levels first, and boxes are merged by non-maximum suppression.
+    With a time_budget, detect returns once it is spent with the tiles done so far; queued tiles
+    are cancelled or skipped by the workers, so only the tiles already running when the budget
+    ends (at most one per worker) finish in the background.
+    """
+    name = 'tiled'
+
+    def __init__(self, min_face=40, max_face=2000, tile_size=512, overlap=160, upsample=1,
+                 num_workers=0, time_budget=0., nms_threshold=0.5):
+        self.min_face = min_face
+        self.max_face = max_face
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.upsample = upsample
+        self.num_workers = num_workers or os.cpu_count()
+        self.time_budget = time_budget
+        self.nms_threshold = nms_threshold
+        self.pool = None
+        self.last_stats = {}
+
+    def get_pool(self):
+        # started on the first image with more than one tile and kept; spawn, so the workers
+        # never inherit the face parser or a CUDA context, and they load only the HOG detector
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=init_tile_worker)
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def levels(self, width, height):
+        '''
+        return: list of pyramid scales, coarsest first
+        '''
+        smallest = HOG_MIN_FACE / 2 ** self.upsample
+        scales = []
+        low = self.min_face
+        while True:
+            scale = smallest / low
+            scales.append(scale)
+            # a face up to the overlap is whole in some tile; a level in one tile sees every size
+            if low * self.overlap / smallest >= self.max_face or max(width, height) * scale <= self.tile_size:
+                break
+            low = low * self.overlap / smallest
+        return scales[::-1]
+
+    def tiles(self, width, height):
+        '''
+        return: list of (scale, left, top) of every tile, in level coordinates
+        '''
+        step = self.tile_size - self.overlap
+        tiles = []
+        for scale in self.levels(width, height):
+            level_w, level_h = int(width * scale + 0.5), int(height * scale + 0.5)
+            xs = list(range(0, max(level_w - self.tile_size, 0) + 1, step))
+            ys = list(range(0, max(level_h - self.tile_size, 0) + 1, step))
+            # the last row and column end at the image border
+            if xs[-1] + self.tile_size < level_w:
+                xs.append(level_w - self.tile_size)
+            if ys[-1] + self.tile_size < level_h:
+                ys.append(level_h - self.tile_size)
+            tiles += [(scale, x, y) for y in ys for x in xs]
+        return tiles
+
+    def detect(self, image: Image) -> 'faces':
+        start = time.perf_counter()
+        image = np.asarray(image)
+        height, width = image.shape[:2]
+        tiles = self.tiles(width, height)
+        levels = {}
+        jobs = []
+        for scale, x, y in tiles:
+            if scale not in levels:
+                size = (int(width * scale + 0.5), int(height * scale + 0.5))
+                levels[scale] = image if scale == 1 else cv2.resize(
+                    image, size, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+            tile = np.ascontiguousarray(levels[scale][y:y + self.tile_size, x:x + self.tile_size])
+            jobs.append(((scale, x, y), tile))
+
+        results = []
+        if len(jobs) == 1:
+            results.append((jobs[0][0], detect_tile(jobs[0][1], self.upsample)))
+        else:
+            pool = self.get_pool()
+            # wall clock, shared with the workers
+            deadline = time.time() + self.time_budget if self.time_budget else None
+            futures = {pool.submit(detect_tile, tile, self.upsample, deadline): key for key, tile in jobs}
+            pending = set(futures)
+            while pending:
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                results += [(futures[future], future.result()) for future in done]
+            # tiles already handed to a worker cannot be cancelled, they are skipped there
+            for future in pending:
+                future.cancel()
+        results = [(key, tile_boxes) for key, tile_boxes in results if tile_boxes is not None]
+
+        boxes = []
+        for (scale, x, y), tile_boxes in results:
+            for left, top, right, bottom, score in tile_boxes:
+                box = ((left + x) / scale, (top + y) / scale, (right + x) / scale, (bottom + y) / scale, score)
+                if self.min_face <= box[2] - box[0] <= self.max_face:
+                    boxes.append(box)
+        faces = dlib.rectangles()
+        for left, top, right, bottom, _ in nms(boxes, self.nms_threshold):
+            faces.append(dlib.rectangle(int(left + 0.5), int(top + 0.5), int(right + 0.5), int(bottom + 0.5)))
+        self.last_stats = {'levels': len(levels), 'tiles': len(jobs), 'tiles_done': len(results),
+                           'seconds': time.perf_counter() - start}
+        return faces
+
+
+DETECTORS = ('dlib', 'opencv_dnn', 'cascade', 'tiled')
+
+
+def get_detector(config, name=None) -> FaceDetector:
+    '''
+    The face detector `name`, config.PREPROCESS.DETECTOR if None
+    '''
+    cfg = config.PREPROCESS
+    name = name or cfg.DETECTOR
+    if name not in DETECTORS:
+        raise ValueError('Unknown face detector: {}, expected one of {}'.format(name, DETECTORS))
+    if name == 'dlib':
+        return DlibHOGDetector(cfg.DETECTOR_MAX_SIDE, cfg.DETECTOR_UPSAMPLE)
+    if name == 'tiled':
+        return TiledDetector(cfg.DETECTOR_MIN_FACE, cfg.DETECTOR_MAX_FACE, cfg.DETECTOR_TILE_SIZE,
+                             cfg.DETECTOR_TILE_OVERLAP, cfg.DETECTOR_UPSAMPLE, cfg.DETECTOR_WORKERS,
+                             cfg.DETECTOR_TIME_BUDGET, cfg.DETECTOR_NMS_THRESHOLD)
+    dnn = OpenCVDNNDetector(cfg.DNN_MODEL, cfg.DNN_CONFIG, cfg.DNN_INPUT_SIZE, cfg.DNN_CONFIDENCE)
+    if name == 'opencv_dnn':
+        return dnn
+    return CascadeDetector(dnn, DlibHOGDetector(cfg.DETECTOR_MAX_SIDE, cfg.DETECTOR_UPSAMPLE))
@@ -9,15 +9,23 @@ import cv2
 from concern.image import resize_by_max
 
 detector = dlib.get_frontal_face_detector()
-predictor = dlib.shape_predictor(osp.split(osp.realpath(__file__))[0] + '/shape_predictor_68_face_landmarks.dat')
+predictor = None
 
 
-def detect(image: Image) -> 'faces':
+def get_predictor():
+    # loaded on the first landmarks call, detection-only processes never need it
+    global predictor
+    if predictor is None:
+        predictor = dlib.shape_predictor(osp.split(osp.realpath(__file__))[0] + '/shape_predictor_68_face_landmarks.dat')
+    return predictor
+
+
+def detect(image: Image, max_side=361, upsample=1) -> 'faces':
     image = np.asarray(image)
     h, w = image.shape[:2]
-    image = resize_by_max(image, 361)
+    image = resize_by_max(image, max_side)
     actual_h, actual_w = image.shape[:2]
-    faces_on_small = detector(image, 1)
+    faces_on_small = detector(image, upsample)
     faces = dlib.rectangles()
     for face in faces_on_small:
         faces.append(
@@ -108,7 +116,7 @@ def crop_by_image_size(image: Image, face) -> (Image, 'face'):
 
 
 def landmarks(image: Image, face):
-    shape = predictor(np.asarray(image), face).parts()
+    shape = get_predictor()(np.asarray(image), face).parts()
     return np.array([[p.y, p.x] for p in shape])
 
 def crop_from_array(image: np.array, face) -> (np.array, 'face'):
@@ -8,19 +8,49 @@ from PIL import Image
 import torch
 import torchvision.transforms as transforms
 
-from .model import BiSeNet
+from models.quantization import is_quantized_checkpoint, load_quantized_model
+from .model import BiSeNet, fuse_conv_bn
+
+
+# BiSeNet runs at any multiple of 32; the bundled weights were trained at 512
+INPUT_SIZES = (512, 384, 256)
 
 
 class FaceParser:
-    def __init__(self, device="cpu"):
+    def __init__(self, device="cpu", channels_last=False, input_size=512, fuse_bn=False, weights=''):
+        '''
+        input_size: side of the square crops parse / parse_batch take, one of INPUT_SIZES
+        fuse_bn: fold the BatchNorm layers into the convolutions (inference only); close to, but
+            not bit-identical with the unfused parser, check with scripts/optimize_face_parser.py
+        weights: '' for the bundled resnet.pth, or a checkpoint written by
+            scripts/optimize_face_parser.py (INT8, CPU only)
+        '''
+        if input_size not in INPUT_SIZES:
+            raise ValueError('Face parser input size must be one of {}, got {}'.format(INPUT_SIZES, input_size))
         mapper = [0, 1, 2, 3, 4, 5, 0, 11, 12, 0, 6, 8, 7, 9, 13, 0, 0, 10, 0]
         self.device = device
+        self.input_size = input_size
         self.dic = torch.tensor(mapper, device=device).unsqueeze(1)
-        save_pth = osp.split(osp.realpath(__file__))[0] + '/resnet.pth'
-
         net = BiSeNet(n_classes=19)
-        net.load_state_dict(torch.load(save_pth, map_location=device))
+        if weights:
+            # an explicitly configured checkpoint; quantized ones hold packed params, not plain tensors
+            state = torch.load(weights, map_location='cpu', weights_only=False)
+        else:
+            state = torch.load(osp.split(osp.realpath(__file__))[0] + '/resnet.pth', map_location='cpu')
+        self.quantized = is_quantized_checkpoint(state)
+        if self.quantized:
+            if torch.device(device).type != 'cpu':
+                raise ValueError('Quantized face parsers run on the CPU, got device {}'.format(device))
+            # quantized from a parser with folded BatchNorm
+            net = load_quantized_model(fuse_conv_bn(net), state)
+        else:
+            net.load_state_dict(state)
+            if fuse_bn:
+                fuse_conv_bn(net)
         self.net = net.to(device).eval()
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        if channels_last:
+            self.net.to(memory_format=torch.channels_last)
         self.to_tensor = transforms.Compose([
             transforms.ToTensor(),
             transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
@@ -28,12 +58,28 @@ class FaceParser:
 
 
     def parse(self, image: Image):
-        assert image.shape[:2] == (512, 512)
+        size = self.input_size
+        assert image.shape[:2] == (size, size)
         with torch.no_grad():
             image = self.to_tensor(image).to(self.device)
-            image = torch.unsqueeze(image, 0)
+            image = torch.unsqueeze(image, 0).contiguous(memory_format=self.memory_format)
             out = self.net(image)[0]
             parsing = out.squeeze(0).argmax(0)
         parsing = torch.nn.functional.embedding(parsing, self.dic)
         return parsing.float().squeeze(2)
 
+
+    def parse_batch(self, images):
+        '''
+        images: list of (input_size, input_size, 3) RGB arrays, parsed in one forward pass
+        return: (N, input_size, input_size), the same labels as parse on each image
+        '''
+        size = self.input_size
+        assert all(image.shape[:2] == (size, size) for image in images)
+        with torch.no_grad():
+            batch = torch.stack([self.to_tensor(image) for image in images]).to(self.device)
+            batch = batch.contiguous(memory_format=self.memory_format)
+            out = self.net(batch)[0]
+            parsing = out.argmax(1)
+        parsing = torch.nn.functional.embedding(parsing, self.dic)
+        return parsing.float().squeeze(3)
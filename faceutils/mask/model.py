@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from .resnet import Resnet18
 
@@ -269,6 +270,27 @@ class BiSeNet(nn.Module):
         return wd_params, nowd_params, lr_mul_wd_params, lr_mul_nowd_params
 
 
+def fuse_conv_bn(net):
+    '''
+    Fold every BatchNorm2d into the convolution it follows, in place, for inference.
+    BiSeNet and Resnet18 register each BatchNorm2d right after the Conv2d feeding it, so
+    those pairs are found among consecutive children; the BatchNorm2d becomes an Identity
+    and the forward passes are unchanged.
+    '''
+    net.eval()
+    pairs = []
+    for module in net.modules():
+        names = [name for name, _ in module.named_children()]
+        for conv_name, bn_name in zip(names, names[1:]):
+            if isinstance(getattr(module, conv_name), nn.Conv2d) and \
+                    isinstance(getattr(module, bn_name), nn.BatchNorm2d):
+                pairs.append((module, conv_name, bn_name))
+    for module, conv_name, bn_name in pairs:
+        setattr(module, conv_name, fuse_conv_bn_eval(getattr(module, conv_name), getattr(module, bn_name)))
+        setattr(module, bn_name, nn.Identity())
+    return net
+
+
 if __name__ == "__main__":
     net = BiSeNet(19)
     net.cuda()
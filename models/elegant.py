@@ -1,19 +1,39 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from .modules.module_base import ResidualBlock_IN, Downsample, Upsample, PositionalEmbedding, MergeBlock
 from .modules.module_attn import Attention_apply, FeedForwardLayer, MultiheadAttention 
 from .modules.sow_attention import SowAttention
-from .modules.tps_transform import tps_spatial_transform
+from .modules.tps_transform import bulid_delta_inverse, build_target_coordinate_matrix, tps_grid, grid_sample
+from concern.track import span
+
+
+def swap_transfer_input(transfer_input):
+    '''
+    Swap the two halves of a batch of encodings, e.g. (A, B) -> (B, A).
+    '''
+    return [[torch.cat(x.chunk(2, dim=0)[::-1], dim=0) for x in tensors] for tensors in transfer_input]
 
 
 class Generator(nn.ModuleDict):
     """Generator. Encoder-Decoder Architecture."""
     def __init__(self, conv_dim=64, image_size=256, num_layer_e=2, num_layer_d=1, window_size=16, use_ff=False,
-                 merge_mode='conv', num_head=1, double_encoder=False, **unused):
+                 merge_mode='conv', num_head=1, double_encoder=False, checkpoint_segments=(), precision='fp32',
+                 channels_last=False, **unused):
         super(Generator, self).__init__()
 
+        if precision not in ('fp32', 'bf16'):
+            raise ValueError('Unknown precision: {}'.format(precision))
+        self.precision = precision
+
+        # activation checkpointing, only while training with gradients
+        unknown = set(checkpoint_segments) - {'encoder', 'attention', 'decoder'}
+        if unknown:
+            raise ValueError('Unknown checkpoint segments: {}'.format(sorted(unknown)))
+        self.checkpoint_segments = set(checkpoint_segments)
+
         # -------------------------- Encoder --------------------------
 
         layers = nn.Conv2d(3, conv_dim, kernel_size=7, stride=1, padding=3, bias=False)
@@ -100,9 +120,29 @@ class Generator(nn.ModuleDict):
         )
         self.add_module('out_conv', layers)
 
+        # NHWC weights and activations end to end, inputs are converted on entry
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+
+    def run_segment(self, segment, module, *inputs):
+        if segment in self.checkpoint_segments and self.training and torch.is_grad_enabled():
+            return checkpoint(module, *inputs, use_reentrant=False)
+        return module(*inputs)
+
+    def autocast(self):
+        device_type = next(self.parameters()).device.type
+        return torch.autocast(device_type, dtype=torch.bfloat16, enabled=self.precision == 'bf16')
 
     def get_transfer_input(self, image, mask, diff, lms, is_reference=False):
+        with span('encode', reference=is_reference), self.autocast():
+            return self._get_transfer_input(image, mask, diff, lms, is_reference)
+
+    def _get_transfer_input(self, image, mask, diff, lms, is_reference=False):
         feature_size = image.shape[2]; scale_factor = 1.0
+        # no-ops unless the model is channels_last; the diff embeddings inherit diff's layout
+        image = image.contiguous(memory_format=self.memory_format)
+        diff = diff.contiguous(memory_format=self.memory_format)
         fea_list, mask_list, diff_list, lms_list = [], [], [], []
 
         # input conv
@@ -115,10 +155,10 @@ class Generator(nn.ModuleDict):
         for i in range(2):
             if self.double_encoder and is_reference:
                 fea = self['down_{:d}_s'.format(i+1)](fea)
-                fea_ = self['e_bottleneck_{:d}_s'.format(i+1)](fea)
+                fea_ = self.run_segment('encoder', self['e_bottleneck_{:d}_s'.format(i+1)], fea)
             else:
                 fea = self['down_{:d}'.format(i+1)](fea)
-                fea_ = self['e_bottleneck_{:d}'.format(i+1)](fea)
+                fea_ = self.run_segment('encoder', self['e_bottleneck_{:d}'.format(i+1)], fea)
             fea_list.append(fea_)
             
             feature_size = feature_size // 2; scale_factor = scale_factor * 0.5
@@ -136,15 +176,22 @@ class Generator(nn.ModuleDict):
 
     def get_transfer_output(self, fea_c_list, mask_c_list, diff_c_list, lms_c_list,
                             fea_s_list, mask_s_list, diff_s_list, lms_s_list):
+        with self.autocast():
+            return self._get_transfer_output(fea_c_list, mask_c_list, diff_c_list, lms_c_list,
+                                             fea_s_list, mask_s_list, diff_s_list, lms_s_list)
+
+    def _get_transfer_output(self, fea_c_list, mask_c_list, diff_c_list, lms_c_list,
+                             fea_s_list, mask_s_list, diff_s_list, lms_s_list):
         attn_out_list = []
         for i in range(2):
             feature_size = fea_c_list[i].shape[2]
 
             # align
             if i == 0:
-                fea_s_ = self.tps_align(feature_size, lms_s_list[i], lms_c_list[i], fea_s_list[i])
-                mask_s_ = self.tps_align(feature_size, lms_s_list[i], lms_c_list[i], mask_s_list[i], 'nearest')
-                diff_s_ = self.tps_align(feature_size, lms_s_list[i], lms_c_list[i], diff_s_list[i], 'nearest')
+                with span('tps_align', feature_size=feature_size):
+                    fea_s_, mask_s_, diff_s_ = self.tps_align(
+                        feature_size, lms_s_list[i], lms_c_list[i],
+                        (fea_s_list[i], mask_s_list[i], diff_s_list[i]), ('bilinear', 'nearest', 'nearest'))
             else:
                 fea_s_ = fea_s_list[i]
                 mask_s_ = mask_s_list[i]
@@ -153,7 +200,9 @@ class Generator(nn.ModuleDict):
             # transfer
             input_q = torch.cat((fea_c_list[i], diff_c_list[i]), dim=1)
             input_k = torch.cat((fea_s_, diff_s_), dim=1)
-            attn_out = self['attention_extract_{:d}'.format(i+1)](input_q, input_k, fea_s_, mask_c_list[i], mask_s_)
+            with span('attention', level=i+1, feature_size=feature_size):
+                attn_out = self.run_segment('attention', self['attention_extract_{:d}'.format(i+1)],
+                                            input_q, input_k, fea_s_, mask_c_list[i], mask_s_)
             if self.use_ff:
                 attn_out = self['feedforward_{:d}'.format(i+1)](attn_out)
             attn_out_list.append(attn_out)
@@ -162,10 +211,16 @@ class Generator(nn.ModuleDict):
 
     
     def decode(self, fea_c_list, attn_out_list):
+        with span('decode'), self.autocast():
+            return self._decode(fea_c_list, attn_out_list).float()
+
+    def _decode(self, fea_c_list, attn_out_list):
+        # the encoding may be shared by several transfers, do not modify it
+        fea_c_list = list(fea_c_list)
         # apply
         for i in range(2): 
             fea_c_ = self['attention_apply_{:d}'.format(i+1)](fea_c_list[i], attn_out_list[i])
-            fea_c_ = self['d_bottleneck_{:d}'.format(2-i)](fea_c_)
+            fea_c_ = self.run_segment('decoder', self['d_bottleneck_{:d}'.format(2-i)], fea_c_)
             fea_c_list[i] = fea_c_
 
         # up-sampling & merge
@@ -189,20 +244,35 @@ class Generator(nn.ModuleDict):
         """
         transfer_input_c = self.get_transfer_input(c, mask_c, diff_c, lms_c)
         transfer_input_s = self.get_transfer_input(s, mask_s, diff_s, lms_s, True)
+        return self.transfer(transfer_input_c, transfer_input_s)
+
+    def transfer(self, transfer_input_c, transfer_input_s):
+        '''
+        Transfer between inputs already encoded by `get_transfer_input`,
+        so one encoding can serve several passes (as content and as style).
+        '''
         attn_out_list = self.get_transfer_output(*transfer_input_c, *transfer_input_s)
-        fea_c = self.decode(transfer_input_c[0], attn_out_list)
-        return fea_c
+        return self.decode(transfer_input_c[0], attn_out_list)
 
 
-    def tps_align(self, feature_size, lms_s, lms_c, fea_s, sample_mode='bilinear'):
+    def tps_align(self, feature_size, lms_s, lms_c, maps, sample_modes):
         '''
-        fea: (B, C, H, W), lms: (B, K, 2)
+        maps: tuple of (B, C, H, W), lms: (B, K, 2), sample_modes: one per map
+        The maps share one TPS grid per sample, solved and sampled in fp32;
+        each output keeps its map's dtype and memory format.
         '''
-        fea_out = []
-        for l_s, l_c, f_s in zip(lms_s, lms_c, fea_s):
-            l_c = torch.flip(l_c, dims=[1]) / (feature_size - 1)
-            l_s = (torch.flip(l_s, dims=[1]) / (feature_size - 1)).unsqueeze(0)
-            f_s = f_s.unsqueeze(0) # (1, C, H, W)
-            fea_trans, _ = tps_spatial_transform(feature_size, feature_size, l_c, f_s, l_s, sample_mode)
-            fea_out.append(fea_trans)
-        return torch.cat(fea_out, dim=0)
+        with torch.autocast(lms_s.device.type, enabled=False):
+            # (y, x) -> (x, y); indexing rather than flip, which also exports to ONNX
+            lms_c = lms_c.float()[..., [1, 0]] / (feature_size - 1)
+            lms_s = lms_s.float()[..., [1, 0]] / (feature_size - 1)
+            inverse_kernel = bulid_delta_inverse(lms_c)
+            target_coordinate_repr = build_target_coordinate_matrix(feature_size, feature_size, lms_c)
+            grid, _ = tps_grid(feature_size, feature_size, inverse_kernel, target_coordinate_repr, lms_s)
+            outputs = []
+            for fea, sample_mode in zip(maps, sample_modes):
+                out = grid_sample(fea.float(), grid, mode=sample_mode)
+                if fea.is_contiguous(memory_format=torch.channels_last):
+                    # grid_sample writes NCHW; one explicit copy back, not one per consumer
+                    out = out.contiguous(memory_format=torch.channels_last)
+                outputs.append(out.to(fea.dtype))
+        return outputs
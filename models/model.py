@@ -28,7 +28,10 @@ def get_generator(config):
         'num_layer_e':config.MODEL.NUM_LAYER_E,
         'num_layer_d':config.MODEL.NUM_LAYER_D,
         'window_size':config.MODEL.WINDOW_SIZE,
-        'merge_mode':config.MODEL.MERGE_MODE
+        'merge_mode':config.MODEL.MERGE_MODE,
+        'checkpoint_segments':config.TRAINING.CHECKPOINT_SEGMENTS,
+        'precision':config.MODEL.PRECISION,
+        'channels_last':config.MODEL.CHANNELS_LAST
     }
     G = Generator(**kwargs)
     return G
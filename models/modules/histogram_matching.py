@@ -1,41 +1,69 @@
-import copy
 import torch
 
-def cal_hist(image):
+
+def cal_hist(values, weights):
     """
-        cal cumulative hist for channel list
+        cal cumulative hist for a batch of channels
+        values: (N, P), pixel values in [0, 255]
+        weights: (N, P), 1 for the pixels that count, 0 otherwise
+        return: (N, 256), float32 cumulative distributions, bit-identical to the former
+                per-channel loop (float32 histc, then a running float32 sum over the bins)
     """
-    hists = []
-    for i in range(0, 3):
-        channel = image[i]
-        # channel = image[i, :, :]
-        channel = torch.from_numpy(channel)
-        # hist, _ = np.histogram(channel, bins=256, range=(0,255))
-        hist = torch.histc(channel, bins=256, min=0, max=256)
-        hist = hist.numpy()
-        # refHist=hist.view(256,1)
-        sum = hist.sum()
-        pdf = [v / (sum + 1e-10) for v in hist]
-        for i in range(1, 256):
-            pdf[i] = pdf[i - 1] + pdf[i]
-        hists.append(pdf)
-    return hists
+    # same bins as torch.histc(channel, bins=256, min=0, max=256): [k, k+1)
+    bins = values.long().clamp_(0, 255)
+    hist = torch.zeros(values.shape[0], 256, dtype=torch.float32, device=values.device)
+    hist.scatter_add_(1, bins, weights.to(torch.float32))
+    pdf = hist / (hist.sum(dim=1, keepdim=True) + 1e-10)
+    # not cumsum: it may accumulate in double or in a different order, and a last-bit difference
+    # moves searchsorted in cal_trans where the CDFs tie
+    for k in range(1, 256):
+        pdf[:, k] += pdf[:, k - 1]
+    return pdf
 
 
 def cal_trans(ref, adj):
     """
         calculate transfer function
         algorithm refering to wiki item: Histogram matching
+        ref, adj: (N, 256) cumulative distributions
+        return: (N, 256) long, table[i] is the first j in [1, 255] with adj[j-1] <= ref[i] <= adj[j],
+                i itself if there is none; table[0] = 0 and table[255] = 255
     """
-    table = list(range(0, 256))
-    for i in list(range(1, 256)):
-        for j in list(range(1, 256)):
-            if ref[i] >= adj[j - 1] and ref[i] <= adj[j]:
-                table[i] = j
-                break
-    table[255] = 255
+    ref = ref.contiguous()
+    adj = adj.contiguous()
+    # adj is non-decreasing, so adj[j] >= ref[i] <=> j >= first (left insertion point)
+    # and adj[j-1] <= ref[i] <=> j <= last (right insertion point)
+    first = torch.searchsorted(adj, ref, right=False).clamp_(min=1)
+    last = torch.searchsorted(adj, ref, right=True)
+    identity = torch.arange(256, device=ref.device).expand_as(first)
+    table = torch.where((first <= last) & (first <= 255), first, identity)
+    table[:, 0] = 0
+    table[:, 255] = 255
     return table
 
+
+def masked_histogram_matching(dstImg, refImg, mask_dst, mask_ref):
+    """
+        perform histogram matching for a batch, on the device of the inputs
+        dstImg, refImg: (B, C, H, W), values in [0, 255]
+        mask_dst, mask_ref: (B, 1, H, W), pixels to transform in dstImg / to compute histogram in refImg
+        return: (B, C, H, W), dstImg * mask_dst with the masked pixels remapped
+    """
+    B, C, H, W = dstImg.shape
+    dst = (dstImg.detach().float() * mask_dst).reshape(B * C, H * W)
+    ref = (refImg.detach().float() * mask_ref).reshape(B * C, -1)
+    select_dst = (mask_dst != 0).expand(B, C, H, W).reshape(B * C, H * W)
+    select_ref = (mask_ref != 0).expand_as(refImg).reshape(B * C, -1)
+
+    hist_dst = cal_hist(dst, select_dst)
+    hist_ref = cal_hist(ref, select_ref)
+    tables = cal_trans(hist_dst, hist_ref)
+
+    matched = tables.gather(1, dst.long().clamp_(0, 255)).to(dst.dtype)
+    dst = torch.where(select_dst, matched, dst)
+    return dst.reshape(B, C, H, W)
+
+
 def histogram_matching(dstImg, refImg, index):
     """
         perform histogram matching
@@ -43,22 +71,8 @@ def histogram_matching(dstImg, refImg, index):
         index[0], index[1]: the index of pixels that need to be transformed in dstImg
         index[2], index[3]: the index of pixels that to compute histogram in refImg
     """
-    index = [x.cpu().numpy() for x in index]
-    dstImg = dstImg.detach().cpu().numpy()
-    refImg = refImg.detach().cpu().numpy()
-    dst_align = [dstImg[i, index[0], index[1]] for i in range(0, 3)]
-    ref_align = [refImg[i, index[2], index[3]] for i in range(0, 3)]
-    hist_ref = cal_hist(ref_align)
-    hist_dst = cal_hist(dst_align)
-    tables = [cal_trans(hist_dst[i], hist_ref[i]) for i in range(0, 3)]
-
-    mid = copy.deepcopy(dst_align)
-    for i in range(0, 3):
-        for k in range(0, len(index[0])):
-            dst_align[i][k] = tables[i][int(mid[i][k])]
-
-    for i in range(0, 3):
-        dstImg[i, index[0], index[1]] = dst_align[i]
-
-    dstImg = torch.FloatTensor(dstImg)
-    return dstImg
\ No newline at end of file
+    mask_dst = torch.zeros((1, 1) + dstImg.shape[1:], device=dstImg.device)
+    mask_dst[0, 0, index[0], index[1]] = 1
+    mask_ref = torch.zeros((1, 1) + refImg.shape[1:], device=refImg.device)
+    mask_ref[0, 0, index[2], index[3]] = 1
+    return masked_histogram_matching(dstImg.unsqueeze(0), refImg.unsqueeze(0), mask_dst, mask_ref).squeeze(0)
@@ -25,6 +25,7 @@ class MultiheadAttention_weight(nn.Module):
         '''
         bsz, dim, h, w = fea_c.shape; mask_channel = mask_c.shape[1]
 
+        # a view for both layouts; for channels_last it is already the contiguous (b, HW, d) Linear reads
         fea_c = fea_c.view(bsz, dim, h*w).transpose(1, 2) # (b, HW, d)
         fea_s = fea_s.view(bsz, dim, h*w).transpose(1, 2)
         with torch.no_grad():
@@ -47,7 +48,8 @@ class MultiheadAttention_weight(nn.Module):
         weights = torch.matmul(query, key.transpose(-1, -2)) # (b, h, HW, HW)
         weights = weights * self.scaling
         weights = weights + mask_attn.detach()
-        weights = self.dropout(F.softmax(weights, dim=-1))
+        # normalize in fp32, also under bf16 autocast
+        weights = self.dropout(F.softmax(weights, dim=-1, dtype=torch.float32))
         weights = weights * (1 - (mask_sum == 0).float().detach())
         return weights 
 
@@ -75,7 +77,7 @@ class MultiheadAttention_value(nn.Module):
 
         out = torch.matmul(weights, value)
         out = out.transpose(1, 2).contiguous().view(bsz, h*w, self.proj_dim) # (b, HW, D)
-        out = out.transpose(1, 2).view(bsz, self.proj_dim, h, w) #(b, d, H, W)
+        out = out.transpose(1, 2).view(bsz, self.proj_dim, h, w) #(b, d, H, W), channels_last strides
         return out
 
 
@@ -5,7 +5,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torchvision.transforms import functional
 
-from models.modules.tps_transform import tps_sampler, tps_spatial_transform
+from models.modules.tps_transform import tps_sampler, tps_spatial_transform, tps_grid, grid_sample, \
+    bulid_delta_inverse, build_target_coordinate_matrix
 
 
 def expand_area(mask:torch.Tensor, margin:int):
@@ -86,59 +87,59 @@ def tps_align(img_size, lms_r, lms_s, image_r, image_s=None,
 def tps_blend(blend_alpha, img_size, lms_r, lms_s, image_r, image_s=None, mask_r = None, mask_s=None, 
               mask_s_bound=None, blur_size=7, sample_mode='bilinear', blend_mode='smooth'):
     '''
-    image: (C, H, W), lms: (K, 2), mask:(1, H, W)
+    image: (B, C, H, W), lms: (B, K, 2), mask:(B, 1, H, W)
+    the image and the mask are warped with the same TPS grid
     '''
-    lms_s = torch.flip(lms_s, dims=[1]) / (img_size - 1)
-    lms_r = (torch.flip(lms_r, dims=[1]) / (img_size - 1)).unsqueeze(0)
-    image_r = image_r.unsqueeze(0)
-    image_trans, _ = tps_spatial_transform(img_size, img_size, lms_s, image_r, lms_r, sample_mode)
-    if mask_r is not None:
-        mask_r_trans, _ = tps_spatial_transform(img_size, img_size, lms_s, mask_r.unsqueeze(0), 
-                                                lms_r, 'nearest')
+    lms_s = torch.flip(lms_s, dims=[-1]) / (img_size - 1)
+    lms_r = torch.flip(lms_r, dims=[-1]) / (img_size - 1)
+    inverse_kernel = bulid_delta_inverse(lms_s)
+    target_coordinate_repr = build_target_coordinate_matrix(img_size, img_size, lms_s)
+    grid, _ = tps_grid(img_size, img_size, inverse_kernel, target_coordinate_repr, lms_r)
+    image_trans = grid_sample(image_r, grid, mode=sample_mode)
     if image_s is not None:
-        mask_compose = torch.ones((1, img_size, img_size), device=lms_r.device)
+        mask_compose = torch.ones_like(image_s[:, 0:1])
         if mask_s is not None:
             mask_compose *= mask_s
         if mask_r is not None:
-            mask_compose *= mask_r_trans.squeeze(0)
+            mask_compose *= grid_sample(mask_r, grid, mode='nearest')
         mask_compose = mask_blend(mask_compose, blend_alpha, mask_s_bound, blur_size, blend_mode)
-        return image_s * (1 - mask_compose) + image_trans.squeeze(0) * mask_compose
+        return image_s * (1 - mask_compose) + image_trans * mask_compose
     else:
-        return image_trans.squeeze(0)
+        return image_trans
 
 
 def fine_align(img_size, lms_r, lms_s, image_r, image_s, mask_r, mask_s, margins, blend_alphas):
     '''
-    image: (C, H, W), lms: (K, 2)
-    mask: (C, H, W), lip, face, left eye, right eye
+    image: (B, C, H, W), lms: (B, K, 2)
+    mask: (B, C, H, W), lip, face, left eye, right eye
     margins: dictionary, blend_alphas: dictionary
     '''
     # skin align
-    image_s = tps_blend(blend_alphas['skin'], img_size, lms_r[:60], lms_s[:60], image_r, image_s, 
-                        mask_r[1:2], mask_s[1:2], mask_s[1:2], blur_size=8, blend_mode='valid')
+    image_s = tps_blend(blend_alphas['skin'], img_size, lms_r[:, :60], lms_s[:, :60], image_r, image_s, 
+                        mask_r[:, 1:2], mask_s[:, 1:2], mask_s[:, 1:2], blur_size=8, blend_mode='valid')
 
     # lip align
-    mask_s_lip = expand_area(mask_s[0:1], margins['lip'])
-    mask_r_lip = expand_area(mask_r[0:1], margins['lip'])
-    image_s = tps_blend(blend_alphas['lip'], img_size, lms_r[48:], lms_s[48:], image_r, image_s, 
-                        mask_r_lip, mask_s_lip, mask_s[0:1], blur_size=3)
+    mask_s_lip = expand_area(mask_s[:, 0:1], margins['lip'])
+    mask_r_lip = expand_area(mask_r[:, 0:1], margins['lip'])
+    image_s = tps_blend(blend_alphas['lip'], img_size, lms_r[:, 48:], lms_s[:, 48:], image_r, image_s, 
+                        mask_r_lip, mask_s_lip, mask_s[:, 0:1], blur_size=3)
 
     # left eye align
-    mask_s_eye = expand_area(mask_s[2:3], margins['eye'])
-    mask_r_eye = expand_area(mask_r[2:3], margins['eye']) * mask_r[1:2]
+    mask_s_eye = expand_area(mask_s[:, 2:3], margins['eye'])
+    mask_r_eye = expand_area(mask_r[:, 2:3], margins['eye']) * mask_r[:, 1:2]
     image_s = tps_blend(blend_alphas['eye'], img_size, 
-                        torch.cat((lms_r[14:17], lms_r[22:27], lms_r[27:31], lms_r[42:48]), dim=0), 
-                        torch.cat((lms_s[14:17], lms_s[22:27], lms_s[27:31], lms_s[42:48]), dim=0), 
-                        image_r, image_s, mask_r_eye, mask_s_eye, mask_s[1:2], 
+                        torch.cat((lms_r[:, 14:17], lms_r[:, 22:27], lms_r[:, 27:31], lms_r[:, 42:48]), dim=1), 
+                        torch.cat((lms_s[:, 14:17], lms_s[:, 22:27], lms_s[:, 27:31], lms_s[:, 42:48]), dim=1), 
+                        image_r, image_s, mask_r_eye, mask_s_eye, mask_s[:, 1:2], 
                         blur_size=5, sample_mode='nearest')
 
     # right eye align
-    mask_s_eye = expand_area(mask_s[3:4], margins['eye'])
-    mask_r_eye = expand_area(mask_r[3:4], margins['eye']) * mask_r[1:2]
+    mask_s_eye = expand_area(mask_s[:, 3:4], margins['eye'])
+    mask_r_eye = expand_area(mask_r[:, 3:4], margins['eye']) * mask_r[:, 1:2]
     image_s = tps_blend(blend_alphas['eye'], img_size, 
-                        torch.cat((lms_r[0:3], lms_r[17:22], lms_r[27:31], lms_r[36:42]), dim=0), 
-                        torch.cat((lms_s[0:3], lms_s[17:22], lms_s[27:31], lms_s[36:42]), dim=0), 
-                        image_r, image_s, mask_r_eye, mask_s_eye, mask_s[1:2], 
+                        torch.cat((lms_r[:, 0:3], lms_r[:, 17:22], lms_r[:, 27:31], lms_r[:, 36:42]), dim=1), 
+                        torch.cat((lms_s[:, 0:3], lms_s[:, 17:22], lms_s[:, 27:31], lms_s[:, 36:42]), dim=1), 
+                        image_r, image_s, mask_r_eye, mask_s_eye, mask_s[:, 1:2], 
                         blur_size=5, sample_mode='nearest')
 
     return image_s
@@ -38,33 +38,40 @@ class WindowAttention(nn.Module):
         window_weight = torch.cat((window_weight, torch.flip(window_weight, dims=[1])), dim=1)
         return window_weight.view(-1)   
 
+    def split_window(self, x: torch.Tensor, num_heads):
+        """
+        input: (B, C, H, W), contiguous or channels_last
+        output: (B, h, H/S, W/S, S*S, C/h), contiguous
+        Goes through the (B, H, W, C) view, which is free for channels_last inputs,
+        so either layout costs exactly one copy, straight into the layout matmul reads.
+        """
+        bsz, dim, h, w = x.shape
+        x = x.permute(0, 2, 3, 1).view(bsz, h // self.window_size, self.window_size, w // self.window_size, 
+                                       self.window_size, num_heads, dim // num_heads)
+        x = x.permute(0, 5, 1, 3, 2, 4, 6) # (B, h, H/S, W/S, S(h), S(w), C/h)
+        return x.reshape(bsz, num_heads, h // self.window_size, w // self.window_size, 
+                         self.window_size**2, dim // num_heads)
+
     def make_window(self, x: torch.Tensor):
         """
         input: (B, C, H, W)
         output: (B, h, H/S, W/S, S*S, C/h)
         """
-        bsz, dim, h, w = x.shape
-        x = x.view(bsz, self.num_heads, dim // self.num_heads, h // self.window_size, self.window_size, 
-                   w // self.window_size, self.window_size)
-        x = x.transpose(4, 5).contiguous().view(bsz, self.num_heads, dim // self.num_heads, 
-                                                h // self.window_size, w // self.window_size, self.window_size**2)
-        x = x.permute(0, 1, 3, 4, 5, 2)
-        return x
+        return self.split_window(x, self.num_heads)
 
-    def demake_window(self, x: torch.Tensor):
+    def demake_window(self, x: torch.Tensor, channels_last=False):
         """
         input: (B, h, H/S, W/S, S*S, C/h)
-        output: (B, C, H, W)
+        output: (B, C, H, W), contiguous or channels_last, with one copy either way
         """
         bsz, _, h_s, w_s, _, dim_h = x.shape
-        x = x.permute(0, 1, 5, 2, 3, 4).contiguous()
-        #print(x.shape)
-        x = x.view(bsz, dim_h * self.num_heads, h_s, w_s, self.window_size, self.window_size)
-        #print(x.shape)
-        x = x.transpose(3, 4).contiguous().view(bsz, dim_h * self.num_heads, 
-                                                h_s * self.window_size, w_s * self.window_size)
-        #print(x.shape)
-        return x
+        x = x.view(bsz, self.num_heads, h_s, w_s, self.window_size, self.window_size, dim_h)
+        if channels_last:
+            x = x.permute(0, 2, 4, 3, 5, 1, 6) # (B, H/S, S(h), W/S, S(w), h, C/h)
+            x = x.reshape(bsz, h_s * self.window_size, w_s * self.window_size, dim_h * self.num_heads)
+            return x.permute(0, 3, 1, 2)
+        x = x.permute(0, 1, 6, 2, 4, 3, 5) # (B, h, C/h, H/S, S(h), W/S, S(w))
+        return x.reshape(bsz, dim_h * self.num_heads, h_s * self.window_size, w_s * self.window_size)
 
     @torch.no_grad()
     def make_mask_window(self, mask: torch.Tensor):
@@ -72,13 +79,7 @@ class WindowAttention(nn.Module):
         input: (B, C, H, W)
         output: (B, 1, H/S, W/S, S*S, C)
         """
-        bsz, mask_channel, h, w = mask.shape
-        mask = mask.view(bsz, 1, mask_channel, h // self.window_size, self.window_size, 
-                         w // self.window_size, self.window_size)
-        mask = mask.transpose(4, 5).contiguous().view(bsz, 1, mask_channel, 
-                                                      h // self.window_size, w // self.window_size, self.window_size**2)
-        mask = mask.permute(0, 1, 3, 4, 5, 2)
-        return mask
+        return self.split_window(mask, 1)
     
     def forward(self, fea_q, fea_k, fea_v, mask_q=None, mask_k=None):
         '''
@@ -88,6 +89,8 @@ class WindowAttention(nn.Module):
         query = self.q_proj(fea_q) # (B, D, H, W)
         key = self.k_proj(fea_k)
         value = self.v_proj(fea_v)
+        # the output follows the layout of the (channels_last) model
+        channels_last = query.is_contiguous(memory_format=torch.channels_last)
         query = self.make_window(query) # (B, h, H/S, W/S, S*S, D/h)
         key = self.make_window(key)
         value = self.make_window(value)
@@ -104,7 +107,8 @@ class WindowAttention(nn.Module):
                 mask_attn = mask_attn.masked_fill_(mask_attn == 0, float('-inf')).masked_fill_(mask_attn == 1, float(0.0))
             weights += mask_attn        
 
-        weights = self.dropout(F.softmax(weights, dim=-1))
+        # normalize in fp32, also under bf16 autocast
+        weights = self.dropout(F.softmax(weights, dim=-1, dtype=torch.float32))
         if mask_q is not None and mask_k is not None:
             weights = weights * (1 - (mask_sum == 0).float().detach())
 
@@ -112,7 +116,7 @@ class WindowAttention(nn.Module):
         if self.weighted_output:
             window_weight = self.window_weight.view(1, 1, 1, 1, self.window_size ** 2, 1)
             out = out * window_weight
-        out = self.demake_window(out) #(B, D, H, W)
+        out = self.demake_window(out, channels_last) #(B, D, H, W)
         return out
 
 class SowAttention(nn.Module):
@@ -267,7 +271,8 @@ class StridedwindowAttention(nn.Module):
                 mask_attn = mask_attn.masked_fill_(mask_attn == 0, float('-inf')).masked_fill_(mask_attn == 1, float(0.0))
             weights += mask_attn        
 
-        weights = self.dropout(F.softmax(weights, dim=-1))
+        # normalize in fp32, also under bf16 autocast
+        weights = self.dropout(F.softmax(weights, dim=-1, dtype=torch.float32))
         if mask_q is not None and mask_k is not None:
             weights = weights * (1 - (mask_sum == 0).float().detach())
 
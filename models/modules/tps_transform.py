@@ -1,7 +1,6 @@
 from __future__ import absolute_import
 
 import numpy as np
-import itertools
 
 import torch
 import torch.nn as nn
@@ -25,13 +24,15 @@ def grid_sample(input, grid, mode='bilinear', canvas=None):
 
 # phi(x1, x2) = r^2 * log(r), where r = ||x1 - x2||_2
 def compute_partial_repr(input_points, control_points):
-    N = input_points.size(0)
-    M = control_points.size(0)
-    pairwise_diff = input_points.view(N, 1, 2) - control_points.view(1, M, 2)
+    '''
+    input_points: (N, 2) or (B, N, 2), control_points: (M, 2) or (B, M, 2)
+    return: (N, M) or (B, N, M)
+    '''
+    pairwise_diff = input_points.unsqueeze(-2) - control_points.unsqueeze(-3)
     # original implementation, very slow
     # pairwise_dist = torch.sum(pairwise_diff ** 2, dim = 2) # square of distance
     pairwise_diff_square = pairwise_diff * pairwise_diff
-    pairwise_dist = pairwise_diff_square[:, :, 0] + pairwise_diff_square[:, :, 1]
+    pairwise_dist = pairwise_diff_square[..., 0] + pairwise_diff_square[..., 1]
     repr_matrix = 0.5 * pairwise_dist * torch.log(pairwise_dist)
     #repr_matrix = 0.5 * pairwise_dist * torch.log(pairwise_dist + 1e-8)
     # fix numerical error for 0 * log(0), substitute all nan with 0
@@ -43,16 +44,18 @@ def compute_partial_repr(input_points, control_points):
 # compute \Delta_c^-1
 def bulid_delta_inverse(target_control_points):
     '''
-    target_control_points: (N, 2)
+    target_control_points: (N, 2) or (B, N, 2)
     '''
-    N = target_control_points.shape[0]
-    forward_kernel = torch.zeros(N + 3, N + 3).to(target_control_points.device)
+    N = target_control_points.shape[-2]
+    batch_shape = target_control_points.shape[:-2]
+    device = target_control_points.device
     target_control_partial_repr = compute_partial_repr(target_control_points, target_control_points)
-    forward_kernel[:N, :N].copy_(target_control_partial_repr)
-    forward_kernel[:N, -3].fill_(1)
-    forward_kernel[-3, :N].fill_(1)
-    forward_kernel[:N, -2:].copy_(target_control_points)
-    forward_kernel[-2:, :N].copy_(target_control_points.transpose(0, 1))
+    # [[K, 1, P], [1^T, 0, 0], [P^T, 0, 0]], assembled with cat rather than slice writes so it traces to ONNX
+    ones = torch.ones(batch_shape + (N, 1), device=device)
+    upper = torch.cat([target_control_partial_repr, ones, target_control_points], dim=-1)
+    lower = torch.cat([ones.transpose(-1, -2), target_control_points.transpose(-1, -2)], dim=-2)
+    lower = torch.cat([lower, torch.zeros(batch_shape + (3, 3), device=device)], dim=-1)
+    forward_kernel = torch.cat([upper, lower], dim=-2)
     # compute inverse matrix
     inverse_kernel = torch.inverse(forward_kernel)
     return inverse_kernel
@@ -61,20 +64,21 @@ def bulid_delta_inverse(target_control_points):
 # create target coordinate matrix
 def build_target_coordinate_matrix(target_height, target_width, target_control_points):
     '''
-    target_control_points: (N, 2)
+    target_control_points: (N, 2) or (B, N, 2)
+    return: (HW, N + 3) or (B, HW, N + 3)
     '''
-    HW = target_height * target_width
-    target_coordinate = list(itertools.product(range(target_height), range(target_width)))
-    target_coordinate = torch.Tensor(target_coordinate).to(target_control_points.device) # HW x 2
-    Y, X = target_coordinate.split(1, dim = 1)
-    Y = Y / (target_height - 1)
-    X = X / (target_width - 1)
-    target_coordinate = torch.cat([X, Y], dim = 1) # convert from (y, x) to (x, y)
+    device = target_control_points.device
+    Y, X = torch.meshgrid(torch.arange(target_height, dtype=torch.float32, device=device),
+                          torch.arange(target_width, dtype=torch.float32, device=device), indexing='ij')
+    Y = Y.reshape(-1, 1) / (target_height - 1)
+    X = X.reshape(-1, 1) / (target_width - 1)
+    target_coordinate = torch.cat([X, Y], dim = 1) # HW x 2, (x, y)
     target_coordinate_partial_repr = compute_partial_repr(target_coordinate, target_control_points)
+    batch_shape = target_coordinate_partial_repr.shape[:-1]
     target_coordinate_repr = torch.cat([
         target_coordinate_partial_repr, 
-        torch.ones((HW, 1), device=target_control_points.device), 
-        target_coordinate], dim = 1)
+        torch.ones(batch_shape + (1,), device=device), 
+        target_coordinate.expand(batch_shape + (2,))], dim = -1)
     return target_coordinate_repr
 
 
@@ -86,8 +90,23 @@ def tps_sampler(target_height, target_width, inverse_kernel, target_coordinate_r
     source: (B, C, H, W)
     source_control_points: (B, N, 2)
     '''
-    batch_size = source.shape[0]
-    Y = torch.cat([source_control_points, torch.zeros((batch_size, 3, 2), device=source.device)], dim=1)
+    grid, source_coordinate = tps_grid(target_height, target_width, inverse_kernel, 
+                                       target_coordinate_repr, source_control_points)
+    output_maps = grid_sample(source, grid, mode=sample_mode, canvas=None)
+    return output_maps, source_coordinate
+
+
+def tps_grid(target_height, target_width, inverse_kernel, target_coordinate_repr, source_control_points):
+    r'''
+    The sampling grid of a TPS transform, shared by all the maps warped with the same control points.
+    inverse_kernel: \Delta_C^-1, (N + 3, N + 3) or per sample (B, N + 3, N + 3)
+    target_coordinate_repr: \hat{p}, (HW, N + 3) or per sample (B, HW, N + 3)
+    source_control_points: (B, N, 2)
+    return: grid (B, H, W, 2) in [-1, 1], source_coordinate (B, HW, 2)
+    '''
+    batch_size = source_control_points.shape[0]
+    Y = torch.cat([source_control_points, 
+                   torch.zeros((batch_size, 3, 2), device=source_control_points.device)], dim=1)
     mapping_matrix = torch.matmul(inverse_kernel, Y)
     source_coordinate = torch.matmul(target_coordinate_repr, mapping_matrix)
 
@@ -95,8 +114,7 @@ def tps_sampler(target_height, target_width, inverse_kernel, target_coordinate_r
     grid = torch.clamp(grid, 0, 1) # the source_control_points may be out of [0, 1].
     # the input to grid_sample is normalized [-1, 1], but what we get is [0, 1]
     grid = 2.0 * grid - 1.0
-    output_maps = grid_sample(source, grid, mode=sample_mode, canvas=None)
-    return output_maps, source_coordinate
+    return grid, source_coordinate
 
 
 def tps_spatial_transform(target_height, target_width, target_control_points, 
@@ -0,0 +1,160 @@
+import os
+import json
+import torch
+import torch.nn as nn
+
+from concern.track import span
+
+try:
+    import onnxruntime as ort
+    ONNXRUNTIME_AVAILABLE = True
+except ImportError:
+    ONNXRUNTIME_AVAILABLE = False
+
+
+# encodings cross the graph boundaries flattened, level by level:
+# [fea_list, mask_list, diff_list, lms_list] <-> fea_1, fea_2, mask_1, mask_2, ...
+TRANSFER_KEYS = ('fea', 'mask', 'diff', 'lms')
+NUM_LEVELS = 2
+
+
+def flatten_transfer_input(transfer_input):
+    return [x for tensors in transfer_input for x in tensors]
+
+
+def unflatten_transfer_input(tensors):
+    return [list(tensors[i * NUM_LEVELS:(i + 1) * NUM_LEVELS]) for i in range(len(TRANSFER_KEYS))]
+
+
+def transfer_input_names(prefix=''):
+    return ['{}{}_{:d}'.format(prefix, key, level + 1) for key in TRANSFER_KEYS for level in range(NUM_LEVELS)]
+
+
+############################## Export ##############################
+class EncodeStage(nn.Module):
+    """Generator.get_transfer_input with flat tensor outputs"""
+    def __init__(self, G, is_reference=False):
+        super(EncodeStage, self).__init__()
+        self.G = G
+        self.is_reference = is_reference
+
+    def forward(self, image, mask, diff, lms):
+        return tuple(flatten_transfer_input(self.G.get_transfer_input(image, mask, diff, lms, self.is_reference)))
+
+
+class TransferStage(nn.Module):
+    """Generator.get_transfer_output on flat content and style encodings"""
+    def __init__(self, G):
+        super(TransferStage, self).__init__()
+        self.G = G
+
+    def forward(self, *tensors):
+        size = len(TRANSFER_KEYS) * NUM_LEVELS
+        transfer_input_c = unflatten_transfer_input(tensors[:size])
+        transfer_input_s = unflatten_transfer_input(tensors[size:])
+        return tuple(self.G.get_transfer_output(*transfer_input_c, *transfer_input_s))
+
+
+class DecodeStage(nn.Module):
+    """Generator.decode on flat features and attention outputs"""
+    def __init__(self, G):
+        super(DecodeStage, self).__init__()
+        self.G = G
+
+    def forward(self, *tensors):
+        return self.G.decode(list(tensors[:NUM_LEVELS]), list(tensors[NUM_LEVELS:]))
+
+
+def stage_signatures(double_encoder):
+    '''
+    return: dict, stage -> (input names, output names)
+    '''
+    encode = (['image', 'mask', 'diff', 'lms'], transfer_input_names())
+    signatures = {'encode': encode}
+    if double_encoder:
+        signatures['encode_reference'] = encode
+    signatures['transfer'] = (transfer_input_names('c_') + transfer_input_names('s_'),
+                              ['attn_{:d}'.format(level + 1) for level in range(NUM_LEVELS)])
+    signatures['decode'] = (['fea_{:d}'.format(level + 1) for level in range(NUM_LEVELS)] +
+                            ['attn_{:d}'.format(level + 1) for level in range(NUM_LEVELS)], ['image'])
+    return signatures
+
+
+############################## Runtime ##############################
+class OnnxGenerator:
+    """
+    The exported Generator stages on ONNX Runtime's CPU execution provider, behind the
+    same get_transfer_input / get_transfer_output / decode calls as the torch Generator,
+    so Inference keeps caching encodings and fusing attention outputs between them.
+    Tensors go in and come out as CPU float32 torch tensors.
+    """
+    def __init__(self, folder, num_threads=None):
+        if not ONNXRUNTIME_AVAILABLE:
+            raise ImportError('The onnxruntime backend needs onnxruntime, install it with: pip install onnxruntime')
+        with open(os.path.join(folder, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.double_encoder = self.meta['double_encoder']
+        self.batch_size = self.meta['batch_size']
+        self.sessions = {name: self.load_session(folder, name, num_threads) for name in self.meta['stages']}
+        # the exporter prunes graph inputs a stage never reads, e.g. the level-2 landmarks
+        self.inputs = {}
+        for name, session in self.sessions.items():
+            used = {arg.name for arg in session.get_inputs()}
+            self.inputs[name] = [(arg, arg in used) for arg in self.meta['stages'][name]['inputs']]
+
+    @staticmethod
+    def load_session(folder, name, num_threads=None):
+        '''
+        The first load optimizes the graph and saves the result next to it;
+        later loads of an up-to-date optimized graph skip the optimization passes.
+        '''
+        path = os.path.join(folder, name + '.onnx')
+        optimized = os.path.join(folder, name + '.optimized.onnx')
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        if os.path.exists(optimized) and os.path.getmtime(optimized) >= os.path.getmtime(path):
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            path = optimized
+        else:
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            options.optimized_model_filepath = optimized
+        return ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+    def run(self, name, tensors):
+        # the stages are exported with a fixed batch dimension
+        for x in tensors:
+            if x.shape[0] != self.batch_size:
+                raise ValueError('The {} stage was exported for batch size {:d}, got a batch of {:d}; '
+                                 're-export it with scripts/export_onnx.py --batch-size {:d}'.format(
+                                     name, self.batch_size, x.shape[0], x.shape[0]))
+        feeds = {arg: x.detach().to('cpu', torch.float32).contiguous().numpy()
+                 for (arg, used), x in zip(self.inputs[name], tensors) if used}
+        return [torch.from_numpy(x) for x in self.sessions[name].run(None, feeds)]
+
+    def get_transfer_input(self, image, mask, diff, lms, is_reference=False):
+        with span('encode', reference=is_reference, backend='onnxruntime'):
+            name = 'encode_reference' if self.double_encoder and is_reference else 'encode'
+            return unflatten_transfer_input(self.run(name, (image, mask, diff, lms)))
+
+    def get_transfer_output(self, fea_c_list, mask_c_list, diff_c_list, lms_c_list,
+                            fea_s_list, mask_s_list, diff_s_list, lms_s_list):
+        with span('transfer', backend='onnxruntime'):
+            transfer_input_c = [fea_c_list, mask_c_list, diff_c_list, lms_c_list]
+            transfer_input_s = [fea_s_list, mask_s_list, diff_s_list, lms_s_list]
+            return self.run('transfer', flatten_transfer_input(transfer_input_c) +
+                            flatten_transfer_input(transfer_input_s))
+
+    def decode(self, fea_c_list, attn_out_list):
+        with span('decode', backend='onnxruntime'):
+            return self.run('decode', list(fea_c_list) + list(attn_out_list))[0]
+
+    def transfer(self, transfer_input_c, transfer_input_s):
+        attn_out_list = self.get_transfer_output(*transfer_input_c, *transfer_input_s)
+        return self.decode(transfer_input_c[0], attn_out_list)
+
+    def __call__(self, c, s, mask_c, mask_s, diff_c, diff_s, lms_c, lms_s):
+        """Generator.forward"""
+        transfer_input_c = self.get_transfer_input(c, mask_c, diff_c, lms_c)
+        transfer_input_s = self.get_transfer_input(s, mask_s, diff_s, lms_s, True)
+        return self.transfer(transfer_input_c, transfer_input_s)
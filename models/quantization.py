@@ -0,0 +1,109 @@
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QConfig, QuantWrapper, convert, default_dynamic_qconfig, \
+    default_weight_observer, get_default_qconfig, prepare, quantize_dynamic
+
+
+# layers with int8 kernels; InstanceNorm, the attention softmax and the TPS alignment
+# are not among them and stay fp32 between the quantized layers
+QUANTIZABLE = (nn.Conv2d, nn.ConvTranspose2d, nn.Linear)
+SCHEMES = ('static', 'dynamic')
+
+
+def default_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise RuntimeError('No quantized engine available in this torch build')
+
+
+def is_quantized_checkpoint(state):
+    return isinstance(state, dict) and 'quantization' in state and 'state_dict' in state
+
+
+def quantizable_modules(G, scheme='static', skip=()):
+    '''
+    skip: module names (with their submodules) left in fp32, e.g. ('in_conv', 'out_conv')
+    return: names of the layers quantized under `scheme`; dynamic quantization only has Linear kernels
+    '''
+    types = QUANTIZABLE if scheme == 'static' else (nn.Linear,)
+    names = []
+    for name, module in G.named_modules():
+        if isinstance(module, types) and not any(name == s or name.startswith(s + '.') for s in skip):
+            names.append(name)
+    return names
+
+
+def get_qconfig(module, engine):
+    qconfig = get_default_qconfig(engine)
+    if isinstance(module, nn.ConvTranspose2d):
+        # quantized transposed convolutions only take per-tensor weights
+        qconfig = QConfig(activation=qconfig.activation, weight=default_weight_observer)
+    return qconfig
+
+
+def prepare_static(G, names, engine):
+    '''
+    Wrap every named layer as quantize -> layer -> dequantize and attach observers, in place.
+    Run the model on calibration data before `convert_static`.
+    '''
+    torch.backends.quantized.engine = engine
+    for name in names:
+        parent_name, _, child = name.rpartition('.')
+        parent = G.get_submodule(parent_name) if parent_name else G
+        wrapper = QuantWrapper(getattr(parent, child))
+        wrapper.qconfig = get_qconfig(wrapper.module, engine)
+        setattr(parent, child, wrapper)
+    prepare(G, inplace=True)
+    return G
+
+
+def convert_static(G):
+    return convert(G.eval(), inplace=True)
+
+
+def quantize_generator_dynamic(G, names, engine):
+    torch.backends.quantized.engine = engine
+    qconfig_spec = {name: default_dynamic_qconfig for name in names}
+    return quantize_dynamic(G.eval(), qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+def quantized_checkpoint(model, scheme, engine, names, **info):
+    '''
+    info: extra entries recorded with the scheme, e.g. how the fp32 model was prepared
+    '''
+    return {
+        'quantization': dict(info, scheme=scheme, engine=engine, modules=list(names)),
+        'state_dict': model.state_dict()
+    }
+
+
+def load_quantized_model(model, state):
+    '''
+    Rebuild the quantized layers of a fresh fp32 model and load a checkpoint written by
+    `quantized_checkpoint`. Quantized kernels run on the CPU only.
+    '''
+    info = state['quantization']
+    if info['scheme'] not in SCHEMES:
+        raise ValueError('Unknown quantization scheme: {}'.format(info['scheme']))
+    if info['engine'] not in torch.backends.quantized.supported_engines:
+        raise RuntimeError('Quantized engine {} is not available here'.format(info['engine']))
+    model.eval()
+    if info['scheme'] == 'static':
+        prepare_static(model, info['modules'], info['engine'])
+        # the observers have seen no data; their placeholder qparams are overwritten by the checkpoint
+        convert_static(model)
+    else:
+        quantize_generator_dynamic(model, info['modules'], info['engine'])
+    model.load_state_dict(state['state_dict'])
+    return model
+
+
+def load_quantized_generator(G, state):
+    '''
+    Load a Generator checkpoint written by scripts/quantize_generator.py.
+    '''
+    # int8 layers are fed fp32 activations, never bf16 ones
+    G.precision = 'fp32'
+    return load_quantized_model(G, state)
@@ -10,13 +10,17 @@ import sys
 import argparse
 import json
 import time
-import tracemalloc
+from contextlib import ExitStack
 
 sys.path.append('.')
 
+import numpy as np
 import torch
 from PIL import Image
 
+from concern.history import DEFAULT_HISTORY, record_run
+from concern.memory import MB, RSSSampler, TorchMemoryStats, read_rss, release_memory, stage_memory
+from concern.track import trace
 from training.config import get_config
 from training.inference import Inference
 
@@ -59,6 +63,33 @@ def load_images_from_manifest(manifest_path: str, max_images: int = None):
     return images, reference_path
 
 
+def fit_memory_model(per_image_results):
+    """
+    Least-squares fit of per-image RSS growth against face count and resolution,
+    used to size container memory limits.
+    return: dict with 'base_mb', 'per_face_mb' and (if resolutions vary) 'per_megapixel_mb', or None
+    """
+    rows = [r for r in per_image_results if r['success'] and 'rss_growth_mb' in r]
+    if len(rows) < 2:
+        return None
+    y = np.array([r['rss_growth_mb'] for r in rows])
+    columns = {
+        'base_mb': np.ones(len(rows)),
+        'per_face_mb': np.array([r['expected_faces'] for r in rows], dtype=np.float64),
+        'per_megapixel_mb': np.array([r['megapixels'] for r in rows])
+    }
+    for names in (['base_mb', 'per_face_mb', 'per_megapixel_mb'], ['base_mb', 'per_face_mb'],
+                  ['base_mb', 'per_megapixel_mb']):
+        A = np.stack([columns[n] for n in names], axis=1)
+        if len(rows) < len(names) or np.linalg.matrix_rank(A) < len(names):
+            continue
+        coef, _, _, _ = np.linalg.lstsq(A, y, rcond=None)
+        model = {n: float(c) for n, c in zip(names, coef)}
+        model['max_residual_mb'] = float(np.abs(A @ coef - y).max())
+        return model
+    return None
+
+
 def run_benchmark(
     images: list,
     reference_path: str,
@@ -67,7 +98,8 @@ def run_benchmark(
     model_path: str = 'ckpts/sow_pyramid_a5_e3d2_remapped.pth',
     measure_memory: bool = False,
     use_cache: bool = False,
-    optimize: bool = False
+    optimize: bool = False,
+    memory_interval: float = 0.005
 ):
     os.makedirs(output_dir, exist_ok=True)
     
@@ -78,8 +110,7 @@ def run_benchmark(
         except ImportError:
             pass
     
-    if measure_memory:
-        tracemalloc.start()
+    rss_before_init = read_rss()
     
     args, model_path = create_args(device, model_path)
     config = get_config()
@@ -87,6 +118,7 @@ def run_benchmark(
     init_start = time.perf_counter()
     inference = Inference(config, args, model_path)
     init_time = time.perf_counter() - init_start
+    rss_after_init = read_rss()
     
     reference = Image.open(reference_path).convert('RGB')
     
@@ -100,6 +132,8 @@ def run_benchmark(
     results = []
     total_faces = 0
     total_processing_time = 0
+    peak_memory = 0
+    stage_totals = {}
     
     for i, img_info in enumerate(images):
         img_path = img_info['path']
@@ -107,14 +141,21 @@ def run_benchmark(
         
         source = Image.open(img_path).convert('RGB')
         
-        img_start = time.perf_counter()
-        
-        if cached_reference is not None and hasattr(inference, 'transfer_all_faces_cached'):
-            result = inference.transfer_all_faces_cached(source, cached_reference, postprocess=True)
-        else:
-            result = inference.transfer_all_faces(source, reference, postprocess=True)
-        
-        img_time = time.perf_counter() - img_start
+        with ExitStack() as stack:
+            if measure_memory:
+                release_memory()
+                sampler = stack.enter_context(RSSSampler(memory_interval))
+                torch_memory = stack.enter_context(TorchMemoryStats(device))
+            image_trace = stack.enter_context(trace('image', index=i))
+            
+            img_start = time.perf_counter()
+            
+            if cached_reference is not None and hasattr(inference, 'transfer_all_faces_cached'):
+                result = inference.transfer_all_faces_cached(source, cached_reference, postprocess=True)
+            else:
+                result = inference.transfer_all_faces(source, reference, postprocess=True)
+            
+            img_time = time.perf_counter() - img_start
         total_processing_time += img_time
         
         faces_processed = expected_faces if result is not None else 0
@@ -124,19 +165,32 @@ def run_benchmark(
             output_path = os.path.join(output_dir, f'result_{i}.png')
             result.save(output_path)
         
-        results.append({
+        image_result = {
             'image': os.path.basename(img_path),
             'expected_faces': expected_faces,
             'faces_processed': faces_processed,
+            'resolution': list(source.size),
+            'megapixels': source.size[0] * source.size[1] / 1e6,
             'time_seconds': img_time,
             'success': result is not None
-        })
-    
-    peak_memory_mb = 0
-    if measure_memory:
-        current, peak = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
-        peak_memory_mb = peak / 1024 / 1024
+        }
+        if measure_memory:
+            image_peak = sampler.peak()
+            peak_memory = max(peak_memory, image_peak)
+            stages = stage_memory(image_trace, sampler)
+            stages.pop('image', None)
+            for name, item in stages.items():
+                total = stage_totals.setdefault(name, {'count': 0, 'peak_rss_mb': 0.0, 'growth_mb': 0.0})
+                total['count'] += item['count']
+                total['peak_rss_mb'] = max(total['peak_rss_mb'], item['peak_rss_mb'])
+                total['growth_mb'] = max(total['growth_mb'], item['growth_mb'])
+            image_result.update({
+                'peak_rss_mb': image_peak / MB,
+                'rss_growth_mb': (image_peak - sampler.samples[0][1]) / MB,
+                'torch_memory': torch_memory.stats,
+                'stage_memory': stages
+            })
+        results.append(image_result)
     
     return {
         'total_time_seconds': total_processing_time,
@@ -146,7 +200,11 @@ def run_benchmark(
         'total_faces': total_faces,
         'avg_time_per_image': total_processing_time / len(images) if images else 0,
         'avg_time_per_face': total_processing_time / total_faces if total_faces > 0 else 0,
-        'peak_memory_mb': peak_memory_mb,
+        'peak_memory_mb': peak_memory / MB,
+        'rss_before_init_mb': rss_before_init / MB,
+        'rss_after_init_mb': rss_after_init / MB,
+        'stage_memory': stage_totals,
+        'memory_model': fit_memory_model(results) if measure_memory else None,
         'device': device,
         'use_cache': use_cache,
         'optimize': optimize,
@@ -162,6 +220,8 @@ def main():
 Examples:
     python scripts/benchmark.py --images 2 --reference test_data/benchmark/reference.png
     python scripts/benchmark.py --images 8 --measure-memory --json results/metrics.json
+    python scripts/benchmark.py --images 2 --repeat 5 --use-cache
+    python scripts/benchmark_report.py compare -2 -1
         """
     )
     
@@ -185,15 +245,24 @@ Examples:
     parser.add_argument('--cold-start', action='store_true',
                         help='Measure cold-start time (no warmup)')
     parser.add_argument('--measure-memory', action='store_true',
-                        help='Track peak memory usage')
+                        help='Track peak RSS per stage and torch allocator statistics')
+    parser.add_argument('--memory-interval', type=float, default=0.005,
+                        help='RSS sampling interval in seconds (default: 0.005)')
     parser.add_argument('--optimize', action='store_true',
                         help='Apply CPU optimizations')
     parser.add_argument('--use-cache', action='store_true',
                         help='Use reference caching if available')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Process the image set this many times (default: 1)')
+    parser.add_argument('--history', type=str, default=DEFAULT_HISTORY,
+                        help=f'JSONL history store the run is appended to (default: {DEFAULT_HISTORY})')
+    parser.add_argument('--no-history', action='store_true',
+                        help='Do not record the run in the history store')
     
     args = parser.parse_args()
     
     images, reference_path = load_images_from_manifest(args.manifest, args.images)
+    images = images * args.repeat
     
     if args.reference != 'test_data/benchmark/reference.png':
         reference_path = args.reference
@@ -206,6 +275,7 @@ Examples:
     print(f"  Memory tracking: {args.measure_memory}")
     print(f"  Optimizations: {args.optimize}")
     print(f"  Use cache: {args.use_cache}")
+    print(f"  Repeat: {args.repeat}")
     print()
     
     start_time = time.perf_counter()
@@ -217,7 +287,8 @@ Examples:
         model_path=args.model_path,
         measure_memory=args.measure_memory,
         use_cache=args.use_cache,
-        optimize=args.optimize
+        optimize=args.optimize,
+        memory_interval=args.memory_interval
     )
     wall_time = time.perf_counter() - start_time
     metrics['wall_time_seconds'] = wall_time
@@ -234,20 +305,70 @@ Examples:
     print(f"Total faces: {metrics['total_faces']}")
     print(f"Avg time per image: {metrics['avg_time_per_image']:.2f}s")
     print(f"Avg time per face: {metrics['avg_time_per_face']:.2f}s")
+    print(f"RSS before/after model init: {metrics['rss_before_init_mb']:.0f} / "
+          f"{metrics['rss_after_init_mb']:.0f} MB")
     if metrics['peak_memory_mb'] > 0:
-        print(f"Peak memory: {metrics['peak_memory_mb']:.1f} MB")
+        print(f"Peak RSS: {metrics['peak_memory_mb']:.1f} MB")
     print()
     
+    if metrics['stage_memory']:
+        print("Per-stage memory (max over images):")
+        for name, item in metrics['stage_memory'].items():
+            print(f"  {name}: peak {item['peak_rss_mb']:.0f} MB, growth +{item['growth_mb']:.1f} MB "
+                  f"(x{item['count']})")
+        print()
+    
     print("Per-image breakdown:")
     for r in metrics['per_image_results']:
         status = "OK" if r['success'] else "FAILED"
-        print(f"  {r['image']}: {r['time_seconds']:.2f}s, {r['faces_processed']} faces [{status}]")
+        line = (f"  {r['image']}: {r['time_seconds']:.2f}s, {r['faces_processed']} faces, "
+                f"{r['resolution'][0]}x{r['resolution'][1]} ({r['megapixels']:.1f} MP)")
+        if 'rss_growth_mb' in r:
+            line += (f", RSS +{r['rss_growth_mb']:.0f} MB, "
+                     f"torch peak {r['torch_memory'].get('peak_mb', 0):.0f} MB")
+        print(f"{line} [{status}]")
+    
+    model = metrics['memory_model']
+    if model:
+        print()
+        terms = [f"{model['base_mb']:.0f} MB"]
+        if 'per_face_mb' in model:
+            terms.append(f"{model['per_face_mb']:.1f} MB/face")
+        if 'per_megapixel_mb' in model:
+            terms.append(f"{model['per_megapixel_mb']:.1f} MB/MP")
+        print(f"Memory per image ~ {' + '.join(terms)} above the "
+              f"{metrics['rss_after_init_mb']:.0f} MB model footprint "
+              f"(max residual {model['max_residual_mb']:.0f} MB)")
     
     if args.json:
         os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
         with open(args.json, 'w') as f:
             json.dump(metrics, f, indent=2)
         print(f"\nMetrics saved to: {args.json}")
+    
+    if not args.no_history:
+        samples = {}
+        for r in metrics['per_image_results']:
+            if r['success']:
+                samples.setdefault('image:' + r['image'], []).append(r['time_seconds'])
+                samples.setdefault('per_face', []).append(r['time_seconds'] / max(r['faces_processed'], 1))
+        record = record_run(
+            'benchmark',
+            options={
+                'device': args.device,
+                'images': args.images,
+                'manifest': args.manifest,
+                'reference': reference_path,
+                'model_path': args.model_path,
+                'use_cache': args.use_cache,
+                'optimize': args.optimize,
+                'measure_memory': args.measure_memory
+            },
+            metrics={k: v for k, v in metrics.items() if not isinstance(v, (list, dict))},
+            samples=samples,
+            path=args.history
+        )
+        print(f"Run {record['id']} recorded in {args.history}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Report on the benchmark history recorded by scripts/benchmark.py.
+
+Runs are identified by their id (or a unique prefix), a git revision prefix
+(latest run of that revision), 'latest' or a negative index ('-2' = second to last).
+
+Usage:
+    python scripts/benchmark_report.py list
+    python scripts/benchmark_report.py compare -2 -1
+    python scripts/benchmark_report.py trend --sample per_face
+"""
+import os
+import sys
+import argparse
+import json
+
+sys.path.append('.')
+
+from concern.history import DEFAULT_HISTORY, find_run, load_runs
+from concern.stats import compare_samples, summarize
+
+
+def describe(run):
+    git = run['git']
+    revision = (git['revision'][:7] or 'nogit') + ('+' if git['dirty'] else '')
+    options = ', '.join(f'{k}={v}' for k, v in run['options'].items()
+                        if k in ('device', 'use_cache', 'optimize', 'measure_memory'))
+    return f"{run['id']}  {revision:8s}  host {run['host']['fingerprint']}  " \
+           f"threads {run['threads']['torch_threads']}  {options}"
+
+
+def differences(a, b):
+    """Settings that differ between two runs and make their timings not directly comparable"""
+    diffs = []
+    if a['host']['fingerprint'] != b['host']['fingerprint']:
+        diffs.append(f"host {a['host']['fingerprint']} vs {b['host']['fingerprint']}")
+    for group in ('threads', 'options'):
+        for key in sorted(set(a[group]) | set(b[group])):
+            if a[group].get(key) != b[group].get(key):
+                diffs.append(f"{key} {a[group].get(key)} vs {b[group].get(key)}")
+    return diffs
+
+
+def compare_runs(a, b, alpha=0.05, tolerance=0.05):
+    samples = {}
+    for name in a['samples']:
+        if name in b['samples']:
+            samples[name] = compare_samples(a['samples'][name], b['samples'][name], alpha, tolerance)
+    metrics = {}
+    for name, value in a['metrics'].items():
+        other = b['metrics'].get(name)
+        if isinstance(value, (int, float)) and isinstance(other, (int, float)) and not isinstance(value, bool):
+            metrics[name] = {'a': value, 'b': other, 'change': (other - value) / value if value else 0.0}
+    return {'a': a['id'], 'b': b['id'], 'differences': differences(a, b),
+            'samples': samples, 'metrics': metrics}
+
+
+def trend(runs, sample, alpha=0.05, tolerance=0.05, confidence=0.95):
+    rows = []
+    previous = None
+    for run in runs:
+        values = run['samples'].get(sample)
+        if not values:
+            continue
+        row = {'id': run['id'], 'revision': run['git']['revision'][:7], 'dirty': run['git']['dirty'],
+               'subject': run['git'].get('subject', ''), **summarize(values, confidence)}
+        if previous is not None:
+            row['vs_previous'] = compare_samples(previous, values, alpha, tolerance)
+        rows.append(row)
+        previous = values
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare benchmark runs and show latency trends across commits',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python scripts/benchmark_report.py list --limit 10
+    python scripts/benchmark_report.py compare a1b2c3d latest --alpha 0.01
+    python scripts/benchmark_report.py trend --sample image:two_faces.jpg --option use_cache=True
+        """
+    )
+    parser.add_argument('--history', type=str, default=DEFAULT_HISTORY,
+                        help=f'JSONL history store (default: {DEFAULT_HISTORY})')
+    parser.add_argument('--json', type=str, default=None, help='Path to save the report as JSON')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = subparsers.add_parser('list', help='List recorded runs')
+    list_parser.add_argument('--limit', type=int, default=20)
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two runs')
+    compare_parser.add_argument('a', help='Baseline run')
+    compare_parser.add_argument('b', nargs='?', default='latest', help='Candidate run (default: latest)')
+
+    trend_parser = subparsers.add_parser('trend', help='Show a sample across runs')
+    trend_parser.add_argument('--sample', type=str, default='per_face',
+                              help="Sample to follow, e.g. per_face or image:single_face.jpg (default: per_face)")
+    trend_parser.add_argument('--host', type=str, default=None,
+                              help="Host fingerprint prefix (default: the latest run's host)")
+    trend_parser.add_argument('--option', action='append', default=[],
+                              help='Only runs with this option value, e.g. use_cache=True (repeatable)')
+    trend_parser.add_argument('--limit', type=int, default=30)
+
+    for sub in (compare_parser, trend_parser):
+        sub.add_argument('--alpha', type=float, default=0.05,
+                         help='Significance level of the Welch t-test (default: 0.05)')
+        sub.add_argument('--tolerance', type=float, default=0.05,
+                         help='Relative change below which differences are ignored (default: 0.05)')
+    args = parser.parse_args()
+
+    runs = load_runs(args.history, kind='benchmark')
+    if not runs:
+        print(f"No runs recorded in {args.history}")
+        sys.exit(1)
+
+    if args.command == 'list':
+        report = runs[-args.limit:]
+        for run in report:
+            per_face = run['samples'].get('per_face')
+            mean = f"{sum(per_face) / len(per_face):.3f}s/face" if per_face else 'n/a'
+            print(f"{describe(run)}  {mean}")
+
+    elif args.command == 'compare':
+        a, b = find_run(runs, args.a), find_run(runs, args.b)
+        report = compare_runs(a, b, args.alpha, args.tolerance)
+        print("=" * 50)
+        print("BENCHMARK COMPARISON")
+        print("=" * 50)
+        print(f"A: {describe(a)}")
+        print(f"B: {describe(b)}")
+        for diff in report['differences']:
+            print(f"  warning: {diff}")
+        print()
+        for name, item in report['samples'].items():
+            print(f"  {name}: {item['baseline_mean']:.3f}s -> {item['current_mean']:.3f}s "
+                  f"({item['change'] * 100:+.1f}%, p={item['p_value']:.3g}) {item['verdict']}")
+        print()
+        for name, item in report['metrics'].items():
+            print(f"  {name}: {item['a']:.3f} -> {item['b']:.3f} ({item['change'] * 100:+.1f}%)")
+
+    else:
+        host = args.host or runs[-1]['host']['fingerprint']
+        options = {}
+        for option in args.option:
+            key, value = option.split('=', 1)
+            options[key] = json.loads(value.lower()) if value.lower() in ('true', 'false') else value
+        selected = load_runs(args.history, kind='benchmark', host=host, options=options)[-args.limit:]
+        report = trend(selected, args.sample, args.alpha, args.tolerance)
+        print(f"Trend of {args.sample} on host {host} ({len(report)} runs)")
+        for row in report:
+            line = (f"  {row['id']}  {row['revision']}{'+' if row['dirty'] else ' '}  "
+                    f"{row['mean']:.3f}s [{row['ci_low']:.3f}, {row['ci_high']:.3f}] n={row['n']}")
+            if 'vs_previous' in row:
+                change = row['vs_previous']
+                line += f"  {change['change'] * 100:+.1f}% {change['verdict']}"
+            print(f"{line}  {row['subject'][:40]}")
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport saved to: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Export the Generator stages to ONNX for the onnxruntime inference backend.
+
+Writes get_transfer_input (encode, plus encode_reference with a double encoder),
+get_transfer_output (transfer: TPS alignment and both attention levels) and decode as
+separate graphs, with meta.json describing their inputs, into one folder. The graphs are
+traced in fp32 at DATA.IMG_SIZE and a fixed batch size. The TPS matrix inverse is exported
+as ONNX Runtime's com.microsoft Inverse operator, so the graphs need ONNX Runtime to run.
+After exporting, every stage is run on ONNX Runtime and compared with the torch Generator.
+
+Usage:
+    python scripts/export_onnx.py --model-path ckpts/sow_pyramid_a5_e3d2_remapped.pth --output ckpts/onnx
+    then run inference with MODEL.BACKEND = 'onnxruntime' and MODEL.ONNX_DIR set to the output folder
+"""
+import os
+import sys
+import argparse
+import inspect
+import json
+import time
+
+sys.path.append('.')
+
+import torch
+
+from models.model import get_generator
+from models.onnx_stages import EncodeStage, TransferStage, DecodeStage, OnnxGenerator, stage_signatures, \
+    flatten_transfer_input
+from training.config import get_config
+from training.optimization import generator_example_inputs
+
+
+DEFAULT_MODEL_PATH = 'ckpts/sow_pyramid_a5_e3d2_remapped.pth'
+DEFAULT_OPSET = 17  # GridSample needs 16
+
+
+def inverse_symbolic(g, self):
+    return g.op('com.microsoft::Inverse', self).setType(self.type())
+
+
+def register_symbolics(opset):
+    for name in ('aten::linalg_inv', 'aten::inverse'):
+        torch.onnx.register_custom_op_symbolic(name, inverse_symbolic, opset)
+
+
+def load_generator(config, model_path):
+    # exported graphs are always fp32 and NCHW
+    config = config.clone()
+    config.MODEL.PRECISION = 'fp32'
+    config.MODEL.CHANNELS_LAST = False
+    G = get_generator(config)
+    G.load_state_dict(torch.load(model_path, map_location='cpu', weights_only=False))
+    return G.eval()
+
+
+def example_stage_inputs(G, image_size, batch_size):
+    '''
+    return: dict, stage -> tuple of example inputs, from two different synthetic faces
+    '''
+    inputs_c = generator_example_inputs(image_size, batch_size, seed=0)
+    inputs_s = generator_example_inputs(image_size, batch_size, seed=1)
+    with torch.no_grad():
+        transfer_input_c = G.get_transfer_input(*inputs_c)
+        transfer_input_s = G.get_transfer_input(*inputs_s, True)
+        attn_out_list = G.get_transfer_output(*transfer_input_c, *transfer_input_s)
+    examples = {
+        'encode': tuple(inputs_c),
+        'encode_reference': tuple(inputs_s),
+        'transfer': tuple(flatten_transfer_input(transfer_input_c) + flatten_transfer_input(transfer_input_s)),
+        'decode': tuple(transfer_input_c[0] + attn_out_list)
+    }
+    return examples
+
+
+def export_generator(G, folder, image_size, batch_size=1, opset=DEFAULT_OPSET):
+    '''
+    return: the meta dict written to folder/meta.json
+    '''
+    os.makedirs(folder, exist_ok=True)
+    register_symbolics(opset)
+    export_kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # the Inverse symbolic is registered with the TorchScript-based exporter
+        export_kwargs['dynamo'] = False
+
+    stages = {
+        'encode': EncodeStage(G),
+        'encode_reference': EncodeStage(G, is_reference=True),
+        'transfer': TransferStage(G),
+        'decode': DecodeStage(G)
+    }
+    signatures = stage_signatures(G.double_encoder)
+    examples = example_stage_inputs(G, image_size, batch_size)
+    for name, (input_names, output_names) in signatures.items():
+        path = os.path.join(folder, name + '.onnx')
+        print(f"  {name} -> {path}")
+        with torch.no_grad():
+            torch.onnx.export(stages[name], examples[name], path, input_names=input_names,
+                              output_names=output_names, opset_version=opset, do_constant_folding=True,
+                              custom_opsets={'com.microsoft': 1}, **export_kwargs)
+        # a stale optimized graph would shadow the new export
+        optimized = os.path.join(folder, name + '.optimized.onnx')
+        if os.path.exists(optimized):
+            os.remove(optimized)
+
+    meta = {
+        'image_size': image_size,
+        'batch_size': batch_size,
+        'opset': opset,
+        'double_encoder': G.double_encoder,
+        'stages': {name: {'inputs': inputs, 'outputs': outputs} for name, (inputs, outputs) in signatures.items()}
+    }
+    with open(os.path.join(folder, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def check_export(G, folder, image_size, batch_size=1, repeat=5):
+    '''
+    Run every stage and the full transfer on ONNX Runtime and the torch Generator.
+    return: dict, max abs difference per stage, median transfer times in milliseconds, session load time
+    '''
+    start = time.perf_counter()
+    onnx_G = OnnxGenerator(folder, torch.get_num_threads())
+    load_time = time.perf_counter() - start
+    inputs_c = generator_example_inputs(image_size, batch_size, seed=0)
+    inputs_s = generator_example_inputs(image_size, batch_size, seed=1)
+
+    def stages(generator):
+        transfer_input_c = generator.get_transfer_input(*inputs_c)
+        transfer_input_s = generator.get_transfer_input(*inputs_s, True)
+        attn_out_list = generator.get_transfer_output(*transfer_input_c, *transfer_input_s)
+        return {
+            'encode': flatten_transfer_input(transfer_input_c),
+            'encode_reference': flatten_transfer_input(transfer_input_s),
+            'transfer': attn_out_list,
+            'decode': [generator.decode(transfer_input_c[0], attn_out_list)]
+        }
+
+    def median_ms(fn):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - start) * 1000)
+        return sorted(samples)[len(samples) // 2]
+
+    with torch.no_grad():
+        expected, actual = stages(G), stages(onnx_G)
+        report = {name: max((a - e).abs().max().item() for a, e in zip(actual[name], expected[name]))
+                  for name in expected}
+        report = {'max_abs_diff': report, 'ort_load_s': load_time,
+                  'torch_ms': median_ms(lambda: stages(G)), 'onnxruntime_ms': median_ms(lambda: stages(onnx_G))}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export the Generator stages to ONNX for the onnxruntime backend',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python scripts/export_onnx.py --output ckpts/onnx
+    python scripts/export_onnx.py --model-path G.pth --output ckpts/onnx --opset 18 --json results/onnx.json
+        """
+    )
+    parser.add_argument('--model-path', type=str, default=DEFAULT_MODEL_PATH, help='Generator weights')
+    parser.add_argument('--output', type=str, default=None, help='Folder for the graphs (default: MODEL.ONNX_DIR)')
+    parser.add_argument('--batch-size', type=int, default=1, help='Batch size the graphs are traced at (default: 1)')
+    parser.add_argument('--opset', type=int, default=DEFAULT_OPSET,
+                        help=f'ONNX opset version, at least 16 (default: {DEFAULT_OPSET})')
+    parser.add_argument('--no-check', action='store_true', help='Skip comparing ONNX Runtime with torch')
+    parser.add_argument('--json', type=str, default=None, help='Path to save the export report as JSON')
+    args = parser.parse_args()
+
+    if args.opset < 16:
+        parser.error('GridSample needs opset 16 or later')
+    config = get_config()
+    folder = args.output or config.MODEL.ONNX_DIR
+    image_size = config.DATA.IMG_SIZE
+    G = load_generator(config, args.model_path)
+
+    print(f"Exporting {args.model_path} (opset {args.opset}, batch {args.batch_size}, {image_size}px)")
+    start = time.perf_counter()
+    meta = export_generator(G, folder, image_size, args.batch_size, args.opset)
+    report = {'meta': meta, 'export_s': time.perf_counter() - start}
+
+    print("\n" + "=" * 50)
+    print("ONNX EXPORT")
+    print("=" * 50)
+    print(f"Stages: {', '.join(meta['stages'])} in {report['export_s']:.1f}s")
+    if not args.no_check:
+        check = check_export(G, folder, image_size, args.batch_size)
+        report['check'] = check
+        print("Max abs difference: " + ", ".join(f"{k} {v:.2g}" for k, v in check['max_abs_diff'].items()))
+        print(f"Transfer: torch {check['torch_ms']:.1f} ms, onnxruntime {check['onnxruntime_ms']:.1f} ms "
+              f"(sessions loaded in {check['ort_load_s']:.2f}s)")
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults saved to: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+HTTP load generator for the EleGANt API.
+
+Starts the FastAPI app locally (or targets a running server with --url), drives it with a
+weighted mix of /transfer, /transfer-preset and /presets traffic using the
+test_data/benchmark images, and reports throughput, p50/p95/p99 latency, error rates
+and the server RSS over time.
+
+Two traffic models are supported:
+    --rate R          open loop, R requests/s on a fixed schedule; latency is measured
+                      from the scheduled send time so server queueing is not hidden
+    --concurrency C   closed loop, C clients each sending the next request on completion
+
+Usage:
+    python scripts/load_test.py --concurrency 2 --duration 60
+    python scripts/load_test.py --rate 0.5 --duration 120 --mix transfer=3,transfer-preset=1,presets=1
+"""
+import os
+import sys
+import argparse
+import json
+import random
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+ENDPOINTS = ('transfer', 'transfer-preset', 'presets')
+
+
+def read_rss_mb(pid):
+    """Resident set size of a process in MB, None if it cannot be read"""
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / 1024 / 1024
+    except Exception:
+        return None
+
+
+class RSSSampler(threading.Thread):
+    def __init__(self, pid, interval, origin):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.origin = origin
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            rss = read_rss_mb(self.pid)
+            if rss is not None:
+                self.samples.append((time.perf_counter() - self.origin, rss))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Server:
+    """The API app running in a child uvicorn process"""
+    def __init__(self, host, port, startup_timeout):
+        self.url = f'http://{host}:{port}'
+        env = dict(os.environ)
+        env.pop('TRACE_DIR', None)
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'api:app', '--host', host, '--port', str(port),
+             '--log-level', 'warning'],
+            env=env
+        )
+        deadline = time.time() + startup_timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'API server exited with code {self.process.returncode}')
+            try:
+                health = requests.get(self.url + '/health', timeout=2).json()
+                if health.get('model_loaded'):
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(1)
+        self.stop()
+        raise RuntimeError(f'API server not ready after {startup_timeout}s')
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        if name not in ENDPOINTS:
+            raise ValueError(f'unknown endpoint {name}, expected one of {ENDPOINTS}')
+        weights[name] = float(weight)
+    return weights
+
+
+class RequestFactory:
+    def __init__(self, url, manifest_path, preset_path, output_folder, images_per_request, seed=0):
+        self.url = url
+        self.output_folder = output_folder
+        self.images_per_request = images_per_request
+        self.preset_path = os.path.abspath(preset_path)
+        manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        self.images = [os.path.join(manifest_dir, img['path']) for img in manifest['images']]
+        self.reference = os.path.join(manifest_dir, manifest['reference'])
+        self.random = random.Random(seed)
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def sources(self):
+        return [self.random.choice(self.images) for _ in range(self.images_per_request)]
+
+    def build(self, endpoint):
+        """return: (method, url, json payload or None)"""
+        with self.lock:
+            self.counter += 1
+            session_id = f'loadtest_{self.counter:06d}'
+            sources = self.sources()
+        if endpoint == 'transfer':
+            return 'POST', self.url + '/transfer', {
+                'source_images': sources,
+                'reference_image': self.reference,
+                'session_id': session_id,
+                'output_folder': self.output_folder
+            }
+        elif endpoint == 'transfer-preset':
+            return 'POST', self.url + '/transfer-preset', {
+                'source_images': sources,
+                'preset_path': self.preset_path,
+                'session_id': session_id,
+                'output_folder': self.output_folder
+            }
+        return 'GET', self.url + '/presets', None
+
+
+_thread_local = threading.local()
+
+def send(method, url, payload, timeout):
+    """return: (ok, status code or error name)"""
+    if not hasattr(_thread_local, 'session'):
+        _thread_local.session = requests.Session()
+    try:
+        response = _thread_local.session.request(method, url, json=payload, timeout=timeout)
+    except requests.RequestException as e:
+        return False, type(e).__name__
+    if response.status_code != 200:
+        return False, response.status_code
+    if payload is not None and not response.json().get('success', False):
+        return False, 'no_success'
+    return True, 200
+
+
+def run_closed_loop(factory, weights, concurrency, duration, timeout, origin):
+    records = []
+    lock = threading.Lock()
+    deadline = origin + duration
+    names, probs = list(weights), np.array(list(weights.values())) / sum(weights.values())
+
+    def client(seed):
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            endpoint = rng.choices(names, probs)[0]
+            method, url, payload = factory.build(endpoint)
+            start = time.perf_counter()
+            ok, status = send(method, url, payload, timeout)
+            end = time.perf_counter()
+            with lock:
+                records.append((endpoint, start - origin, end - start, ok, status))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return records
+
+
+def run_open_loop(factory, weights, rate, duration, timeout, origin, max_in_flight=256):
+    records = []
+    lock = threading.Lock()
+    rng = random.Random(0)
+    names, probs = list(weights), np.array(list(weights.values())) / sum(weights.values())
+
+    def fire(endpoint, scheduled):
+        method, url, payload = factory.build(endpoint)
+        ok, status = send(method, url, payload, timeout)
+        end = time.perf_counter()
+        with lock:
+            records.append((endpoint, scheduled - origin, end - scheduled, ok, status))
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        n = 0
+        while True:
+            scheduled = origin + n / rate
+            if scheduled >= origin + duration:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(fire, rng.choices(names, probs)[0], scheduled)
+            n += 1
+    return records
+
+
+def latency_stats(latencies):
+    if not latencies:
+        return {}
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'mean_ms': float(latencies.mean()),
+        'max_ms': float(latencies.max())
+    }
+
+
+def summarize_records(records, duration):
+    report = {}
+    groups = {'all': records}
+    for endpoint in ENDPOINTS:
+        groups[endpoint] = [r for r in records if r[0] == endpoint]
+    for name, group in groups.items():
+        if not group:
+            continue
+        errors = [r for r in group if not r[3]]
+        error_kinds = {}
+        for r in errors:
+            error_kinds[str(r[4])] = error_kinds.get(str(r[4]), 0) + 1
+        report[name] = {
+            'requests': len(group),
+            'throughput_rps': (len(group) - len(errors)) / duration,
+            'error_rate': len(errors) / len(group),
+            'errors': error_kinds,
+            **latency_stats([r[2] for r in group if r[3]])
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the EleGANt API with a mix of endpoints',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python scripts/load_test.py --concurrency 4 --duration 120 --json results/load/c4.json
+    python scripts/load_test.py --rate 1.0 --duration 300 --mix transfer=1
+    python scripts/load_test.py --url http://localhost:8000 --concurrency 2
+        """
+    )
+    parser.add_argument('--url', type=str, default=None,
+                        help='Target an already running server instead of starting one')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--startup-timeout', type=float, default=300,
+                        help='Seconds to wait for the model to load (default: 300)')
+    parser.add_argument('--mix', type=str, default='transfer=6,transfer-preset=3,presets=1',
+                        help='Weighted endpoint mix (default: transfer=6,transfer-preset=3,presets=1)')
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument('--rate', type=float, default=None, help='Open loop arrival rate (requests/s)')
+    load.add_argument('--concurrency', type=int, default=None, help='Closed loop client count')
+    parser.add_argument('--duration', type=float, default=60, help='Measured seconds (default: 60)')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='Sequential /transfer requests before measuring (default: 1)')
+    parser.add_argument('--images-per-request', type=int, default=1,
+                        help='Source images per transfer request (default: 1)')
+    parser.add_argument('--manifest', type=str, default='test_data/benchmark/manifest.json')
+    parser.add_argument('--preset', type=str, default='presets/Test Preset',
+                        help='Preset folder used by /transfer-preset')
+    parser.add_argument('--output-folder', type=str, default='result/load_test',
+                        help='Output folder passed to the API; removed afterwards unless --keep-outputs')
+    parser.add_argument('--keep-outputs', action='store_true')
+    parser.add_argument('--timeout', type=float, default=600, help='Per-request timeout in seconds')
+    parser.add_argument('--rss-interval', type=float, default=0.5,
+                        help='Server RSS sampling interval in seconds (default: 0.5)')
+    parser.add_argument('--json', type=str, default=None, help='Path to save the report as JSON')
+    args = parser.parse_args()
+    if args.rate is None and args.concurrency is None:
+        args.concurrency = 1
+
+    weights = parse_mix(args.mix)
+    server = None
+    if args.url is None:
+        print(f"Starting API server on {args.host}:{args.port}...")
+        server = Server(args.host, args.port, args.startup_timeout)
+        url = server.url
+    else:
+        url = args.url.rstrip('/')
+
+    factory = RequestFactory(url, args.manifest, args.preset, args.output_folder,
+                             args.images_per_request)
+    sampler = None
+    try:
+        for _ in range(args.warmup):
+            send(*factory.build('transfer'), args.timeout)
+
+        origin = time.perf_counter()
+        if server is not None:
+            sampler = RSSSampler(server.pid, args.rss_interval, origin)
+            sampler.start()
+        mode = f'open loop, {args.rate} req/s' if args.rate else f'closed loop, {args.concurrency} clients'
+        print(f"Running {args.duration:.0f}s of load ({mode}), mix: {weights}")
+        if args.rate:
+            records = run_open_loop(factory, weights, args.rate, args.duration, args.timeout, origin)
+        else:
+            records = run_closed_loop(factory, weights, args.concurrency, args.duration,
+                                      args.timeout, origin)
+        elapsed = time.perf_counter() - origin
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if server is not None:
+            server.stop()
+        if not args.keep_outputs and os.path.isdir(args.output_folder):
+            shutil.rmtree(args.output_folder, ignore_errors=True)
+
+    report = {
+        'mode': 'open' if args.rate else 'closed',
+        'rate': args.rate,
+        'concurrency': args.concurrency,
+        'duration_seconds': elapsed,
+        'mix': weights,
+        'images_per_request': args.images_per_request,
+        'endpoints': summarize_records(records, elapsed),
+        'rss_mb': [] if sampler is None else [[round(t, 2), round(m, 1)] for t, m in sampler.samples]
+    }
+
+    print("=" * 50)
+    print("LOAD TEST RESULTS")
+    print("=" * 50)
+    for name, stats in report['endpoints'].items():
+        print(f"{name}: {stats['requests']} requests, {stats['throughput_rps']:.3f} req/s, "
+              f"errors {stats['error_rate'] * 100:.1f}%")
+        if 'p50_ms' in stats:
+            print(f"  latency p50={stats['p50_ms']:.0f}ms p95={stats['p95_ms']:.0f}ms "
+                  f"p99={stats['p99_ms']:.0f}ms max={stats['max_ms']:.0f}ms")
+        if stats['errors']:
+            print(f"  errors: {stats['errors']}")
+    if report['rss_mb']:
+        rss = report['rss_mb']
+        print(f"Server RSS: start {rss[0][1]:.0f} MB, peak {max(m for _, m in rss):.0f} MB, "
+              f"end {rss[-1][1]:.0f} MB")
+        step = max(1, len(rss) // 10)
+        print("  " + ", ".join(f"{t:.0f}s:{m:.0f}MB" for t, m in rss[::step]))
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport saved to: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
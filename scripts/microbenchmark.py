@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""
+Per-module microbenchmarks for the EleGANt hot paths, with regression detection.
+
+Every case is run at realistic shapes (256px faces, 128/64px feature maps, 68 landmarks)
+with warm-up and repetitions; results carry the mean and its confidence interval.
+Each case is compared with the baseline file using Welch's t-test and the script exits with
+status 1 on a statistically significant slowdown. A missing baseline also fails, unless
+--allow-missing-baseline is given: a gate without a baseline would always pass.
+
+Usage:
+    python scripts/microbenchmark.py --save-baseline
+    python scripts/microbenchmark.py --json results/microbench.json
+    python scripts/microbenchmark.py --cases sow_attention,tps_spatial_transform --batch-sizes 1,4 \
+        --allow-missing-baseline
+
+With --channels-last the module cases run NHWC models on NHWC inputs; comparing such a run
+with an NCHW baseline shows the per-module effect of MODEL.CHANNELS_LAST.
+"""
+import os
+import sys
+import argparse
+import json
+import platform
+import time
+
+sys.path.append('.')
+
+import numpy as np
+import cv2
+import torch
+from PIL import Image
+
+from concern.stats import summarize, compare_samples
+
+
+DEFAULT_BASELINE = 'baseline/microbenchmarks.json'
+DEFAULT_MODEL_PATH = 'ckpts/sow_pyramid_a5_e3d2_remapped.pth'
+
+
+class SkipCase(Exception):
+    """Raised by a case setup when its weights or inputs are not available"""
+
+
+CASES = {}
+
+def case(name, batched=True):
+    """Register a benchmark; the setup returns the zero-argument callable to time"""
+    def register(setup):
+        CASES[name] = (setup, batched)
+        return setup
+    return register
+
+
+############################## Synthetic Inputs ##############################
+def synthetic_masks(batch_size, size, device):
+    '''
+    return: (b, 2, size, size), lip and face masks as prepared by Inference.prepare_input
+    '''
+    canvas = np.zeros((2, size, size), dtype=np.float32)
+    center = size // 2
+    cv2.ellipse(canvas[0], (center, int(size * 0.72)), (size // 8, size // 20), 0, 0, 360, 1, -1)
+    cv2.ellipse(canvas[1], (center, int(size * 0.55)), (int(size * 0.32), int(size * 0.42)), 0, 0, 360, 1, -1)
+    canvas[1] *= (1 - canvas[0])
+    mask = torch.from_numpy(canvas).unsqueeze(0).repeat(batch_size, 1, 1, 1)
+    return mask.to(device)
+
+
+def synthetic_landmarks(batch_size, size, device, seed=0, jitter=0.0):
+    '''
+    return: (b, 68, 2), distinct (y, x) points inside the face area
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    lms = torch.rand(batch_size, 68, 2, generator=generator) * size * 0.6 + size * 0.2
+    if jitter > 0:
+        lms = lms + torch.randn(batch_size, 68, 2, generator=generator) * jitter
+    return lms.round().clamp(0, size - 1).to(device)
+
+
+def synthetic_features(batch_size, channels, size, device, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(batch_size, channels, size, size, generator=generator).to(device)
+
+
+def load_benchmark_image(context, name='single_face.jpg'):
+    path = os.path.join(context.data_dir, name)
+    if not os.path.exists(path):
+        raise SkipCase('missing image {}'.format(path))
+    return Image.open(path).convert('RGB')
+
+
+def get_inference(context):
+    if context.inference is None:
+        if not os.path.exists(context.model_path):
+            raise SkipCase('missing model checkpoint {}'.format(context.model_path))
+        from training.config import get_config
+        from training.inference import Inference
+        args = argparse.Namespace(device=torch.device(context.device))
+        context.inference = Inference(get_config(), args, context.model_path)
+    return context.inference
+
+
+def get_generator_inputs(context, batch_size):
+    '''
+    return: randomly initialized Generator (in the context's layout), encodings of two batches of
+            synthetic faces as content and style
+    '''
+    from models.model import get_generator
+    from training.config import get_config
+    from training.preprocess import PreProcess
+    config = get_config().clone()
+    config.MODEL.CHANNELS_LAST = context.channels_last
+    G = get_generator(config).to(context.device).eval()
+    size = config.DATA.IMG_SIZE
+    preprocess = PreProcess(config, need_parser=False)
+    mask = synthetic_masks(batch_size, size, context.device)
+    inputs = []
+    for seed in (1, 2):
+        image = torch.tanh(synthetic_features(batch_size, 3, size, context.device, seed))
+        lms = synthetic_landmarks(batch_size, size, context.device, seed=1, jitter=2.0 * (seed - 1))
+        inputs.append((image, mask, preprocess.diff_process(lms), lms))
+    with torch.no_grad():
+        input_c = G.get_transfer_input(*inputs[0])
+        input_s = G.get_transfer_input(*inputs[1], True)
+    return G, inputs[0], input_c, input_s
+
+
+def get_faceutils():
+    try:
+        import faceutils as futils
+    except Exception as e: # missing dlib or its landmark model
+        raise SkipCase('faceutils unavailable: {}'.format(e))
+    return futils
+
+
+############################## Cases ##############################
+@case('sow_attention')
+def setup_sow_attention(context, batch_size):
+    from models.modules.sow_attention import SowAttention
+    dim, size = 128, 128  # first transfer level of the default Generator
+    module = SowAttention(window_size=16, in_channels=dim + 136, proj_channels=dim + 136,
+                          value_channels=dim, out_channels=dim).to(context.device).eval()
+    fea_q = synthetic_features(batch_size, dim + 136, size, context.device, 1)
+    fea_k = synthetic_features(batch_size, dim + 136, size, context.device, 2)
+    fea_v = synthetic_features(batch_size, dim, size, context.device, 3)
+    mask = synthetic_masks(batch_size, size, context.device)
+    module, tensors = context.convert(module, fea_q, fea_k, fea_v, mask)
+    return lambda: module(tensors[0], tensors[1], tensors[2], tensors[3], tensors[3])
+
+
+@case('multihead_attention')
+def setup_multihead_attention(context, batch_size):
+    from models.modules.module_attn import MultiheadAttention
+    dim, size = 256, 64  # second transfer level of the default Generator
+    module = MultiheadAttention(in_channels=dim + 136, proj_channels=dim + 136,
+                                value_channels=dim, out_channels=dim).to(context.device).eval()
+    fea_q = synthetic_features(batch_size, dim + 136, size, context.device, 1)
+    fea_k = synthetic_features(batch_size, dim + 136, size, context.device, 2)
+    fea_v = synthetic_features(batch_size, dim, size, context.device, 3)
+    mask = synthetic_masks(batch_size, size, context.device)
+    module, tensors = context.convert(module, fea_q, fea_k, fea_v, mask)
+    return lambda: module(tensors[0], tensors[1], tensors[2], tensors[3], tensors[3])
+
+
+@case('generator_encode')
+def setup_generator_encode(context, batch_size):
+    G, inputs, _, _ = get_generator_inputs(context, batch_size)
+    return lambda: G.get_transfer_input(*inputs)
+
+
+@case('generator_transfer')
+def setup_generator_transfer(context, batch_size):
+    # TPS alignment and both attention levels
+    G, _, input_c, input_s = get_generator_inputs(context, batch_size)
+    return lambda: G.get_transfer_output(*input_c, *input_s)
+
+
+@case('generator_decode')
+def setup_generator_decode(context, batch_size):
+    G, _, input_c, input_s = get_generator_inputs(context, batch_size)
+    with torch.no_grad():
+        attn_out_list = G.get_transfer_output(*input_c, *input_s)
+    return lambda: G.decode(input_c[0], attn_out_list)
+
+
+@case('tps_spatial_transform')
+def setup_tps_spatial_transform(context, batch_size):
+    from models.modules.tps_transform import tps_spatial_transform
+    size = 128
+    lms_c = synthetic_landmarks(1, size, context.device, seed=1)[0]
+    lms_s = synthetic_landmarks(batch_size, size, context.device, seed=1, jitter=2.0)
+    target = torch.flip(lms_c, dims=[1]) / (size - 1)
+    source_points = torch.flip(lms_s, dims=[2]) / (size - 1)
+    fea = synthetic_features(batch_size, 128, size, context.device)
+    return lambda: tps_spatial_transform(size, size, target, fea, source_points)
+
+
+@case('positional_embedding')
+def setup_positional_embedding(context, batch_size):
+    from models.modules.module_base import PositionalEmbedding
+    module = PositionalEmbedding(embedding_dim=136, feature_size=128, max_size=256).to(context.device)
+    diff = synthetic_features(batch_size, 136, 256, context.device)
+    mask = synthetic_masks(batch_size, 256, context.device)
+    return lambda: module(diff, mask)
+
+
+@case('face_parser', batched=False)
+def setup_face_parser(context, batch_size):
+    futils = get_faceutils()
+    try:
+        parser = futils.mask.FaceParser(device=context.device, channels_last=context.channels_last)
+    except Exception as e:
+        raise SkipCase('face parser weights unavailable: {}'.format(e))
+    image = cv2.resize(np.array(load_benchmark_image(context)), (parser.input_size, parser.input_size))
+    return lambda: parser.parse(image)
+
+
+@case('face_parser_batch')
+def setup_face_parser_batch(context, batch_size):
+    futils = get_faceutils()
+    try:
+        parser = futils.mask.FaceParser(device=context.device, channels_last=context.channels_last)
+    except Exception as e:
+        raise SkipCase('face parser weights unavailable: {}'.format(e))
+    image = cv2.resize(np.array(load_benchmark_image(context)), (parser.input_size, parser.input_size))
+    images = [image] * batch_size
+    return lambda: parser.parse_batch(images)
+
+
+@case('dlib_detect', batched=False)
+def setup_dlib_detect(context, batch_size):
+    futils = get_faceutils()
+    image = load_benchmark_image(context, 'two_faces.jpg')
+    return lambda: futils.dlib.detect(image)
+
+
+def setup_configured_detector(context, name):
+    futils = get_faceutils()
+    from training.config import get_config
+    config = get_config().clone()
+    config.PREPROCESS.DETECTOR = name
+    try:
+        detector = futils.detector.get_detector(config)
+    except FileNotFoundError as e:
+        raise SkipCase(str(e))
+    image = load_benchmark_image(context, 'two_faces.jpg')
+    return lambda: detector.detect(image)
+
+
+@case('opencv_dnn_detect', batched=False)
+def setup_opencv_dnn_detect(context, batch_size):
+    return setup_configured_detector(context, 'opencv_dnn')
+
+
+@case('cascade_detect', batched=False)
+def setup_cascade_detect(context, batch_size):
+    return setup_configured_detector(context, 'cascade')
+
+
+@case('tiled_detect', batched=False)
+def setup_tiled_detect(context, batch_size):
+    return setup_configured_detector(context, 'tiled')
+
+
+@case('dlib_landmarks', batched=False)
+def setup_dlib_landmarks(context, batch_size):
+    futils = get_faceutils()
+    image = load_benchmark_image(context)
+    faces = futils.dlib.detect(image)
+    if not faces:
+        raise SkipCase('no face detected in benchmark image')
+    return lambda: futils.dlib.landmarks(image, faces[0])
+
+
+@case('histogram_matching')
+def setup_histogram_matching(context, batch_size):
+    from models.loss import masked_his_match
+    image_s = synthetic_features(batch_size, 3, 256, context.device, 1).tanh()
+    image_r = synthetic_features(batch_size, 3, 256, context.device, 2).tanh()
+    mask = synthetic_masks(batch_size, 256, context.device)[:, 1:2]
+    return lambda: masked_his_match(image_s, image_r, mask, mask)
+
+
+@case('generate_pgt')
+def setup_generate_pgt(context, batch_size):
+    from models.loss import ComposePGT
+    size = 256
+    masks = synthetic_masks(batch_size, size, context.device)
+    eyes = np.zeros((2, size, size), dtype=np.float32)
+    cv2.ellipse(eyes[0], (int(size * 0.38), int(size * 0.42)), (size // 16, size // 32), 0, 0, 360, 1, -1)
+    cv2.ellipse(eyes[1], (int(size * 0.62), int(size * 0.42)), (size // 16, size // 32), 0, 0, 360, 1, -1)
+    eyes = torch.from_numpy(eyes).unsqueeze(0).repeat(batch_size, 1, 1, 1).to(context.device)
+    mask = torch.cat([masks[:, 0:1], masks[:, 1:2] * (1 - eyes.sum(dim=1, keepdim=True)), eyes], dim=1)
+    image_s = synthetic_features(batch_size, 3, size, context.device, 1).tanh()
+    image_r = synthetic_features(batch_size, 3, size, context.device, 2).tanh()
+    lms_s = synthetic_landmarks(batch_size, size, context.device, seed=1)
+    lms_r = synthetic_landmarks(batch_size, size, context.device, seed=1, jitter=3.0)
+    pgt_maker = ComposePGT({'eye': 12, 'lip': 4}, 0.3, 0.8, 0.1)
+    return lambda: pgt_maker(image_s, image_r, mask, mask, lms_s, lms_r)
+
+
+@case('expand_area')
+def setup_expand_area(context, batch_size):
+    from models.modules.pseudo_gt import expand_area
+    mask = synthetic_masks(batch_size, 256, context.device)[:, 0:1]
+    return lambda: expand_area(mask, 12)
+
+
+@case('mask_blur')
+def setup_mask_blur(context, batch_size):
+    from models.modules.pseudo_gt import mask_blur
+    mask = synthetic_masks(batch_size, 256, context.device)[:, 1:2]
+    return lambda: mask_blur(mask, blur_size=5, mode='valid')
+
+
+@case('postprocess', batched=False)
+def setup_postprocess(context, batch_size):
+    inference = get_inference(context)
+    source = load_benchmark_image(context)
+    result = source.resize((inference.img_size, inference.img_size))
+    return lambda: inference.postprocess(source, None, result)
+
+
+@case('paste_face_to_full_image', batched=False)
+def setup_paste_face(context, batch_size):
+    inference = get_inference(context)
+    futils = get_faceutils()
+    image = load_benchmark_image(context, 'two_faces.jpg')
+    faces = futils.dlib.detect(image)
+    if not faces:
+        raise SkipCase('no face detected in benchmark image')
+    _, _, crop_face = futils.dlib.crop(image, faces[0], inference.preprocess.up_ratio,
+                                       inference.preprocess.down_ratio, inference.preprocess.width_ratio)
+    face_result = image.crop((crop_face.left(), crop_face.top(), crop_face.right(), crop_face.bottom()))
+    return lambda: inference.paste_face_to_full_image(image, face_result, crop_face)
+
+
+############################## Runner ##############################
+class BenchContext:
+    def __init__(self, device, model_path, data_dir, channels_last=False):
+        self.device = device
+        self.model_path = model_path
+        self.data_dir = data_dir
+        self.channels_last = channels_last
+        self.inference = None
+
+    def convert(self, module, *tensors):
+        """Hook for layout/precision variants of the module cases"""
+        if not self.channels_last:
+            return module, tensors
+        module = module.to(memory_format=torch.channels_last)
+        tensors = tuple(t.contiguous(memory_format=torch.channels_last) if t.dim() == 4 else t
+                        for t in tensors)
+        return module, tensors
+
+
+def synchronize(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def time_callable(fn, device, warmup, repeat):
+    """
+    return: list of per-call timings in milliseconds
+    """
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        synchronize(device)
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            synchronize(device)
+            samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def run_microbenchmarks(case_names, batch_sizes, context, warmup=3, repeat=20, confidence=0.95):
+    results = {}
+    skipped = {}
+    for name in case_names:
+        setup, batched = CASES[name]
+        for batch_size in (batch_sizes if batched else [1]):
+            case_id = '{}[b={:d}]'.format(name, batch_size) if batched else name
+            try:
+                fn = setup(context, batch_size)
+            except SkipCase as e:
+                skipped[case_id] = str(e)
+                print(f"  {case_id}: skipped ({e})")
+                continue
+            samples = time_callable(fn, context.device, warmup, repeat)
+            stats = summarize(samples, confidence)
+            stats['samples_ms'] = samples
+            results[case_id] = stats
+            print(f"  {case_id}: {stats['mean']:.3f} ms "
+                  f"[{stats['ci_low']:.3f}, {stats['ci_high']:.3f}] (median {stats['median']:.3f})")
+    return results, skipped
+
+
+def environment_info(device):
+    return {
+        'torch': torch.__version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'device': str(device),
+        'num_threads': torch.get_num_threads(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+
+def compare_with_baseline(results, baseline, alpha, tolerance):
+    comparison = {}
+    for case_id, stats in results.items():
+        if case_id not in baseline.get('results', {}):
+            continue
+        comparison[case_id] = compare_samples(
+            baseline['results'][case_id]['samples_ms'], stats['samples_ms'], alpha, tolerance)
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Per-module microbenchmarks with baseline regression detection',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python scripts/microbenchmark.py --save-baseline
+    python scripts/microbenchmark.py --cases sow_attention,multihead_attention --repeat 50
+    python scripts/microbenchmark.py --json results/microbench.json --tolerance 0.10
+    python scripts/microbenchmark.py --cases generator_encode,generator_transfer,generator_decode --channels-last
+        """
+    )
+    parser.add_argument('--cases', type=str, default=None,
+                        help='Comma separated case names (default: all). Available: ' + ', '.join(CASES))
+    parser.add_argument('--batch-sizes', type=str, default='1,4',
+                        help='Comma separated batch sizes for the tensor cases (default: 1,4)')
+    parser.add_argument('--warmup', type=int, default=3, help='Warm-up calls per case (default: 3)')
+    parser.add_argument('--repeat', type=int, default=20, help='Timed calls per case (default: 20)')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='Confidence level of the reported intervals (default: 0.95)')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to use (cpu or cuda:N)')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads value')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='Run the module, generator and face parser cases channels_last (NHWC)')
+    parser.add_argument('--model-path', type=str, default=DEFAULT_MODEL_PATH,
+                        help='Model weights, needed by the postprocess/paste cases')
+    parser.add_argument('--data-dir', type=str, default='test_data/benchmark',
+                        help='Folder with the benchmark images')
+    parser.add_argument('--json', type=str, default=None, help='Path to save results as JSON')
+    parser.add_argument('--baseline', type=str, default=DEFAULT_BASELINE,
+                        help=f'Baseline results to compare against (default: {DEFAULT_BASELINE})')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Write the results as the new baseline instead of comparing')
+    parser.add_argument('--allow-missing-baseline', action='store_true',
+                        help='Only measure when there is no baseline, instead of failing')
+    parser.add_argument('--alpha', type=float, default=0.01,
+                        help='Significance level of the regression test (default: 0.01)')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='Relative slowdown tolerated even when significant (default: 0.05)')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    case_names = args.cases.split(',') if args.cases else list(CASES)
+    unknown = [name for name in case_names if name not in CASES]
+    if unknown:
+        parser.error('unknown cases: ' + ', '.join(unknown))
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+
+    context = BenchContext(torch.device(args.device), args.model_path, args.data_dir, args.channels_last)
+    print(f"Microbenchmarks on {args.device} ({torch.get_num_threads()} threads), "
+          f"warmup={args.warmup}, repeat={args.repeat}" + (", channels_last" if args.channels_last else ""))
+    results, skipped = run_microbenchmarks(case_names, batch_sizes, context,
+                                           args.warmup, args.repeat, args.confidence)
+    report = {
+        'environment': environment_info(args.device),
+        'config': {'warmup': args.warmup, 'repeat': args.repeat, 'batch_sizes': batch_sizes,
+                   'channels_last': args.channels_last},
+        'results': results,
+        'skipped': skipped
+    }
+
+    regressions, missing_baseline = [], False
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or '.', exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to: {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        report['comparison'] = compare_with_baseline(results, baseline, args.alpha, args.tolerance)
+        print()
+        print("=" * 50)
+        print(f"COMPARISON WITH BASELINE ({args.baseline})")
+        print("=" * 50)
+        for case_id, c in report['comparison'].items():
+            print(f"  {case_id}: {c['baseline_mean']:.3f} -> {c['current_mean']:.3f} ms "
+                  f"({c['change'] * 100:+.1f}%, p={c['p_value']:.4f}) [{c['verdict'].upper()}]")
+            if c['verdict'] == 'regression':
+                regressions.append(case_id)
+    elif args.allow_missing_baseline:
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to create one.")
+    else:
+        missing_baseline = True
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults saved to: {args.json}")
+
+    if missing_baseline:
+        print(f"\nERROR: no baseline at {args.baseline}, nothing was checked for regressions. "
+              f"Create it with --save-baseline on the reference build, or pass --allow-missing-baseline.")
+        sys.exit(1)
+    if regressions:
+        print(f"\nREGRESSIONS: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
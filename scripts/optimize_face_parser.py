@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Optimized face parser variants, validated against the current parser.
+
+The reference is the bundled BiSeNet at 512x512 with unfused BatchNorm. Candidates are the
+parser with BatchNorm folded into the convolutions at each input size of --sizes and, with
+--quantize, a post-training INT8 parser (static, calibrated on face crops) at the same sizes.
+Every candidate parses the same face crops, batched like PreProcess does, and is compared
+with the reference by IoU per mapped class at 512x512, together with its parsing time per face.
+
+The INT8 checkpoint is used by setting PREPROCESS.PARSER_WEIGHTS to --output (CPU only).
+
+Usage:
+    python scripts/optimize_face_parser.py --images data/MT-Dataset/images/makeup --quantize
+    then gate it with: python scripts/perf_gate.py --candidate parser_int8
+"""
+import os
+import sys
+import argparse
+import json
+import time
+
+sys.path.append('.')
+
+import numpy as np
+import cv2
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+import faceutils as futils
+from models.quantization import convert_static, default_engine, prepare_static, quantizable_modules, \
+    quantized_checkpoint
+from training.checkpoint import atomic_save
+from training.config import get_config
+
+
+DEFAULT_OUTPUT = 'ckpts/face_parser_int8.pth'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+REFERENCE_SIZE = 512
+# mapped labels, see PreProcess.mask_process
+CLASSES = ('background', 'face', 'left-eyebrow', 'right-eyebrow', 'left-eye', 'right-eye', 'nose',
+           'upper-lip', 'teeth', 'under-lip', 'hair', 'left-ear', 'right-ear', 'neck')
+
+
+def load_face_crops(folder, config, max_faces):
+    '''
+    return: list of face crops, (h, w, 3) RGB arrays, cropped like PreProcess.preprocess
+    '''
+    crops = []
+    for name in sorted(os.listdir(folder)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        image = Image.open(os.path.join(folder, name)).convert('RGB')
+        for face in futils.dlib.detect(image):
+            crop, _, _ = futils.dlib.crop(image, face, config.PREPROCESS.UP_RATIO,
+                                          config.PREPROCESS.DOWN_RATIO, config.PREPROCESS.WIDTH_RATIO)
+            crops.append(np.array(crop))
+            if len(crops) >= max_faces:
+                return crops
+    return crops
+
+
+def parse_crops(parser, crops, batch_size):
+    '''
+    return: (N, 512, 512) labels, time per face in milliseconds
+    '''
+    size = parser.input_size
+    masks = []
+    # warm up, the first forward pass allocates
+    parser.parse_batch([cv2.resize(crops[0], (size, size))])
+    start = time.perf_counter()
+    for i in range(0, len(crops), batch_size):
+        batch = [cv2.resize(crop, (size, size)) for crop in crops[i:i + batch_size]]
+        masks.append(parser.parse_batch(batch).cpu())
+    elapsed = time.perf_counter() - start
+    masks = torch.cat(masks)
+    if size != REFERENCE_SIZE:
+        masks = F.interpolate(masks.unsqueeze(1), (REFERENCE_SIZE, REFERENCE_SIZE), mode='nearest').squeeze(1)
+    return masks.long(), elapsed * 1000 / len(crops)
+
+
+def class_iou(reference, candidate):
+    '''
+    IoU of each mapped class over all faces; classes absent from both are left out
+    return: dict, class name -> IoU
+    '''
+    iou = {}
+    for label, name in enumerate(CLASSES):
+        ref, cand = reference == label, candidate == label
+        union = (ref | cand).sum().item()
+        if union:
+            iou[name] = (ref & cand).sum().item() / union
+    return iou
+
+
+def quantize_parser(crops, engine, batch_size, output):
+    '''
+    Calibrate an INT8 copy of the parser with folded BatchNorm on `crops` and save it to `output`.
+    '''
+    parser = futils.mask.FaceParser(device='cpu', fuse_bn=True)
+    names = quantizable_modules(parser.net)
+    prepare_static(parser.net, names, engine)
+    parse_crops(parser, crops, batch_size)
+    convert_static(parser.net)
+    atomic_save(quantized_checkpoint(parser.net, 'static', engine, names, fuse_bn=True), output)
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Optimized face parser variants, validated against the current parser',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python scripts/optimize_face_parser.py --images data/MT-Dataset/images/non-makeup
+    python scripts/optimize_face_parser.py --images photos/ --sizes 512,384 --quantize --json results/parser.json
+        """
+    )
+    parser.add_argument('--images', type=str, default=None,
+                        help='Folder of face images (default: DATA.PATH/images/non-makeup)')
+    parser.add_argument('--max-faces', type=int, default=200, help='Face crops evaluated (default: 200)')
+    parser.add_argument('--sizes', type=str, default='512,384,256', help='Candidate input sizes (default: 512,384,256)')
+    parser.add_argument('--batch-size', type=int, default=8, help='Faces per forward pass (default: 8)')
+    parser.add_argument('--device', type=str, default='cpu', help='Device of the fp32 parsers')
+    parser.add_argument('--quantize', action='store_true', help='Also calibrate and evaluate an INT8 parser')
+    parser.add_argument('--calibration-faces', type=int, default=32,
+                        help='Face crops calibrating the INT8 parser, taken before the evaluated ones (default: 32)')
+    parser.add_argument('--engine', type=str, default=None,
+                        help='Quantized engine: x86, fbgemm or qnnpack (default: best available)')
+    parser.add_argument('--output', type=str, default=DEFAULT_OUTPUT,
+                        help=f'INT8 checkpoint to write (default: {DEFAULT_OUTPUT})')
+    parser.add_argument('--min-iou', type=float, default=0.9,
+                        help='Lowest mean IoU a candidate may have against the reference (default: 0.9)')
+    parser.add_argument('--json', type=str, default=None, help='Path to save the report as JSON')
+    args = parser.parse_args()
+
+    config = get_config()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    folder = args.images or os.path.join(config.DATA.PATH, 'images', 'non-makeup')
+    calibration_faces = args.calibration_faces if args.quantize else 0
+    crops = load_face_crops(folder, config, calibration_faces + args.max_faces)
+    calibration, crops = crops[:calibration_faces], crops[calibration_faces:]
+    if not crops or (args.quantize and not calibration):
+        print(f"ERROR: not enough faces found in {folder} to calibrate and evaluate on")
+        sys.exit(1)
+    print(f"Parsing {len(crops)} faces from {folder}")
+
+    reference = futils.mask.FaceParser(device=args.device, fuse_bn=False)
+    reference_masks, reference_ms = parse_crops(reference, crops, args.batch_size)
+    candidates = [(f'fused_{size}', lambda size=size: futils.mask.FaceParser(
+        device=args.device, input_size=size, fuse_bn=True)) for size in sizes]
+    report = {'faces': len(crops), 'reference_ms': reference_ms, 'candidates': {}}
+    if args.quantize:
+        engine = args.engine or default_engine()
+        names = quantize_parser(calibration, engine, args.batch_size, args.output)
+        report['int8'] = {'engine': engine, 'layers': len(names), 'calibration_faces': len(calibration),
+                          'checkpoint': args.output}
+        candidates += [(f'int8_{size}', lambda size=size: futils.mask.FaceParser(
+            device='cpu', input_size=size, weights=args.output)) for size in sizes]
+
+    for name, build in candidates:
+        masks, ms = parse_crops(build(), crops, args.batch_size)
+        iou = class_iou(reference_masks, masks)
+        mean_iou = float(np.mean([value for label, value in iou.items() if label != 'background']))
+        report['candidates'][name] = {'ms_per_face': ms, 'speedup': reference_ms / ms, 'mean_iou': mean_iou,
+                                      'iou': iou, 'passed': mean_iou >= args.min_iou}
+
+    print("\n" + "=" * 50)
+    print("FACE PARSER")
+    print("=" * 50)
+    print(f"reference (512, unfused): {reference_ms:.1f} ms/face")
+    for name, result in report['candidates'].items():
+        worst = min((value, label) for label, value in result['iou'].items() if label != 'background')
+        status = 'PASS' if result['passed'] else 'FAIL'
+        print(f"{name}: {result['ms_per_face']:.1f} ms/face ({result['speedup']:.2f}x), "
+              f"mIoU {result['mean_iou']:.4f}, lowest {worst[1]} {worst[0]:.4f} [{status}]")
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults saved to: {args.json}")
+    if not all(result['passed'] for result in report['candidates'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
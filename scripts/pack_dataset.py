@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Pack MT-Dataset into memory-mapped arrays for training.
+
+Decodes and resizes every image and segmentation once and writes them, with the
+landmarks, into contiguous .npy files read by training.dataset.PackedMakeupDataset:
+images.npy (N, H, W, 3) uint8, segs.npy (N, H, W) uint8, lms.npy (N, 68, 2) int16
+and index.json. Images without landmarks are skipped and listed in the index.
+
+Usage:
+    python scripts/pack_dataset.py --output data/MT-Packed
+    then train with DATA.PACKED_PATH set to the output folder
+"""
+import os
+import sys
+import argparse
+import json
+import time
+
+sys.path.append('.')
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+from torchvision.transforms import functional
+from tqdm import tqdm
+
+from training.config import get_config
+from training.dataset import MakeupDataset, PackedMakeupDataset
+
+
+def pack_dataset(config, output):
+    """
+    Write the packed arrays of the dataset at config.DATA.PATH to `output`.
+    return: the index written to output/index.json
+    """
+    root, img_size = config.DATA.PATH, config.DATA.IMG_SIZE
+    lists = {}
+    for key in ('makeup', 'non-makeup'):
+        with open(os.path.join(root, f'{key}.txt'), 'r') as f:
+            lists[key] = [name.strip() for name in f.readlines() if name.strip()]
+    names = list(dict.fromkeys(lists['makeup'] + lists['non-makeup']))
+    missing = [name for name in names if not os.path.exists(
+        os.path.join(root, 'lms', f'{os.path.splitext(name)[0]}.npy'))]
+    skipped = set(missing)
+    names = [name for name in names if name not in skipped]
+
+    os.makedirs(output, exist_ok=True)
+    # written under temporary names so an interrupted run never leaves a half-packed folder behind
+    arrays = {
+        'images': np.lib.format.open_memmap(os.path.join(output, 'images.tmp.npy'), mode='w+',
+                                            dtype=np.uint8, shape=(len(names), img_size, img_size, 3)),
+        'segs': np.lib.format.open_memmap(os.path.join(output, 'segs.tmp.npy'), mode='w+',
+                                          dtype=np.uint8, shape=(len(names), img_size, img_size)),
+        'lms': np.lib.format.open_memmap(os.path.join(output, 'lms.tmp.npy'), mode='w+',
+                                         dtype=np.int16, shape=(len(names), config.PREPROCESS.LANDMARK_POINTS, 2))
+    }
+    for row, name in enumerate(tqdm(names, desc='packing')):
+        # same resizing as PreProcess.transform and PreProcess.load_mask
+        image = functional.resize(Image.open(os.path.join(root, 'images', name)).convert('RGB'), img_size)
+        image = np.array(image)
+        seg = torch.from_numpy(np.array(Image.open(os.path.join(root, 'segs', name)).convert('L'))).unsqueeze(0)
+        seg = functional.resize(seg, img_size, transforms.InterpolationMode.NEAREST)[0].numpy()
+        if image.shape[:2] != (img_size, img_size) or seg.shape != (img_size, img_size):
+            raise ValueError(f'{name} is not square, cannot pack it at {img_size}px')
+        arrays['images'][row] = image
+        arrays['segs'][row] = seg
+        arrays['lms'][row] = np.load(os.path.join(root, 'lms', f'{os.path.splitext(name)[0]}.npy'))
+
+    for array in arrays.values():
+        array.flush()
+    arrays.clear()
+    for key in ('images', 'segs', 'lms'):
+        os.replace(os.path.join(output, f'{key}.tmp.npy'), os.path.join(output, f'{key}.npy'))
+
+    kept = set(names)
+    index = {
+        'img_size': img_size,
+        'names': names,
+        'makeup': [name for name in lists['makeup'] if name in kept],
+        'non-makeup': [name for name in lists['non-makeup'] if name in kept],
+        'skipped': missing
+    }
+    with open(os.path.join(output, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def check_packed(config, num_samples, seed=0):
+    """
+    Compare packed samples with the ones decoded from the original files and time both.
+    return: dict with the largest difference per entry and the samples/s of both datasets
+    """
+    files = MakeupDataset(config, with_pgt=False)
+    packed = PackedMakeupDataset(config, with_pgt=False, diff_on_device=False)
+    generator = torch.Generator().manual_seed(seed)
+    names = packed.index['names']
+    picks = [names[i] for i in torch.randint(0, len(names), (num_samples,), generator=generator).tolist()]
+
+    result = {'max_abs_diff': {}}
+    for label, dataset in (('files', files), ('packed', packed)):
+        start = time.perf_counter()
+        samples = [dataset.load(name) for name in picks]
+        result[f'{label}_samples_per_second'] = num_samples / (time.perf_counter() - start)
+        result[label] = samples
+    for key, i in (('image', 0), ('mask', 1), ('diff', 2), ('lms', 3)):
+        result['max_abs_diff'][key] = max(
+            (a[i].float() - b[i].float()).abs().max().item() for a, b in zip(result['files'], result['packed']))
+    del result['files'], result['packed']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Pack MT-Dataset into memory-mapped arrays for training',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python scripts/pack_dataset.py --output data/MT-Packed
+    python scripts/pack_dataset.py --data-path data/MT-Dataset --output data/MT-Packed --check 200
+        """
+    )
+    parser.add_argument('--data-path', type=str, default=None,
+                        help='Dataset to pack (default: DATA.PATH)')
+    parser.add_argument('--output', type=str, required=True,
+                        help='Folder to write the packed arrays to')
+    parser.add_argument('--check', type=int, default=50,
+                        help='Samples compared with the original files after packing, 0 to skip (default: 50)')
+    args = parser.parse_args()
+
+    config = get_config().clone()
+    if args.data_path:
+        config.DATA.PATH = args.data_path
+    config.DATA.PACKED_PATH = args.output
+
+    start = time.perf_counter()
+    index = pack_dataset(config, args.output)
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(os.path.join(args.output, f'{key}.npy')) for key in ('images', 'segs', 'lms'))
+
+    print("\n" + "=" * 50)
+    print("PACKED DATASET")
+    print("=" * 50)
+    print(f"Images: {len(index['names'])} ({len(index['makeup'])} makeup, {len(index['non-makeup'])} non-makeup)")
+    print(f"Size: {size / 1024 ** 3:.2f} GB in {elapsed:.1f}s")
+    if index['skipped']:
+        print(f"Skipped {len(index['skipped'])} images without landmarks, e.g. {index['skipped'][0]}")
+
+    if args.check > 0 and index['names']:
+        check = check_packed(config, args.check)
+        print(f"\nLoading {args.check} samples: files {check['files_samples_per_second']:.1f}/s, "
+              f"packed {check['packed_samples_per_second']:.1f}/s")
+        print("Max abs difference: " + ", ".join(f"{k} {v:.2g}" for k, v in check['max_abs_diff'].items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+Combined performance and quality gate for EleGANt optimizations.
+
+Runs the reference inference path and a candidate mode on the benchmark set, each in its
+own process so timings and memory are not skewed by the other, then checks the speedup,
+the peak RSS ratio and the output quality (SSIM/PSNR over the whole image and inside the
+lip, skin and eye regions given by the face parser) against thresholds.
+
+Modes are combined with '+', e.g. `--candidate optimize+cache`.
+
+Usage:
+    python scripts/perf_gate.py --candidate cache
+    python scripts/perf_gate.py --candidate optimize+cache --min-speedup 1.2 --json results/gate.json
+"""
+import os
+import sys
+import argparse
+import json
+import subprocess
+import time
+
+sys.path.append('.')
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from concern.memory import MB, RSSSampler, read_rss, release_memory
+from concern.stats import compare_samples
+from models.modules.pseudo_gt import expand_area
+from scripts.benchmark import create_args, load_images_from_manifest
+from scripts.quality_check import HAS_SKIMAGE, calculate_psnr, calculate_ssim
+from training.config import get_config
+from training.inference import Inference
+from training.preprocess import PreProcess
+
+if HAS_SKIMAGE:
+    from skimage.metrics import structural_similarity
+
+REGIONS = ('lip', 'skin', 'eye')
+
+
+############################## Modes ##############################
+MODES = {}
+
+def mode(name):
+    """Register a mode; it adjusts the config and run options before Inference is built"""
+    def register(apply):
+        MODES[name] = apply
+        return apply
+    return register
+
+
+@mode('reference')
+def reference_mode(config, options):
+    pass
+
+
+@mode('cache')
+def cache_mode(config, options):
+    options['use_cache'] = True
+
+
+@mode('optimize')
+def optimize_mode(config, options):
+    from training.optimization import setup_cpu_optimization
+    options['optimization'] = setup_cpu_optimization()
+
+
+@mode('bf16')
+def bf16_mode(config, options):
+    config.MODEL.PRECISION = 'bf16'
+
+
+@mode('channels_last')
+def channels_last_mode(config, options):
+    config.MODEL.CHANNELS_LAST = True
+
+
+@mode('compile')
+def compile_mode(config, options):
+    config.MODEL.COMPILE = True
+
+
+@mode('onnx')
+def onnx_mode(config, options):
+    # needs the stages exported with scripts/export_onnx.py
+    config.MODEL.BACKEND = 'onnxruntime'
+
+
+@mode('int8')
+def int8_mode(config, options):
+    # needs the checkpoint written by scripts/quantize_generator.py
+    from scripts.quantize_generator import DEFAULT_OUTPUT
+    options['model_path'] = DEFAULT_OUTPUT
+
+
+@mode('parser_fused')
+def parser_fused_mode(config, options):
+    config.PREPROCESS.PARSER_FUSE_BN = True
+
+
+@mode('parser_384')
+def parser_384_mode(config, options):
+    config.PREPROCESS.PARSER_SIZE = 384
+
+
+@mode('parser_256')
+def parser_256_mode(config, options):
+    config.PREPROCESS.PARSER_SIZE = 256
+
+
+@mode('parser_int8')
+def parser_int8_mode(config, options):
+    # needs the checkpoint written by scripts/optimize_face_parser.py --quantize
+    from scripts.optimize_face_parser import DEFAULT_OUTPUT
+    config.PREPROCESS.PARSER_WEIGHTS = DEFAULT_OUTPUT
+
+
+@mode('opencv_dnn')
+def opencv_dnn_mode(config, options):
+    # needs the model files in PREPROCESS.DNN_MODEL and PREPROCESS.DNN_CONFIG
+    config.PREPROCESS.DETECTOR = 'opencv_dnn'
+
+
+@mode('cascade')
+def cascade_mode(config, options):
+    config.PREPROCESS.DETECTOR = 'cascade'
+
+
+@mode('tiled')
+def tiled_mode(config, options):
+    config.PREPROCESS.GROUP_DETECTOR = 'tiled'
+
+
+def run_mode(mode_spec, images, reference_path, output_dir, device, model_path, warmup=1, repeat=3):
+    """
+    Run the benchmark set under `mode_spec` in this process.
+    return: dict with per-image times, init time and RSS figures
+    """
+    config = get_config().clone()
+    options = {'use_cache': False}
+    for name in mode_spec.split('+'):
+        MODES[name](config, options)
+
+    rss_before_init = read_rss()
+    args, model_path = create_args(device, options.pop('model_path', model_path))
+    init_start = time.perf_counter()
+    inference = Inference(config, args, model_path)
+    init_time = time.perf_counter() - init_start
+    rss_after_init = read_rss()
+    if inference.compile_status is not None:
+        options['compile'] = inference.compile_status
+
+    reference = Image.open(reference_path).convert('RGB')
+    cached_reference = inference.cache_reference(reference) if options['use_cache'] else None
+    sources = [(img['path'], Image.open(img['path']).convert('RGB')) for img in images]
+
+    def transfer(source):
+        if cached_reference is not None:
+            return inference.transfer_all_faces_cached(source, cached_reference, postprocess=True)
+        return inference.transfer_all_faces(source, reference, postprocess=True)
+
+    for _ in range(warmup):
+        transfer(sources[0][1])
+
+    os.makedirs(output_dir, exist_ok=True)
+    times = {os.path.basename(path): [] for path, _ in sources}
+    release_memory()
+    with RSSSampler() as sampler:
+        for r in range(repeat):
+            for path, source in sources:
+                start = time.perf_counter()
+                result = transfer(source)
+                times[os.path.basename(path)].append(time.perf_counter() - start)
+                if r == repeat - 1 and result is not None:
+                    result.save(os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + '.png'))
+
+    return {
+        'mode': mode_spec,
+        'options': {k: v for k, v in options.items() if k != 'use_cache'},
+        'use_cache': options['use_cache'],
+        'init_time_seconds': init_time,
+        'rss_before_init_mb': rss_before_init / MB,
+        'rss_after_init_mb': rss_after_init / MB,
+        'peak_rss_mb': sampler.peak() / MB,
+        'times': times
+    }
+
+
+def run_mode_subprocess(mode_spec, args, output_dir):
+    result_path = os.path.join(output_dir, 'run.json')
+    command = [sys.executable, os.path.abspath(__file__), '--worker', mode_spec,
+               '--manifest', args.manifest, '--reference', args.reference, '--device', args.device,
+               '--model-path', args.model_path, '--warmup', str(args.warmup),
+               '--repeat', str(args.repeat), '--output', output_dir]
+    if args.images is not None:
+        command += ['--images', str(args.images)]
+    subprocess.run(command, check=True)
+    with open(result_path, 'r') as f:
+        return json.load(f)
+
+
+############################## Quality ##############################
+def region_masks(preprocess, image: Image, eye_margin=12):
+    """
+    Lip, skin and eye masks of every face of `image` at full resolution, from the face parser.
+    return: dict, region -> (H, W) bool array, or None if no face is found
+    """
+    faces = preprocess.preprocess_all_faces(image)
+    if faces is None:
+        return None
+    if isinstance(faces, tuple):
+        faces = [faces]
+    width, height = image.size
+    masks = {region: np.zeros((height, width), dtype=bool) for region in REGIONS}
+    for (face_image, mask, lms), face_on_image, crop_face in faces:
+        mask = preprocess.mask_process(mask) # lip, face, left eye, right eye
+        eye = expand_area(mask[2:3] + mask[3:4], eye_margin).clamp(0, 1)
+        face_regions = torch.cat([mask[0:1], mask[1:2] * (1 - eye), eye], dim=0)
+        if crop_face is None:
+            left, top, right, bottom = 0, 0, width, height
+        else:
+            left, top = max(crop_face.left(), 0), max(crop_face.top(), 0)
+            right, bottom = min(crop_face.right(), width), min(crop_face.bottom(), height)
+        face_regions = F.interpolate(face_regions.unsqueeze(0), (bottom - top, right - left),
+                                     mode='nearest').squeeze(0).numpy() > 0.5
+        for i, region in enumerate(REGIONS):
+            masks[region][top:bottom, left:right] |= face_regions[i]
+    return masks
+
+
+def region_quality(img1: np.ndarray, img2: np.ndarray, masks):
+    """SSIM (mean of the SSIM map) and PSNR restricted to each region mask"""
+    _, ssim_map = structural_similarity(img1, img2, channel_axis=2, data_range=255, full=True)
+    ssim_map = ssim_map.mean(axis=2)
+    diff = (img1.astype(np.float64) - img2.astype(np.float64)) ** 2
+    quality = {}
+    for region, mask in masks.items():
+        if not mask.any():
+            continue
+        mse = diff[mask].mean()
+        quality[region] = {
+            'ssim': float(ssim_map[mask].mean()),
+            'psnr': float('inf') if mse == 0 else float(10 * np.log10(255 ** 2 / mse)),
+            'pixels': int(mask.sum())
+        }
+    return quality
+
+
+def compare_outputs(images, reference_dir, candidate_dir, preprocess):
+    results = []
+    for img in {img['path']: img for img in images}.values():
+        name = os.path.splitext(os.path.basename(img['path']))[0] + '.png'
+        ref_path, cand_path = os.path.join(reference_dir, name), os.path.join(candidate_dir, name)
+        if not (os.path.exists(ref_path) and os.path.exists(cand_path)):
+            results.append({'image': name, 'missing': True})
+            continue
+        img1 = np.array(Image.open(ref_path).convert('RGB'))
+        img2 = np.array(Image.open(cand_path).convert('RGB'))
+        item = {'image': name, 'ssim': float(calculate_ssim(img1, img2)),
+                'psnr': float(calculate_psnr(img1, img2)), 'regions': {}}
+        masks = region_masks(preprocess, Image.open(img['path']).convert('RGB'))
+        if masks is not None and img1.shape == img2.shape:
+            item['regions'] = region_quality(img1, img2, masks)
+        results.append(item)
+    return results
+
+
+############################## Gate ##############################
+def evaluate_gate(reference, candidate, quality, thresholds, alpha=0.05):
+    checks = []
+
+    def check(name, value, limit, passed):
+        checks.append({'check': name, 'value': value, 'limit': limit, 'passed': bool(passed)})
+
+    ref_times = [t for times in reference['times'].values() for t in times]
+    cand_times = [t for times in candidate['times'].values() for t in times]
+    speedup = float(np.median(ref_times) / np.median(cand_times)) if cand_times else 0.0
+    significance = compare_samples(ref_times, cand_times, alpha=alpha, tolerance=0.0)
+    check('speedup', speedup, thresholds['min_speedup'], speedup >= thresholds['min_speedup'])
+
+    memory_ratio = candidate['peak_rss_mb'] / reference['peak_rss_mb']
+    check('peak_rss_ratio', memory_ratio, thresholds['max_memory_ratio'],
+          memory_ratio <= thresholds['max_memory_ratio'])
+
+    for item in quality:
+        if item.get('missing'):
+            check(f"{item['image']}:output", None, None, False)
+            continue
+        check(f"{item['image']}:ssim", item['ssim'], thresholds['min_ssim'], item['ssim'] >= thresholds['min_ssim'])
+        check(f"{item['image']}:psnr", item['psnr'], thresholds['min_psnr'], item['psnr'] >= thresholds['min_psnr'])
+        for region, metrics in item['regions'].items():
+            check(f"{item['image']}:{region}_ssim", metrics['ssim'], thresholds['min_region_ssim'],
+                  metrics['ssim'] >= thresholds['min_region_ssim'])
+            check(f"{item['image']}:{region}_psnr", metrics['psnr'], thresholds['min_region_psnr'],
+                  metrics['psnr'] >= thresholds['min_region_psnr'])
+
+    return {
+        'speedup': speedup,
+        'speedup_p_value': significance['p_value'],
+        'memory_ratio': memory_ratio,
+        'checks': checks,
+        'passed': all(c['passed'] for c in checks)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Gate an optimization on speedup, memory and output quality',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=f"""
+Available modes: {', '.join(MODES)}
+
+Examples:
+    python scripts/perf_gate.py --candidate cache
+    python scripts/perf_gate.py --candidate optimize+cache --repeat 5 --min-speedup 1.3
+        """
+    )
+    parser.add_argument('--candidate', type=str, default='cache',
+                        help="Candidate mode, modes combined with '+' (default: cache)")
+    parser.add_argument('--baseline-mode', type=str, default='reference',
+                        help='Mode the candidate is compared to (default: reference)')
+    parser.add_argument('--images', type=int, default=None,
+                        help='Number of manifest images (default: all)')
+    parser.add_argument('--manifest', type=str, default='test_data/benchmark/manifest.json')
+    parser.add_argument('--reference', type=str, default='test_data/benchmark/reference.png',
+                        help='Path to reference (makeup) image')
+    parser.add_argument('--expected', type=str, default='baseline/expected_single_face_result.png',
+                        help='Known-good output of single_face.jpg, checked against the baseline mode')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--model-path', type=str, default='ckpts/sow_pyramid_a5_e3d2_remapped.pth')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', type=str, default='results/perf_gate',
+                        help='Directory for the output images of each mode')
+    parser.add_argument('--min-speedup', type=float, default=1.0)
+    parser.add_argument('--max-memory-ratio', type=float, default=1.10)
+    parser.add_argument('--min-ssim', type=float, default=0.95)
+    parser.add_argument('--min-psnr', type=float, default=30.0)
+    parser.add_argument('--min-region-ssim', type=float, default=0.90)
+    parser.add_argument('--min-region-psnr', type=float, default=28.0)
+    parser.add_argument('--alpha', type=float, default=0.05,
+                        help='Significance level reported for the speedup (default: 0.05)')
+    parser.add_argument('--json', type=str, default=None, help='Path to save the gate report')
+    parser.add_argument('--worker', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    images, _ = load_images_from_manifest(args.manifest, args.images)
+
+    if args.worker:
+        result = run_mode(args.worker, images, args.reference, args.output, args.device,
+                          args.model_path, args.warmup, args.repeat)
+        with open(os.path.join(args.output, 'run.json'), 'w') as f:
+            json.dump(result, f, indent=2)
+        return
+
+    if not HAS_SKIMAGE:
+        print("ERROR: scikit-image is required for the quality checks")
+        sys.exit(1)
+    for mode_spec in (args.baseline_mode, args.candidate):
+        unknown = [name for name in mode_spec.split('+') if name not in MODES]
+        if unknown:
+            parser.error(f"unknown mode(s) {unknown}, available: {list(MODES)}")
+
+    reference_dir = os.path.join(args.output, args.baseline_mode)
+    candidate_dir = os.path.join(args.output, args.candidate)
+    print(f"Running baseline mode '{args.baseline_mode}'...")
+    reference = run_mode_subprocess(args.baseline_mode, args, reference_dir)
+    print(f"Running candidate mode '{args.candidate}'...")
+    candidate = run_mode_subprocess(args.candidate, args, candidate_dir)
+
+    preprocess = PreProcess(get_config(), device=args.device)
+    quality = compare_outputs(images, reference_dir, candidate_dir, preprocess)
+    thresholds = {
+        'min_speedup': args.min_speedup,
+        'max_memory_ratio': args.max_memory_ratio,
+        'min_ssim': args.min_ssim,
+        'min_psnr': args.min_psnr,
+        'min_region_ssim': args.min_region_ssim,
+        'min_region_psnr': args.min_region_psnr
+    }
+    gate = evaluate_gate(reference, candidate, quality, thresholds, args.alpha)
+
+    expected_ssim = None
+    baseline_single = os.path.join(reference_dir, 'single_face.png')
+    if os.path.exists(args.expected) and os.path.exists(baseline_single):
+        expected_ssim = float(calculate_ssim(np.array(Image.open(args.expected).convert('RGB')),
+                                             np.array(Image.open(baseline_single).convert('RGB'))))
+
+    print("=" * 50)
+    print("PERFORMANCE / QUALITY GATE")
+    print("=" * 50)
+    print(f"Baseline: {args.baseline_mode}, peak RSS {reference['peak_rss_mb']:.0f} MB")
+    print(f"Candidate: {args.candidate}, peak RSS {candidate['peak_rss_mb']:.0f} MB")
+    print(f"Speedup: {gate['speedup']:.2f}x (p={gate['speedup_p_value']:.3g}), "
+          f"memory ratio {gate['memory_ratio']:.2f}")
+    if expected_ssim is not None:
+        print(f"Baseline vs {args.expected}: SSIM {expected_ssim:.4f}")
+    print()
+    for c in gate['checks']:
+        status = "PASS" if c['passed'] else "FAIL"
+        value = 'missing' if c['value'] is None else f"{c['value']:.4f}"
+        limit = '' if c['limit'] is None else f" (limit {c['limit']})"
+        print(f"  {c['check']}: {value}{limit} [{status}]")
+    print()
+    print(f"GATE: {'PASSED' if gate['passed'] else 'FAILED'}")
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump({
+                'baseline': reference,
+                'candidate': candidate,
+                'quality': quality,
+                'thresholds': thresholds,
+                'expected_ssim': expected_ssim,
+                **gate
+            }, f, indent=2)
+        print(f"\nReport saved to: {args.json}")
+
+    sys.exit(0 if gate['passed'] else 1)
+
+
+if __name__ == '__main__':
+    main()
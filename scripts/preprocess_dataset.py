@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Preprocess a makeup dataset: landmarks (lms/) and face parsing masks (segs/).
+
+Detection and landmarks run in a process pool, one image per task, while the main
+process parses the images in batches with BiSeNet. Every file is written to a
+temporary name and renamed into place, so an interrupted run leaves no partial
+files and a rerun only processes the images whose outputs are missing.
+
+Usage:
+    python scripts/preprocess_dataset.py --data-path data/MT-Dataset
+"""
+import os
+import sys
+import argparse
+import json
+import multiprocessing
+import tempfile
+import time
+
+sys.path.append('.')
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from tqdm import tqdm
+
+import faceutils as futils
+from training.config import get_config
+from training.preprocess import PreProcess
+
+# per worker process, set by init_worker
+_preprocessor = None
+
+
+def output_paths(root, name):
+    base_name = os.path.splitext(name)[0]
+    return os.path.join(root, 'lms', f'{base_name}.npy'), os.path.join(root, 'segs', name)
+
+
+def atomic_write(path, write):
+    """
+    Call write(file) on a temporary file next to `path`, then rename it to `path`.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def init_worker(config):
+    global _preprocessor
+    # dlib is single threaded, keep torch from oversubscribing the cores as well
+    torch.set_num_threads(1)
+    _preprocessor = PreProcess(config, need_parser=False)
+
+
+def process_image(task):
+    """
+    Worker: landmarks of one image and, if its mask is needed, the image resized for parsing.
+    task: (name, image path, need_lms, need_seg)
+    return: dict with name, size, lms (or None), image512 (or None) and error (or None)
+    """
+    name, path, need_lms, need_seg = task
+    result = {'name': name, 'lms': None, 'image512': None, 'error': None}
+    try:
+        image = Image.open(path).convert('RGB')
+        result['size'] = image.size
+        if need_seg:
+            # same resizing as PreProcess.preprocess before parsing
+            result['image512'] = cv2.resize(np.array(image), (512, 512))
+        if need_lms:
+            lms = _preprocessor.lms_process(image)
+            if lms is None:
+                result['error'] = 'no face detected'
+            else:
+                result['lms'] = lms.numpy()
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    return result
+
+
+class MaskWriter:
+    """
+    Collect images and write their masks once a batch is full.
+    """
+    def __init__(self, root, device, batch_size, channels_last=False):
+        self.root = root
+        self.batch_size = batch_size
+        self.parser = futils.mask.FaceParser(device=device, channels_last=channels_last)
+        self.pending = []
+        self.written = 0
+        self.failures = {}
+
+    def add(self, name, image512, size):
+        self.pending.append((name, image512, size))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        try:
+            masks = self.parser.parse_batch([image for _, image, _ in batch]).cpu()
+        except Exception as e:
+            for name, _, _ in batch:
+                self.failures[name] = f'parsing: {type(e).__name__}: {e}'
+            return
+        for (name, _, (width, height)), mask in zip(batch, masks):
+            # back to the image resolution, like the masks shipped with MT-Dataset
+            mask = F.interpolate(mask.view(1, 1, 512, 512), (height, width), mode='nearest')
+            mask = Image.fromarray(mask[0, 0].numpy().astype(np.uint8))
+            atomic_write(output_paths(self.root, name)[1], lambda f: mask.save(f, format='PNG'))
+            self.written += 1
+
+
+def read_image_names(root):
+    names = []
+    for list_name in ('makeup.txt', 'non-makeup.txt'):
+        with open(os.path.join(root, list_name), 'r') as f:
+            names.extend(name.strip() for name in f.readlines() if name.strip())
+    return list(dict.fromkeys(names))
+
+
+def preprocess_dataset(config, root, workers, device, batch_size, overwrite=False):
+    """
+    Write lms/ and segs/ for the images listed in makeup.txt and non-makeup.txt under `root`.
+    return: dict of counts, elapsed seconds, throughput and {name: reason} failures
+    """
+    names = read_image_names(root)
+    tasks = []
+    for name in names:
+        lms_path, seg_path = output_paths(root, name)
+        need_lms = overwrite or not os.path.exists(lms_path)
+        need_seg = overwrite or not os.path.exists(seg_path)
+        if need_lms or need_seg:
+            tasks.append((name, os.path.join(root, 'images', name), need_lms, need_seg))
+    total = len(names)
+
+    failures = {}
+    lms_written = 0
+    start = time.perf_counter()
+    # spawn, so the workers never inherit the parser or a CUDA context
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, initializer=init_worker, initargs=(config,)) as pool:
+        masks = MaskWriter(root, device, batch_size, config.MODEL.CHANNELS_LAST)
+        results = pool.imap_unordered(process_image, tasks, chunksize=4)
+        for result in tqdm(results, total=len(tasks), desc='preprocessing'):
+            name = result['name']
+            if result['lms'] is not None:
+                lms = result['lms']
+                atomic_write(output_paths(root, name)[0], lambda f: np.save(f, lms))
+                lms_written += 1
+            if result['image512'] is not None:
+                masks.add(name, result['image512'], result['size'])
+            if result['error'] is not None:
+                failures[name] = result['error']
+        masks.flush()
+    elapsed = time.perf_counter() - start
+    failures.update(masks.failures)
+
+    return {
+        'images': total,
+        'skipped': total - len(tasks),
+        'processed': len(tasks),
+        'lms_written': lms_written,
+        'segs_written': masks.written,
+        'failures': failures,
+        'seconds': elapsed,
+        'images_per_second': len(tasks) / elapsed if elapsed > 0 else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write landmarks and face parsing masks for a makeup dataset',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python scripts/preprocess_dataset.py --data-path data/MT-Dataset
+    python scripts/preprocess_dataset.py --workers 16 --device cuda:0 --batch-size 32 --json results/preprocess.json
+        """
+    )
+    parser.add_argument('--data-path', type=str, default=None,
+                        help='Dataset folder with images/, makeup.txt and non-makeup.txt (default: DATA.PATH)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Processes for detection and landmarks (default: all cores)')
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu',
+                        help='Device for face parsing (default: cuda:0 if available)')
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='Images per face parsing batch (default: 16)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Process every image again, even those with both outputs')
+    parser.add_argument('--json', type=str, default=None,
+                        help='Path to save the summary and failures as JSON')
+    args = parser.parse_args()
+
+    config = get_config()
+    root = args.data_path or config.DATA.PATH
+    summary = preprocess_dataset(config, root, args.workers, args.device, args.batch_size, args.overwrite)
+
+    print("\n" + "=" * 50)
+    print("PREPROCESSING")
+    print("=" * 50)
+    print(f"Images: {summary['images']} ({summary['skipped']} already done, {summary['processed']} processed)")
+    print(f"Written: {summary['lms_written']} landmarks, {summary['segs_written']} masks")
+    print(f"Time: {summary['seconds']:.1f}s ({summary['images_per_second']:.1f} images/s)")
+    if summary['failures']:
+        print(f"\nFailures: {len(summary['failures'])}")
+        for name, reason in list(summary['failures'].items())[:10]:
+            print(f"  {name}: {reason}")
+        if len(summary['failures']) > 10:
+            print(f"  ... {len(summary['failures']) - 10} more")
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"\nResults saved to: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Post-training INT8 quantization of the Generator.
+
+static (default): the convolutions (in_conv, Downsample, the ResidualBlock_IN bottlenecks,
+the Upsample transposed convolutions, out_conv, merge and attention convolutions) and the
+attention projections run as int8 kernels. Their activation ranges are calibrated by running
+the full inference path on source/reference pairs. dynamic: only the Linear attention
+projections of the second level are quantized, as torch has no dynamic int8 convolution;
+no calibration is needed.
+InstanceNorm, the attention softmax and the TPS alignment always stay fp32.
+
+The checkpoint is loaded by Inference like a regular one (CPU only). Held-out pairs are then
+transferred with the fp32 and the int8 generator and compared per face region.
+
+Usage:
+    python scripts/quantize_generator.py --sources data/MT-Dataset/images/non-makeup \\
+        --references data/MT-Dataset/images/makeup --num-pairs 64
+    then gate it with: python scripts/perf_gate.py --candidate int8
+"""
+import os
+import sys
+import argparse
+import copy
+import itertools
+import json
+import time
+
+sys.path.append('.')
+
+import numpy as np
+import torch
+from PIL import Image
+
+from models.quantization import SCHEMES, convert_static, default_engine, prepare_static, quantizable_modules, \
+    quantize_generator_dynamic, quantized_checkpoint
+from scripts.benchmark import create_args
+from scripts.perf_gate import HAS_SKIMAGE, region_masks, region_quality
+from training.checkpoint import atomic_save
+from training.config import get_config
+from training.inference import Inference
+
+
+DEFAULT_MODEL_PATH = 'ckpts/sow_pyramid_a5_e3d2_remapped.pth'
+DEFAULT_OUTPUT = 'ckpts/sow_pyramid_a5_e3d2_int8.pth'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def list_images(folder):
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def make_pairs(sources, references, count, offset=0):
+    '''
+    Source i is paired with reference i, cycling through the references.
+    return: up to `count` (source path, reference path) pairs, starting at source `offset`
+    '''
+    sources = sources[offset:offset + count]
+    return list(zip(sources, itertools.islice(itertools.cycle(references), offset, offset + len(sources))))
+
+
+def calibrate(inference, G, pairs):
+    '''
+    Run `G` in place of the inference generator on every pair, so its observers see the
+    activations of the real preprocessing and transfer path.
+    return: number of pairs with a face in both images
+    '''
+    fp32_G, inference.solver.G = inference.solver.G, G
+    used = 0
+    try:
+        for i, (source_path, reference_path) in enumerate(pairs):
+            source = Image.open(source_path).convert('RGB')
+            reference = Image.open(reference_path).convert('RGB')
+            if inference.transfer(source, reference, postprocess=False) is not None:
+                used += 1
+            print(f"\r  calibrated {i + 1}/{len(pairs)}", end='', flush=True)
+    finally:
+        inference.solver.G = fp32_G
+    print()
+    return used
+
+
+def evaluate(inference, G, pairs):
+    '''
+    Transfer every pair with the fp32 and the quantized generator.
+    return: list of per-pair results with times and SSIM/PSNR per face region
+    '''
+    generators = {'fp32': inference.solver.G, 'int8': G}
+    results = []
+    for source_path, reference_path in pairs:
+        source = Image.open(source_path).convert('RGB')
+        reference = Image.open(reference_path).convert('RGB')
+        outputs, times = {}, {}
+        for name, generator in generators.items():
+            inference.solver.G = generator
+            start = time.perf_counter()
+            output = inference.transfer(source, reference, postprocess=True, return_full_image=True)
+            times[name] = time.perf_counter() - start
+            outputs[name] = output[1] if output is not None else None
+        inference.solver.G = generators['fp32']
+        if outputs['fp32'] is None or outputs['int8'] is None:
+            continue
+        item = {'source': os.path.basename(source_path), 'reference': os.path.basename(reference_path),
+                'times': times, 'regions': {}}
+        masks = region_masks(inference.preprocess, source)
+        if masks is not None and HAS_SKIMAGE:
+            item['regions'] = region_quality(np.array(outputs['fp32']), np.array(outputs['int8']), masks)
+        results.append(item)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Post-training INT8 quantization of the Generator',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python scripts/quantize_generator.py --sources data/MT-Dataset/images/non-makeup \\
+        --references data/MT-Dataset/images/makeup
+    python scripts/quantize_generator.py --skip in_conv,out_conv --num-pairs 128 --json results/int8.json
+    python scripts/quantize_generator.py --scheme dynamic --eval-pairs 0
+        """
+    )
+    parser.add_argument('--model-path', type=str, default=DEFAULT_MODEL_PATH, help='fp32 Generator weights')
+    parser.add_argument('--output', type=str, default=DEFAULT_OUTPUT,
+                        help=f'Quantized checkpoint to write (default: {DEFAULT_OUTPUT})')
+    parser.add_argument('--scheme', type=str, default='static', choices=SCHEMES)
+    parser.add_argument('--engine', type=str, default=None,
+                        help='Quantized engine: x86, fbgemm or qnnpack (default: best available)')
+    parser.add_argument('--skip', type=str, default='',
+                        help='Comma separated Generator modules kept in fp32, e.g. in_conv,out_conv')
+    parser.add_argument('--sources', type=str, default=None,
+                        help='Folder of source (no makeup) images (default: DATA.PATH/images/non-makeup)')
+    parser.add_argument('--references', type=str, default=None,
+                        help='Folder of reference (makeup) images (default: DATA.PATH/images/makeup)')
+    parser.add_argument('--num-pairs', type=int, default=64, help='Calibration pairs (default: 64)')
+    parser.add_argument('--eval-pairs', type=int, default=16,
+                        help='Held-out pairs compared with fp32, 0 to skip (default: 16)')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads value')
+    parser.add_argument('--json', type=str, default=None, help='Path to save the report as JSON')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    config = get_config().clone()
+    # calibrate and compare against the plain fp32 path
+    config.MODEL.PRECISION = 'fp32'
+    config.MODEL.COMPILE = False
+    engine = args.engine or default_engine()
+    skip = [name.strip() for name in args.skip.split(',') if name.strip()]
+    sources = list_images(args.sources or os.path.join(config.DATA.PATH, 'images', 'non-makeup'))
+    references = list_images(args.references or os.path.join(config.DATA.PATH, 'images', 'makeup'))
+
+    inference_args, _ = create_args('cpu', args.model_path)
+    inference = Inference(config, inference_args, args.model_path)
+    G = copy.deepcopy(inference.solver.G)
+    names = quantizable_modules(G, args.scheme, skip)
+    print(f"Quantizing {len(names)} layers ({args.scheme}, {engine}), fp32: InstanceNorm, softmax, TPS"
+          + (f", {', '.join(skip)}" if skip else ""))
+
+    report = {'scheme': args.scheme, 'engine': engine, 'skip': skip, 'modules': names}
+    if args.scheme == 'static':
+        prepare_static(G, names, engine)
+        pairs = make_pairs(sources, references, args.num_pairs)
+        report['calibration_pairs'] = calibrate(inference, G, pairs)
+        if report['calibration_pairs'] == 0:
+            print("ERROR: no calibration pair had a face in both images")
+            sys.exit(1)
+        convert_static(G)
+    else:
+        quantize_generator_dynamic(G, names, engine)
+    atomic_save(quantized_checkpoint(G, args.scheme, engine, names), args.output)
+    report['size_mb'] = {'fp32': os.path.getsize(args.model_path) / 1024 ** 2,
+                         'int8': os.path.getsize(args.output) / 1024 ** 2}
+
+    print("\n" + "=" * 50)
+    print("INT8 QUANTIZATION")
+    print("=" * 50)
+    print(f"Checkpoint: {args.output} ({report['size_mb']['int8']:.1f} MB, fp32 {report['size_mb']['fp32']:.1f} MB)")
+    if args.eval_pairs > 0:
+        pairs = make_pairs(sources, references, args.eval_pairs, offset=args.num_pairs)
+        results = evaluate(inference, G, pairs)
+        report['evaluation'] = results
+        if results:
+            fp32_time = np.median([item['times']['fp32'] for item in results])
+            int8_time = np.median([item['times']['int8'] for item in results])
+            print(f"Transfer: fp32 {fp32_time * 1000:.0f} ms, int8 {int8_time * 1000:.0f} ms "
+                  f"({fp32_time / int8_time:.2f}x) over {len(results)} held-out pairs")
+            for region in ('lip', 'skin', 'eye'):
+                values = [item['regions'][region] for item in results if region in item['regions']]
+                if values:
+                    print(f"  {region}: SSIM {np.mean([v['ssim'] for v in values]):.4f}, "
+                          f"PSNR {np.mean([v['psnr'] for v in values]):.2f} dB")
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults saved to: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Scaling benchmark for multi-face makeup transfer.
+
+Builds synthetic group photos by tiling and scaling the faces found in the benchmark
+images into collages of N faces at a given resolution, then records detection recall,
+time and memory per face for every (faces, megapixels) combination. The resulting curves
+show where per-face cost stops being linear and where high resolutions blow up.
+
+Usage:
+    python scripts/scaling_benchmark.py --faces 1,2,5,10,20 --megapixels 1,4,12,24
+"""
+import os
+import sys
+import argparse
+import json
+import math
+import time
+
+sys.path.append('.')
+
+import numpy as np
+import torch
+from PIL import Image
+
+import faceutils as futils
+from concern.memory import MB, RSSSampler, release_memory, stage_memory
+from concern.track import trace
+from scripts.benchmark import create_args, fit_memory_model
+from training.config import get_config
+from training.inference import Inference
+
+
+def load_face_crops(manifest_path, context=0.6):
+    """
+    Detect the faces of the manifest images and crop each with some context around it.
+    return: list of (crop: PIL.Image, face box inside the crop: (left, top, right, bottom))
+    """
+    manifest_dir = os.path.dirname(manifest_path)
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    crops = []
+    for img_info in manifest['images']:
+        image = Image.open(os.path.join(manifest_dir, img_info['path'])).convert('RGB')
+        width, height = image.size
+        for face in futils.dlib.detect(image):
+            margin_w, margin_h = context * face.width(), context * face.height()
+            left = int(max(0, face.left() - margin_w))
+            top = int(max(0, face.top() - margin_h))
+            right = int(min(width, face.right() + margin_w))
+            bottom = int(min(height, face.bottom() + margin_h))
+            crops.append((image.crop((left, top, right, bottom)),
+                          (face.left() - left, face.top() - top, face.right() - left, face.bottom() - top)))
+    if not crops:
+        raise RuntimeError(f'No faces detected in the images of {manifest_path}')
+    return crops
+
+
+def build_group_photo(crops, num_faces, megapixels, aspect=4 / 3, seed=0):
+    """
+    Tile `num_faces` scaled face crops on a canvas of about `megapixels` MP.
+    return: (PIL.Image, list of ground-truth face boxes (left, top, right, bottom))
+    """
+    rng = np.random.RandomState(seed)
+    width = int(math.sqrt(megapixels * 1e6 * aspect))
+    height = int(megapixels * 1e6 / width)
+    cols = math.ceil(math.sqrt(num_faces * aspect))
+    rows = math.ceil(num_faces / cols)
+    cell_w, cell_h = width // cols, height // rows
+
+    background = rng.normal(128, 12, size=(height // 8 + 1, width // 8 + 1, 3)).clip(0, 255)
+    canvas = Image.fromarray(background.astype(np.uint8)).resize((width, height), Image.BILINEAR)
+
+    boxes = []
+    for i in range(num_faces):
+        crop, (fl, ft, fr, fb) = crops[i % len(crops)]
+        scale = min(cell_w / crop.width, cell_h / crop.height) * rng.uniform(0.75, 0.95)
+        crop_w, crop_h = max(1, int(crop.width * scale)), max(1, int(crop.height * scale))
+        x = (i % cols) * cell_w + rng.randint(0, cell_w - crop_w + 1)
+        y = (i // cols) * cell_h + rng.randint(0, cell_h - crop_h + 1)
+        canvas.paste(crop.resize((crop_w, crop_h), Image.LANCZOS), (x, y))
+        boxes.append((x + fl * scale, y + ft * scale, x + fr * scale, y + fb * scale))
+    return canvas, boxes
+
+
+def box_iou(a, b):
+    inter_w = min(a[2], b[2]) - max(a[0], b[0])
+    inter_h = min(a[3], b[3]) - max(a[1], b[1])
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    inter = inter_w * inter_h
+    return inter / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter)
+
+
+def detection_recall(detected, boxes, iou_threshold=0.3):
+    """Fraction of ground-truth boxes matched by a detection with IoU >= threshold"""
+    detected = [(d.left(), d.top(), d.right(), d.bottom()) for d in detected]
+    matched = 0
+    for box in boxes:
+        best = max(((box_iou(box, d), j) for j, d in enumerate(detected)), default=(0.0, None))
+        if best[0] >= iou_threshold:
+            matched += 1
+            detected.pop(best[1])
+    return matched / len(boxes) if boxes else 1.0
+
+
+def run_scaling_benchmark(
+    inference,
+    reference,
+    crops,
+    face_counts,
+    megapixels_list,
+    repeat=1,
+    measure_memory=True,
+    memory_interval=0.005,
+    save_dir=None
+):
+    results = []
+    for megapixels in megapixels_list:
+        for num_faces in face_counts:
+            image, boxes = build_group_photo(crops, num_faces, megapixels)
+            if save_dir:
+                os.makedirs(save_dir, exist_ok=True)
+                image.save(os.path.join(save_dir, f'group_{num_faces}f_{megapixels}mp.jpg'), quality=92)
+
+            detect_start = time.perf_counter()
+            detected = inference.preprocess.detect(image, group=True)
+            detect_time = time.perf_counter() - detect_start
+            recall = detection_recall(detected, boxes)
+
+            times, growths, faces_processed, stages = [], [], 0, {}
+            for r in range(repeat):
+                if measure_memory:
+                    release_memory()
+                    sampler = RSSSampler(memory_interval).start()
+                with trace('image', faces=num_faces, megapixels=megapixels) as image_trace:
+                    start = time.perf_counter()
+                    result = inference.transfer_all_faces(image, reference, postprocess=True)
+                    times.append(time.perf_counter() - start)
+                if measure_memory:
+                    sampler.stop()
+                    growths.append((sampler.peak() - sampler.samples[0][1]) / MB)
+                summary = image_trace.summary()
+                # transfer_all_faces is all-or-nothing; single-face images have no 'face' span
+                faces_processed = summary.get('face', {}).get('count', 1) if result is not None else 0
+                if r == repeat - 1:
+                    stages = {name: item['total_ms'] for name, item in summary.items() if name != 'image'}
+                    if measure_memory:
+                        for name, item in stage_memory(image_trace, sampler).items():
+                            if name in stages:
+                                stages[name] = {'total_ms': stages[name], 'growth_mb': item['growth_mb']}
+                del result
+
+            item = {
+                'expected_faces': num_faces,
+                'megapixels': image.size[0] * image.size[1] / 1e6,
+                'resolution': list(image.size),
+                'detected_faces': len(detected),
+                'recall': recall,
+                'detect_time_seconds': detect_time,
+                'faces_processed': faces_processed,
+                'time_seconds': float(np.median(times)),
+                'time_per_face': float(np.median(times)) / max(faces_processed, 1),
+                'stages': stages,
+                'success': faces_processed > 0
+            }
+            if measure_memory:
+                item['rss_growth_mb'] = float(max(growths))
+                item['rss_growth_per_face_mb'] = item['rss_growth_mb'] / max(faces_processed, 1)
+            results.append(item)
+
+            line = (f"  {num_faces:2d} faces @ {megapixels:>4} MP: recall {recall * 100:5.1f}%, "
+                    f"{item['time_seconds']:.2f}s ({item['time_per_face']:.2f}s/face)")
+            if measure_memory:
+                line += f", RSS +{item['rss_growth_mb']:.0f} MB"
+            print(line)
+    return results
+
+
+def scaling_summary(results):
+    """
+    Per resolution: linear fit of time against processed faces and the ratio of the
+    largest to the smallest per-face cost (1.0 = perfectly linear scaling).
+    """
+    summary = {}
+    for megapixels in sorted(set(round(r['megapixels']) for r in results)):
+        rows = [r for r in results if round(r['megapixels']) == megapixels and r['faces_processed'] > 0]
+        if len(rows) < 2:
+            continue
+        faces = np.array([r['faces_processed'] for r in rows], dtype=np.float64)
+        times = np.array([r['time_seconds'] for r in rows])
+        if len(set(faces)) < 2:
+            continue
+        slope, intercept = np.polyfit(faces, times, 1)
+        per_face = times / faces
+        summary[str(megapixels)] = {
+            'fixed_seconds': float(intercept),
+            'seconds_per_face': float(slope),
+            'per_face_cost_ratio': float(per_face[np.argmax(faces)] / per_face[np.argmin(faces)]),
+            'min_recall': float(min(r['recall'] for r in rows))
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark how multi-face transfer scales with face count and resolution',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python scripts/scaling_benchmark.py --faces 1,2,5,10,20 --megapixels 1,4,12,24
+    python scripts/scaling_benchmark.py --faces 1,4,8 --megapixels 2 --save-images results/groups
+    python scripts/scaling_benchmark.py --faces 10,20,40 --megapixels 12,24 --group-detector tiled
+        """
+    )
+    parser.add_argument('--faces', type=str, default='1,2,5,10,20',
+                        help='Comma-separated face counts (default: 1,2,5,10,20)')
+    parser.add_argument('--megapixels', type=str, default='1,4,12,24',
+                        help='Comma-separated image sizes in MP (default: 1,4,12,24)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per combination, the median time is reported (default: 1)')
+    parser.add_argument('--manifest', type=str, default='test_data/benchmark/manifest.json',
+                        help='Manifest whose images provide the faces')
+    parser.add_argument('--reference', type=str, default='test_data/benchmark/reference.png',
+                        help='Path to reference image')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='Device to use (cpu or cuda:N)')
+    parser.add_argument('--model-path', type=str,
+                        default='ckpts/sow_pyramid_a5_e3d2_remapped.pth',
+                        help='Path to model weights')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip RSS sampling')
+    parser.add_argument('--memory-interval', type=float, default=0.005,
+                        help='RSS sampling interval in seconds (default: 0.005)')
+    parser.add_argument('--group-detector', type=str, default=None,
+                        help='Detector for the group photos, e.g. tiled (default: PREPROCESS.GROUP_DETECTOR)')
+    parser.add_argument('--save-images', type=str, default=None,
+                        help='Directory to save the generated group photos')
+    parser.add_argument('--json', type=str, default=None,
+                        help='Path to save results as JSON')
+    args = parser.parse_args()
+
+    face_counts = [int(n) for n in args.faces.split(',')]
+    megapixels_list = [float(mp) if '.' in mp else int(mp) for mp in args.megapixels.split(',')]
+
+    inference_args, model_path = create_args(args.device, args.model_path)
+    config = get_config().clone()
+    if args.group_detector:
+        config.PREPROCESS.GROUP_DETECTOR = args.group_detector
+    inference = Inference(config, inference_args, model_path)
+    reference = Image.open(args.reference).convert('RGB')
+    crops = load_face_crops(args.manifest)
+    print(f"Loaded {len(crops)} face crops from {args.manifest}")
+    print(f"Faces: {face_counts}, megapixels: {megapixels_list}, device: {args.device}")
+    print()
+
+    results = run_scaling_benchmark(
+        inference, reference, crops, face_counts, megapixels_list,
+        repeat=args.repeat,
+        measure_memory=not args.no_memory,
+        memory_interval=args.memory_interval,
+        save_dir=args.save_images
+    )
+    summary = scaling_summary(results)
+    memory_model = None if args.no_memory else fit_memory_model(results)
+
+    print()
+    print("=" * 50)
+    print("SCALING RESULTS")
+    print("=" * 50)
+    for megapixels, item in summary.items():
+        print(f"{megapixels} MP: {item['fixed_seconds']:.2f}s + {item['seconds_per_face']:.2f}s/face, "
+              f"per-face cost ratio {item['per_face_cost_ratio']:.2f}, "
+              f"min recall {item['min_recall'] * 100:.0f}%")
+    if memory_model:
+        terms = [f"{memory_model['base_mb']:.0f} MB"]
+        if 'per_face_mb' in memory_model:
+            terms.append(f"{memory_model['per_face_mb']:.1f} MB/face")
+        if 'per_megapixel_mb' in memory_model:
+            terms.append(f"{memory_model['per_megapixel_mb']:.1f} MB/MP")
+        print(f"Memory per image ~ {' + '.join(terms)} "
+              f"(max residual {memory_model['max_residual_mb']:.0f} MB)")
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump({
+                'device': args.device,
+                'threads': torch.get_num_threads(),
+                'results': results,
+                'summary': summary,
+                'memory_model': memory_model
+            }, f, indent=2)
+        print(f"\nResults saved to: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
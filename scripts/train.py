@@ -6,18 +6,23 @@ from torch.utils.data import DataLoader
 sys.path.append('.')
 
 from training.config import get_config
-from training.dataset import MakeupDataset
+from training.dataset import PairSampler, get_dataset
+from training.distributed import init_distributed, cleanup_distributed
 from training.solver import Solver
 from training.utils import create_logger, print_args
 
 
 def main(config, args):
-    logger = create_logger(args.save_folder, args.name, 'info', console=True)
-    print_args(args, logger)
-    logger.info(config)
+    logger = None
+    if args.rank == 0:
+        logger = create_logger(args.save_folder, args.name, 'info', console=True)
+        print_args(args, logger)
+        logger.info(config)
     
-    dataset = MakeupDataset(config)
-    data_loader = DataLoader(dataset, batch_size=config.DATA.BATCH_SIZE, num_workers=config.DATA.NUM_WORKERS, shuffle=True)
+    dataset = get_dataset(config)
+    # each rank runs 1/world_size of the steps of an epoch, DATA.BATCH_SIZE is per rank
+    sampler = PairSampler(dataset, num_replicas=args.world_size)
+    data_loader = DataLoader(dataset, batch_size=config.DATA.BATCH_SIZE, num_workers=config.DATA.NUM_WORKERS, sampler=sampler)
     
     solver = Solver(config, args, logger)
     solver.train(data_loader)
@@ -30,19 +35,34 @@ if __name__ == "__main__":
     parser.add_argument("--load_folder", type=str, help="path to load model", 
                         default=None)
     parser.add_argument("--keepon", default=False, action="store_true", help='keep on training')
+    parser.add_argument("--resume", type=str, default=None,
+                        help="full training checkpoint to resume from, or 'latest' for the newest in <save_path>/<name>/checkpoints")
 
     parser.add_argument("--gpu", default='0', type=str, help="GPU id to use.")
+    parser.add_argument("--device", default='cuda', choices=['cuda', 'cpu'], help="train on GPUs or on CPU")
+    parser.add_argument("--dist_backend", default='gloo', type=str,
+                        help="torch.distributed backend when launched with torchrun (gloo or nccl)")
 
     args = parser.parse_args()
     config = get_config()
     
-    #args.gpu = 'cuda:' + args.gpu
-    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
-    #args.device = torch.device(args.gpu)
-    args.device = torch.device('cuda:0')
+    # distributed when launched with torchrun, e.g. torchrun --nproc_per_node 4 scripts/train.py --device cpu
+    args.rank, args.world_size, args.local_rank = init_distributed(args.dist_backend)
+    if args.device == 'cpu':
+        args.device = torch.device('cpu')
+    elif args.world_size > 1:
+        # torchrun sets one process per GPU, --gpu is not used
+        args.device = torch.device('cuda:{:d}'.format(args.local_rank))
+        torch.cuda.set_device(args.device)
+    else:
+        #args.gpu = 'cuda:' + args.gpu
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+        #args.device = torch.device(args.gpu)
+        args.device = torch.device('cuda:0')
 
     args.save_folder = os.path.join(args.save_path, args.name)
     if not os.path.exists(args.save_folder):
-        os.makedirs(args.save_folder)    
+        os.makedirs(args.save_folder, exist_ok=True)
     
-    main(config, args)
\ No newline at end of file
+    main(config, args)
+    cleanup_distributed()
\ No newline at end of file
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Time and memory of a Generator training step under activation checkpointing.
+
+Runs the generator part of Solver.train (fake, identity and cycle transfers, L1 losses,
+backward) on synthetic 256px inputs with randomly initialized weights, once per
+TRAINING.CHECKPOINT_SEGMENTS setting and batch size. Reports the peak memory saved and
+the step time added relative to no checkpointing, and checks that the loss and the
+gradients match it.
+
+Usage:
+    python scripts/train_benchmark.py --device cuda:0 --batch-sizes 1,2,4
+"""
+import os
+import sys
+import argparse
+import json
+
+sys.path.append('.')
+
+import torch
+import torch.nn.functional as F
+
+from concern.memory import TorchMemoryStats
+from concern.stats import summarize
+from models.elegant import swap_transfer_input
+from models.model import get_generator
+from scripts.microbenchmark import environment_info, synthetic_features, synthetic_landmarks, \
+    synthetic_masks, time_callable
+from training.config import get_config
+from training.preprocess import PreProcess
+
+
+def make_generator_step(G, config, batch_size, device):
+    """
+    return: zero-argument callable running one generator forward/backward, returning the loss
+    """
+    size = config.DATA.IMG_SIZE
+    image_s = torch.tanh(synthetic_features(batch_size, 3, size, device, seed=0))
+    image_r = torch.tanh(synthetic_features(batch_size, 3, size, device, seed=1))
+    image_sr = torch.cat((image_s, image_r), dim=0)
+    mask_sr = synthetic_masks(2 * batch_size, size, device)
+    lms_sr = torch.cat((synthetic_landmarks(batch_size, size, device, seed=0),
+                        synthetic_landmarks(batch_size, size, device, seed=1, jitter=3.0)), dim=0)
+    diff_sr = PreProcess(config, need_parser=False).diff_process(lms_sr)
+
+    # time_callable runs under torch.no_grad()
+    @torch.enable_grad()
+    def step():
+        G.zero_grad(set_to_none=True)
+        # same passes as Solver.train
+        input_c = G.get_transfer_input(image_sr, mask_sr, diff_sr, lms_sr)
+        input_s = G.get_transfer_input(image_sr, mask_sr, diff_sr, lms_sr, True) if G.double_encoder else input_c
+        fake = G.transfer(input_c, swap_transfer_input(input_s))
+        idt = G.transfer(input_c, input_s)
+        rec = G.transfer(G.get_transfer_input(fake, mask_sr, diff_sr, lms_sr), input_s)
+        loss = F.l1_loss(fake, image_sr.flip(0)) + F.l1_loss(idt, image_sr) + F.l1_loss(rec, image_sr)
+        loss.backward()
+        return loss.detach()
+    return step
+
+
+def gradient_difference(G, reference):
+    """Largest gradient difference relative to the largest reference gradient"""
+    scale = max(g.abs().max().item() for g in reference.values())
+    diff = max((p.grad - reference[name]).abs().max().item()
+               for name, p in G.named_parameters() if name in reference)
+    return diff / scale if scale > 0 else diff
+
+
+def run_train_benchmark(config, settings, batch_sizes, device, warmup=2, repeat=10):
+    """
+    settings: dict, label -> tuple of checkpoint segments; the first one is the reference
+    return: dict, batch size -> label -> results
+    """
+    G = get_generator(config).to(device).train()
+    results = {}
+    for batch_size in batch_sizes:
+        step = make_generator_step(G, config, batch_size, device)
+        results[batch_size] = {}
+        reference = None
+        for label, segments in settings.items():
+            G.checkpoint_segments = set(segments)
+            samples = time_callable(step, device, warmup, repeat)
+            with TorchMemoryStats(device) as memory:
+                loss = step().item()
+            grads = {name: p.grad.clone() for name, p in G.named_parameters() if p.grad is not None}
+            item = {
+                'segments': list(segments),
+                'time_ms': summarize(samples),
+                'peak_mb': memory.stats.get('peak_mb', 0.0),
+                'loss': loss
+            }
+            if reference is None:
+                reference = {'loss': loss, 'grads': grads, 'item': item}
+            else:
+                base = reference['item']
+                item['memory_saved_mb'] = base['peak_mb'] - item['peak_mb']
+                item['memory_saved_ratio'] = item['memory_saved_mb'] / base['peak_mb'] if base['peak_mb'] else 0.0
+                item['time_overhead_ratio'] = item['time_ms']['median'] / base['time_ms']['median'] - 1
+                item['loss_difference'] = abs(loss - reference['loss'])
+                item['relative_grad_difference'] = gradient_difference(G, reference['grads'])
+            results[batch_size][label] = item
+            print(f"  b={batch_size} {label}: {item['time_ms']['median']:.1f} ms, peak {item['peak_mb']:.0f} MB")
+    G.checkpoint_segments = set()
+    return results
+
+
+def parse_settings(text):
+    """'none;encoder;encoder,attention,decoder' -> {'none': (), 'encoder': ('encoder',), ...}"""
+    settings = {'none': ()}
+    for label in text.split(';'):
+        label = label.strip()
+        if label and label != 'none':
+            settings[label] = tuple(s.strip() for s in label.split(','))
+    return settings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Memory saved and time added by activation checkpointing of the Generator',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python scripts/train_benchmark.py --device cuda:0 --batch-sizes 1,2,4
+    python scripts/train_benchmark.py --segments "attention;encoder,attention,decoder" --json results/ckpt.json
+        """
+    )
+    parser.add_argument('--segments', type=str, default='encoder;attention;decoder;encoder,attention,decoder',
+                        help='Semicolon separated settings of TRAINING.CHECKPOINT_SEGMENTS, '
+                             'always compared with no checkpointing')
+    parser.add_argument('--batch-sizes', type=str, default='1,2',
+                        help='Comma separated DATA.BATCH_SIZE values (default: 1,2)')
+    parser.add_argument('--warmup', type=int, default=2, help='Warm-up steps per setting (default: 2)')
+    parser.add_argument('--repeat', type=int, default=10, help='Timed steps per setting (default: 10)')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to use (cpu or cuda:N)')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads value')
+    parser.add_argument('--json', type=str, default=None, help='Path to save results as JSON')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    config = get_config().clone()
+    settings = parse_settings(args.segments)
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    device = torch.device(args.device)
+
+    print(f"Generator training step on {args.device} ({torch.get_num_threads()} threads)")
+    results = run_train_benchmark(config, settings, batch_sizes, device, args.warmup, args.repeat)
+
+    print("\n" + "=" * 50)
+    print("ACTIVATION CHECKPOINTING")
+    print("=" * 50)
+    for batch_size, items in results.items():
+        base = items['none']
+        print(f"Batch size {batch_size}: {base['time_ms']['median']:.1f} ms, peak {base['peak_mb']:.0f} MB without")
+        for label, item in items.items():
+            if label == 'none':
+                continue
+            print(f"  {label}: -{item['memory_saved_mb']:.0f} MB ({item['memory_saved_ratio'] * 100:.0f}%), "
+                  f"{item['time_overhead_ratio'] * 100:+.0f}% time, "
+                  f"grad diff {item['relative_grad_difference']:.1e}")
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment_info(args.device), 'results': results}, f, indent=2)
+        print(f"\nResults saved to: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+'''
+The shared, batched encodings of a training step (Generator.transfer) against the
+separate Generator calls they replaced, on random masks and jittered landmarks.
+Run from the repository root: python -m pytest tests
+'''
+import pytest
+import torch
+import torch.nn.functional as F
+
+from models.elegant import Generator, swap_transfer_input
+from training.optimization import generator_example_inputs
+
+
+IMG_SIZE = 64
+BATCH_SIZE = 2
+
+
+def random_inputs(seed):
+    '''
+    return: image, mask (B, 2, H, W) of random blobs, diff, lms, as the solver passes them to G
+    '''
+    image, _, diff, lms = generator_example_inputs(IMG_SIZE, BATCH_SIZE, seed=seed)
+    generator = torch.Generator().manual_seed(seed)
+    noise = F.avg_pool2d(torch.rand(BATCH_SIZE, 2, IMG_SIZE, IMG_SIZE, generator=generator), 9, stride=1, padding=4)
+    threshold = noise.flatten(2).median(dim=2).values.view(BATCH_SIZE, 2, 1, 1)
+    return image, (noise > threshold).float(), diff, lms
+
+
+@pytest.mark.parametrize('double_encoder', [False, True])
+def test_shared_encodings_match_generator_calls(double_encoder):
+    torch.manual_seed(0)
+    G = Generator(conv_dim=16, image_size=IMG_SIZE, window_size=8, double_encoder=double_encoder).eval()
+    image_s, mask_s, diff_s, lms_s = random_inputs(0)
+    image_r, mask_r, diff_r, lms_r = random_inputs(1)
+
+    with torch.no_grad():
+        # the former training step
+        fake_A = G(image_s, image_r, mask_s, mask_r, diff_s, diff_r, lms_s, lms_r)
+        fake_B = G(image_r, image_s, mask_r, mask_s, diff_r, diff_s, lms_r, lms_s)
+        idt_A = G(image_s, image_s, mask_s, mask_s, diff_s, diff_s, lms_s, lms_s)
+        idt_B = G(image_r, image_r, mask_r, mask_r, diff_r, diff_r, lms_r, lms_r)
+        rec_A = G(fake_A, image_s, mask_s, mask_s, diff_s, diff_s, lms_s, lms_s)
+        rec_B = G(fake_B, image_r, mask_r, mask_r, diff_r, diff_r, lms_r, lms_r)
+
+        # as Solver.train: A and B encoded once, the encodings shared between the passes
+        image_sr = torch.cat((image_s, image_r), dim=0)
+        mask_sr = torch.cat((mask_s, mask_r), dim=0)
+        diff_sr = torch.cat((diff_s, diff_r), dim=0)
+        lms_sr = torch.cat((lms_s, lms_r), dim=0)
+        input_c = G.get_transfer_input(image_sr, mask_sr, diff_sr, lms_sr)
+        input_s = G.get_transfer_input(image_sr, mask_sr, diff_sr, lms_sr, True) if double_encoder else input_c
+        shared_fake = G.transfer(input_c, swap_transfer_input(input_s))
+        shared_idt = G.transfer(input_c, input_s)
+        input_fake = G.get_transfer_input(shared_fake, mask_sr, diff_sr, lms_sr)
+        shared_rec = G.transfer(input_fake, input_s)
+
+    for expected, shared in ((torch.cat((fake_A, fake_B)), shared_fake),
+                             (torch.cat((idt_A, idt_B)), shared_idt),
+                             (torch.cat((rec_A, rec_B)), shared_rec)):
+        torch.testing.assert_close(shared, expected, rtol=1e-4, atol=1e-5)
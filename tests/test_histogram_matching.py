@@ -0,0 +1,127 @@
+'''
+The batched histogram matching against the former per-channel implementation
+(torch.histc and Python loops over numpy arrays), on random images and masks.
+Run from the repository root: python -m pytest tests
+'''
+import copy
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from models.modules.histogram_matching import cal_hist, cal_trans, masked_histogram_matching
+
+
+############################## former implementation ##############################
+def former_cal_hist(image):
+    hists = []
+    for channel in image:
+        hist = torch.histc(torch.from_numpy(channel), bins=256, min=0, max=256).numpy()
+        sum = hist.sum()
+        pdf = [v / (sum + 1e-10) for v in hist]
+        for i in range(1, 256):
+            pdf[i] = pdf[i - 1] + pdf[i]
+        hists.append(pdf)
+    return hists
+
+
+def former_cal_trans(ref, adj):
+    table = list(range(0, 256))
+    for i in list(range(1, 256)):
+        for j in list(range(1, 256)):
+            if ref[i] >= adj[j - 1] and ref[i] <= adj[j]:
+                table[i] = j
+                break
+    table[255] = 255
+    return table
+
+
+def former_histogram_matching(dstImg, refImg, index):
+    index = [x.cpu().numpy() for x in index]
+    dstImg = dstImg.detach().cpu().numpy()
+    refImg = refImg.detach().cpu().numpy()
+    dst_align = [dstImg[i, index[0], index[1]] for i in range(0, 3)]
+    ref_align = [refImg[i, index[2], index[3]] for i in range(0, 3)]
+    hist_ref = former_cal_hist(ref_align)
+    hist_dst = former_cal_hist(dst_align)
+    tables = [former_cal_trans(hist_dst[i], hist_ref[i]) for i in range(0, 3)]
+
+    mid = copy.deepcopy(dst_align)
+    for i in range(0, 3):
+        for k in range(0, len(index[0])):
+            dst_align[i][k] = tables[i][int(mid[i][k])]
+
+    for i in range(0, 3):
+        dstImg[i, index[0], index[1]] = dst_align[i]
+    return torch.FloatTensor(dstImg)
+
+
+def former_masked_matching(image_s, image_r, mask_s, mask_r):
+    '''
+    image: (3, h, w) in [0, 255], mask: (1, h, w); as masked_his_match called it
+    '''
+    index_s, index_r = torch.nonzero(mask_s), torch.nonzero(mask_r)
+    return former_histogram_matching(image_s * mask_s, image_r * mask_r,
+                                     [index_s[:, 1], index_s[:, 2], index_r[:, 1], index_r[:, 2]])
+
+
+################################## random inputs ###################################
+def random_masks(generator, batch_size, size, density=0.5):
+    '''
+    return: (B, 1, size, size) binary masks made of random blobs, covering about `density` of each
+    '''
+    noise = F.avg_pool2d(torch.rand(batch_size, 1, size, size, generator=generator), 9, stride=1, padding=4)
+    threshold = noise.flatten(1).quantile(1 - density, dim=1).view(-1, 1, 1, 1)
+    return (noise > threshold).float()
+
+
+def random_channels(generator, num_channels, num_pixels, num_values):
+    '''
+    return: (N, P) pixel values in [0, 255] taking at most `num_values` distinct values per channel,
+            (N, P) random 0/1 weights; few values leave empty bins, where the CDFs tie
+    '''
+    levels = torch.rand(num_channels, num_values, generator=generator) * 255
+    picks = torch.randint(0, num_values, (num_channels, num_pixels), generator=generator)
+    weights = (torch.rand(num_channels, num_pixels, generator=generator) > 0.3).float()
+    return levels.gather(1, picks), weights
+
+
+def former_hists(values, weights):
+    channels = [row[select].numpy() for row, select in zip(values, weights.bool())]
+    return torch.from_numpy(np.array(former_cal_hist(channels), dtype=np.float32))
+
+
+###################################### tests #######################################
+def test_cal_hist_matches_former():
+    generator = torch.Generator().manual_seed(0)
+    for num_values in (3, 40, 256):
+        values, weights = random_channels(generator, 6, 2000, num_values)
+        hists = cal_hist(values, weights)
+        assert hists.dtype == torch.float32
+        assert torch.equal(hists, former_hists(values, weights))
+
+
+def test_cal_trans_matches_former():
+    generator = torch.Generator().manual_seed(1)
+    for num_values in (3, 40, 256):
+        values, weights = random_channels(generator, 6, 2000, num_values)
+        ref_values, ref_weights = random_channels(generator, 6, 1500, num_values)
+        hist_dst, hist_ref = former_hists(values, weights), former_hists(ref_values, ref_weights)
+        tables = cal_trans(hist_dst, hist_ref)
+        former = [former_cal_trans(dst.tolist(), ref.tolist()) for dst, ref in zip(hist_dst, hist_ref)]
+        assert torch.equal(tables, torch.tensor(former))
+
+
+def test_masked_histogram_matching_matches_former():
+    generator = torch.Generator().manual_seed(2)
+    batch_size, size = 4, 48
+    image_s = torch.rand(batch_size, 3, size, size, generator=generator) * 255
+    image_r = torch.rand(batch_size, 3, size, size, generator=generator) * 255
+    mask_s = random_masks(generator, batch_size, size)
+    mask_r = random_masks(generator, batch_size, size, density=0.3)
+    # an empty reference histogram
+    mask_r[-1] = 0
+
+    matched = masked_histogram_matching(image_s, image_r, mask_s, mask_r)
+    for i in range(batch_size):
+        former = former_masked_matching(image_s[i], image_r[i], mask_s[i], mask_r[i])
+        assert torch.equal(matched[i], former)
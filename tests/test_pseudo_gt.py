@@ -0,0 +1,83 @@
+'''
+The pseudo ground truth made for a whole batch against the same functions run per sample,
+on random masks and jittered landmarks.
+Run from the repository root: python -m pytest tests
+'''
+import pytest
+import torch
+import torch.nn.functional as F
+
+from models.loss import generate_pgt
+from models.modules.pseudo_gt import fine_align, tps_blend
+from training.optimization import generator_example_inputs
+
+
+IMG_SIZE = 64
+BATCH_SIZE = 3
+MARGINS = {'eye': 6, 'lip': 2}
+BLEND_ALPHAS = {'skin': 0.3, 'eye': 0.8, 'lip': 0.1}
+# lip, skin, left eye, right eye
+MASK_DENSITIES = (0.1, 0.6, 0.05, 0.05)
+
+
+def random_masks(generator, batch_size, densities):
+    '''
+    return: (B, len(densities), IMG_SIZE, IMG_SIZE) binary masks made of random blobs,
+            channel c covering about densities[c] of each image
+    '''
+    noise = torch.rand(batch_size, len(densities), IMG_SIZE, IMG_SIZE, generator=generator)
+    noise = F.avg_pool2d(noise, 9, stride=1, padding=4)
+    threshold = torch.stack([noise[:, c].flatten(1).quantile(1 - density, dim=1)
+                             for c, density in enumerate(densities)], dim=1)
+    return (noise > threshold.view(batch_size, -1, 1, 1)).float()
+
+
+def random_inputs(seed):
+    '''
+    return: image (B, 3, H, W) in [-1, 1], mask (B, 4, H, W), lms (B, 68, 2)
+    '''
+    image, _, _, lms = generator_example_inputs(IMG_SIZE, BATCH_SIZE, seed=seed)
+    mask = random_masks(torch.Generator().manual_seed(seed), BATCH_SIZE, MASK_DENSITIES)
+    return image, mask, lms
+
+
+def assert_batch_matches(batched, per_sample):
+    for i, output in enumerate(per_sample):
+        torch.testing.assert_close(batched[i:i + 1], output, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('sample_mode,blend_mode', [('bilinear', 'smooth'), ('nearest', 'smooth'),
+                                                    ('bilinear', 'valid')])
+def test_tps_blend_batched_matches_per_sample(sample_mode, blend_mode):
+    image_s, mask_s, lms_s = random_inputs(0)
+    image_r, mask_r, lms_r = random_inputs(1)
+    args = (lms_r[:, :60], lms_s[:, :60], image_r, image_s, mask_r[:, 1:2], mask_s[:, 1:2], mask_s[:, 1:2])
+    kwargs = {'blur_size': 5, 'sample_mode': sample_mode, 'blend_mode': blend_mode}
+
+    batched = tps_blend(0.5, IMG_SIZE, *args, **kwargs)
+    per_sample = [tps_blend(0.5, IMG_SIZE, *[x[i:i + 1] for x in args], **kwargs) for i in range(BATCH_SIZE)]
+    assert_batch_matches(batched, per_sample)
+
+
+def test_fine_align_batched_matches_per_sample():
+    image_s, mask_s, lms_s = random_inputs(2)
+    image_r, mask_r, lms_r = random_inputs(3)
+    args = (lms_r, lms_s, image_r, image_s, mask_r, mask_s)
+
+    batched = fine_align(IMG_SIZE, *args, MARGINS, BLEND_ALPHAS)
+    per_sample = [fine_align(IMG_SIZE, *[x[i:i + 1] for x in args], MARGINS, BLEND_ALPHAS)
+                  for i in range(BATCH_SIZE)]
+    assert_batch_matches(batched, per_sample)
+
+
+def test_generate_pgt_batched_matches_per_sample():
+    image_s, mask_s, lms_s = random_inputs(4)
+    image_r, mask_r, lms_r = random_inputs(5)
+    args = (image_s, image_r, mask_s, mask_r, lms_s, lms_r)
+
+    batched = generate_pgt(*args, MARGINS, BLEND_ALPHAS)
+    assert batched.shape == image_s.shape
+    # unbatched inputs, as the dataset workers pass them
+    per_sample = [generate_pgt(*[x[i] for x in args], MARGINS, BLEND_ALPHAS).unsqueeze(0)
+                  for i in range(BATCH_SIZE)]
+    assert_batch_matches(batched, per_sample)
@@ -0,0 +1,141 @@
+import os
+import re
+import random
+import threading
+import numpy as np
+import torch
+
+
+CHECKPOINT_PATTERN = re.compile(r'^step_(\d+)\.pth$')
+
+
+def snapshot(obj):
+    '''
+    Copy of a (nested) state with every tensor cloned to the CPU, so training can go on
+    updating the live tensors while the copy is serialized.
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    '''
+    torch.save to a temporary file in the same folder, then rename it over `path`;
+    readers see either the previous file or the complete new one.
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def get_rng_state():
+    '''
+    The numpy and python states are kept as tensors and numbers,
+    so checkpoints holding them load with torch.load(weights_only=True).
+    '''
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    version, internal, gauss_next = random.getstate()
+    state = {
+        'torch': torch.get_rng_state(),
+        'numpy': {'keys': torch.from_numpy(keys.astype(np.int64)), 'pos': int(pos),
+                  'has_gauss': int(has_gauss), 'cached_gaussian': float(cached_gaussian)},
+        'python': {'version': version, 'internal': torch.tensor(internal, dtype=torch.int64),
+                   'gauss_next': gauss_next}
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    if state is None:
+        return
+    torch.set_rng_state(state['torch'])
+    numpy_state = state['numpy']
+    np.random.set_state(('MT19937', numpy_state['keys'].numpy().astype(np.uint32), numpy_state['pos'],
+                         numpy_state['has_gauss'], numpy_state['cached_gaussian']))
+    python_state = state['python']
+    random.setstate((python_state['version'], tuple(python_state['internal'].tolist()),
+                     python_state['gauss_next']))
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread, one at a time.
+    `save` snapshots the state to the CPU before returning, so it only blocks training
+    for the device-to-host copy (and for the previous write, if it is still running).
+    Step checkpoints are named step_<global step>.pth; only the last `keep_last` are kept.
+    """
+    def __init__(self, folder, keep_last=3):
+        self.folder = folder
+        self.keep_last = keep_last
+        self._thread = None
+        self._error = None
+
+    def _run(self, files, prune):
+        try:
+            for path, state in files.items():
+                atomic_save(state, path)
+            if prune:
+                self.prune()
+        except BaseException as e:
+            self._error = e
+
+    def save_files(self, files, prune=False):
+        '''
+        files: dict, path -> state, written in the background after snapshotting
+        '''
+        files = {path: snapshot(state) for path, state in files.items()}
+        self.wait()
+        self._thread = threading.Thread(target=self._run, args=(files, prune), daemon=True)
+        self._thread.start()
+
+    def save(self, state, global_step):
+        path = os.path.join(self.folder, 'step_{:08d}.pth'.format(global_step))
+        self.save_files({path: state}, prune=True)
+        return path
+
+    def wait(self):
+        '''
+        Block until the pending write is done; re-raise its error, if any.
+        '''
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def checkpoints(self):
+        '''
+        return: list of (global step, path) of the complete step checkpoints, oldest first
+        '''
+        if not os.path.isdir(self.folder):
+            return []
+        found = []
+        for name in os.listdir(self.folder):
+            match = CHECKPOINT_PATTERN.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.folder, name)))
+        return sorted(found)
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1][1] if checkpoints else None
+
+    def prune(self):
+        if self.keep_last <= 0:
+            return
+        for _, path in self.checkpoints()[:-self.keep_last]:
+            os.remove(path)
@@ -13,7 +13,16 @@ _C = CfgNode()
 # Logging and saving
 _C.LOG = CfgNode()
 _C.LOG.SAVE_FREQ = 10
+# steps between full training checkpoints, written in the background to <save folder>/checkpoints;
+# one is also written at the end of every epoch (0: only then). The last CHECKPOINT_KEEP are kept
+_C.LOG.CHECKPOINT_FREQ = 1000
+_C.LOG.CHECKPOINT_KEEP = 3
 _C.LOG.VIS_FREQ = 1
+# steps between reading the losses back from the device (progress bar, event file)
+_C.LOG.FLUSH_FREQ = 50
+# also write the losses to TensorBoard event files in the save folder; the matplotlib
+# curves are then only plotted after the last epoch
+_C.LOG.EVENT_FILE = False
 
 # Data settings
 _C.DATA = CfgNode()
@@ -21,6 +30,10 @@ _C.DATA.PATH = './data/MT-Dataset'
 _C.DATA.NUM_WORKERS = 4
 _C.DATA.BATCH_SIZE = 1
 _C.DATA.IMG_SIZE = 256
+# folder written by scripts/pack_dataset.py; when set, training reads it instead of DATA.PATH
+_C.DATA.PACKED_PATH = ''
+# leave diff to the training loop, which builds it from lms on the device (packed dataset only)
+_C.DATA.DIFF_ON_DEVICE = False
 
 # Training hyper-parameters
 _C.TRAINING = CfgNode()
@@ -31,6 +44,9 @@ _C.TRAINING.BETA2 = 0.999
 _C.TRAINING.NUM_EPOCHS = 50
 _C.TRAINING.LR_DECAY_FACTOR = 5e-2
 _C.TRAINING.DOUBLE_D = False
+# parts of the generator recomputed in the backward pass instead of keeping their activations,
+# any of 'encoder' (bottlenecks), 'attention', 'decoder' (bottlenecks); trades time for memory
+_C.TRAINING.CHECKPOINT_SEGMENTS = ()
 
 # Loss weights
 _C.LOSS = CfgNode()
@@ -60,6 +76,23 @@ _C.MODEL.NUM_LAYER_E = 3
 _C.MODEL.NUM_LAYER_D = 2
 _C.MODEL.WINDOW_SIZE = 16
 _C.MODEL.MERGE_MODE = 'conv'
+# 'fp32', or 'bf16' to run the generator's convolutions and attention under bfloat16 autocast
+# (training and inference); TPS alignment and softmax stay in fp32, outputs are fp32
+_C.MODEL.PRECISION = 'fp32'
+# store the generator, the vgg and the face parser and their activations channels_last (NHWC),
+# training and inference; the spectral-normed discriminator stays NCHW
+_C.MODEL.CHANNELS_LAST = False
+# inference only: torch.compile the generator's encode / transfer / decode stages, specialized
+# to DATA.IMG_SIZE and warmed up at start-up for COMPILE_BATCH_SIZES; compiled artifacts are
+# kept in COMPILE_CACHE for warm restarts, and a stage that fails to compile runs eagerly
+_C.MODEL.COMPILE = False
+_C.MODEL.COMPILE_MODE = 'default'
+_C.MODEL.COMPILE_BATCH_SIZES = (1,)
+_C.MODEL.COMPILE_CACHE = 'cache/compile'
+# inference only: 'torch', or 'onnxruntime' to run the stages exported to ONNX_DIR by
+# scripts/export_onnx.py on ONNX Runtime's CPU execution provider
+_C.MODEL.BACKEND = 'torch'
+_C.MODEL.ONNX_DIR = 'ckpts/onnx'
 
 # Preprocessing
 _C.PREPROCESS = CfgNode()
@@ -71,6 +104,38 @@ _C.PREPROCESS.FACE_CLASS = [1, 6]
 _C.PREPROCESS.EYEBROW_CLASS = [2, 3]
 _C.PREPROCESS.EYE_CLASS = [4, 5]
 _C.PREPROCESS.LANDMARK_POINTS = 68
+# face detection, run once per image: 'dlib' (HOG on the image downsized to DETECTOR_MAX_SIDE,
+# upsampled DETECTOR_UPSAMPLE times), 'opencv_dnn' (an SSD face detector read from DNN_MODEL and
+# DNN_CONFIG by OpenCV's dnn module), or 'cascade' (opencv_dnn proposes faces, dlib confirms each
+# on a crop around it and gives the box the crop ratios and landmarks are tuned for)
+_C.PREPROCESS.DETECTOR = 'dlib'
+_C.PREPROCESS.DETECTOR_MAX_SIDE = 361
+_C.PREPROCESS.DETECTOR_UPSAMPLE = 1
+_C.PREPROCESS.DNN_MODEL = 'ckpts/face_detector/res10_300x300_ssd_iter_140000.caffemodel'
+_C.PREPROCESS.DNN_CONFIG = 'ckpts/face_detector/deploy.prototxt'
+_C.PREPROCESS.DNN_INPUT_SIZE = 300
+_C.PREPROCESS.DNN_CONFIDENCE = 0.5
+# 'tiled': dlib HOG on overlapping DETECTOR_TILE_SIZE tiles of an image pyramid, for large group
+# photos; faces DETECTOR_MIN_FACE to DETECTOR_MAX_FACE pixels wide are searched, the tiles run in
+# DETECTOR_WORKERS processes (0: all cores), tiles not done within DETECTOR_TIME_BUDGET seconds
+# (0: no limit) are dropped and boxes overlapping by more than DETECTOR_NMS_THRESHOLD are merged.
+# GROUP_DETECTOR, when set, replaces DETECTOR for the photos whose faces are all transferred
+_C.PREPROCESS.GROUP_DETECTOR = ''
+_C.PREPROCESS.DETECTOR_MIN_FACE = 40
+_C.PREPROCESS.DETECTOR_MAX_FACE = 2000
+_C.PREPROCESS.DETECTOR_TILE_SIZE = 512
+_C.PREPROCESS.DETECTOR_TILE_OVERLAP = 160
+_C.PREPROCESS.DETECTOR_WORKERS = 0
+_C.PREPROCESS.DETECTOR_TIME_BUDGET = 0.
+_C.PREPROCESS.DETECTOR_NMS_THRESHOLD = 0.5
+# face parser: square input side (512, 384 or 256; masks are resized to DATA.IMG_SIZE either way),
+# optionally with BatchNorm folded into the convolutions, the faces of an image parsed
+# PARSER_BATCH_SIZE at a time; PARSER_WEIGHTS '' is the bundled fp32 model, or an INT8 checkpoint
+# (CPU only) written by scripts/optimize_face_parser.py, which also validates the variants
+_C.PREPROCESS.PARSER_SIZE = 512
+_C.PREPROCESS.PARSER_FUSE_BN = False
+_C.PREPROCESS.PARSER_BATCH_SIZE = 8
+_C.PREPROCESS.PARSER_WEIGHTS = ''
 
 # Pseudo ground truth
 _C.PGT = CfgNode()
@@ -86,6 +151,8 @@ _C.PGT.EYE_ALPHA_VALUES = (0.6, 0.8, 0.6, 0.4)
 _C.PGT.LIP_ALPHA = 0.1
 _C.PGT.LIP_ALPHA_MILESTONES = (0, 12, 24, 50)
 _C.PGT.LIP_ALPHA_VALUES = (0.05, 0.2, 0.1, 0.0)
+# generate pgt_A/pgt_B in the data loader workers instead of the training loop
+_C.PGT.IN_WORKERS = False
 
 # Postprocessing
 _C.POSTPROCESS = CfgNode()
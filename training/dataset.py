@@ -1,47 +1,185 @@
 import os
+import json
+import math
+import numpy as np
 from PIL import Image
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 
+from models.loss import generate_pgt
 from training.config import get_config
 from training.preprocess import PreProcess
 
 class MakeupDataset(Dataset):
-    def __init__(self, config=None):
+    def __init__(self, config=None, with_pgt=None):
         super(MakeupDataset, self).__init__()
         if config is None:
             config = get_config()
         self.root = config.DATA.PATH
-        with open(os.path.join(config.DATA.PATH, 'makeup.txt'), 'r') as f:
-            self.makeup_names = [name.strip() for name in f.readlines()]
-        with open(os.path.join(config.DATA.PATH, 'non-makeup.txt'), 'r') as f:
-            self.non_makeup_names = [name.strip() for name in f.readlines()]
+        self.makeup_names, self.non_makeup_names = self.read_names(config)
         self.preprocessor = PreProcess(config, need_parser=False)
         self.img_size = config.DATA.IMG_SIZE
 
+        # pseudo ground truth made by the workers; the blend alphas live in shared
+        # memory so the values set by the training loop reach running workers
+        self.with_pgt = config.PGT.IN_WORKERS if with_pgt is None else with_pgt
+        if self.with_pgt:
+            self.margins = {'eye':config.PGT.EYE_MARGIN,
+                            'lip':config.PGT.LIP_MARGIN}
+            self.pgt_alphas = torch.tensor(
+                [config.PGT.SKIN_ALPHA, config.PGT.EYE_ALPHA, config.PGT.LIP_ALPHA]).share_memory_()
+
+    def read_names(self, config):
+        with open(os.path.join(config.DATA.PATH, 'makeup.txt'), 'r') as f:
+            makeup_names = [name.strip() for name in f.readlines()]
+        with open(os.path.join(config.DATA.PATH, 'non-makeup.txt'), 'r') as f:
+            non_makeup_names = [name.strip() for name in f.readlines()]
+        return makeup_names, non_makeup_names
+
+    def set_pgt_alphas(self, blend_alphas):
+        '''
+        blend_alphas: dict with 'skin', 'eye', 'lip', e.g. the current values of AnnealingComposePGT
+        '''
+        self.pgt_alphas.copy_(torch.tensor(
+            [blend_alphas['skin'], blend_alphas['eye'], blend_alphas['lip']]))
+
+    def make_pgt(self, source, reference):
+        skin, eye, lip = self.pgt_alphas.tolist()
+        blend_alphas = {'skin':skin, 'eye':eye, 'lip':lip}
+        # image, mask, [diff,] lms; diff is left out when it is built on the device
+        pgt_A = generate_pgt(source[0], reference[0], source[1], reference[1], source[-1], reference[-1],
+                             self.margins, blend_alphas)
+        pgt_B = generate_pgt(reference[0], source[0], reference[1], source[1], reference[-1], source[-1],
+                             self.margins, blend_alphas)
+        return pgt_A, pgt_B
+
     def load_from_file(self, img_name):
         image = Image.open(os.path.join(self.root, 'images', img_name)).convert('RGB')
         mask = self.preprocessor.load_mask(os.path.join(self.root, 'segs', img_name))
         base_name = os.path.splitext(img_name)[0]
         lms = self.preprocessor.load_lms(os.path.join(self.root, 'lms', f'{base_name}.npy'))
         return self.preprocessor.process(image, mask, lms)
+
+    def load(self, img_name):
+        return self.load_from_file(img_name)
     
     def __len__(self):
         return max(len(self.makeup_names), len(self.non_makeup_names))
 
     def __getitem__(self, index):
-        idx_s = torch.randint(0, len(self.non_makeup_names), (1, )).item()
-        idx_r = torch.randint(0, len(self.makeup_names), (1, )).item()
+        # (source, reference) indices drawn by PairSampler; any other index draws a random pair
+        if isinstance(index, tuple):
+            idx_s, idx_r = index
+        else:
+            idx_s = torch.randint(0, len(self.non_makeup_names), (1, )).item()
+            idx_r = torch.randint(0, len(self.makeup_names), (1, )).item()
         name_s = self.non_makeup_names[idx_s]
         name_r = self.makeup_names[idx_r]
-        source = self.load_from_file(name_s)
-        reference = self.load_from_file(name_r)
+        source = self.load(name_s)
+        reference = self.load(name_r)
+        if self.with_pgt:
+            with torch.no_grad():
+                pgt_A, pgt_B = self.make_pgt(source, reference)
+            return source, reference, pgt_A, pgt_B
         return source, reference
 
+
+class PackedMakeupDataset(MakeupDataset):
+    '''
+    MakeupDataset reading the arrays written by scripts/pack_dataset.py:
+    images.npy (N, H, W, 3) uint8, already resized to DATA.IMG_SIZE
+    segs.npy   (N, H, W) uint8, face parsing labels
+    lms.npy    (N, 68, 2) int16
+    index.json names, rows and the two lists of the dataset
+    The arrays are memory-mapped and each worker maps them on first use, so samples are
+    slices of the page cache instead of decoded and resized files.
+    With diff_on_device, samples are [image, mask, lms] and the training loop builds diff.
+    '''
+    def __init__(self, config=None, with_pgt=None, diff_on_device=None):
+        if config is None:
+            config = get_config()
+        self.packed_path = config.DATA.PACKED_PATH
+        with open(os.path.join(self.packed_path, 'index.json'), 'r') as f:
+            self.index = json.load(f)
+        if self.index['img_size'] != config.DATA.IMG_SIZE:
+            raise ValueError('{} was packed at {}px, DATA.IMG_SIZE is {}'.format(
+                self.packed_path, self.index['img_size'], config.DATA.IMG_SIZE))
+        self.rows = {name: row for row, name in enumerate(self.index['names'])}
+        self.diff_on_device = config.DATA.DIFF_ON_DEVICE if diff_on_device is None else diff_on_device
+        self.arrays = None
+        super(PackedMakeupDataset, self).__init__(config, with_pgt)
+
+    def read_names(self, config):
+        return self.index['makeup'], self.index['non-makeup']
+
+    def __getstate__(self):
+        # spawned workers map the files themselves instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def open_arrays(self):
+        # copy-on-write mapping: writable for torch.from_numpy, never written back
+        self.arrays = {key: np.load(os.path.join(self.packed_path, f'{key}.npy'), mmap_mode='c')
+                       for key in ('images', 'segs', 'lms')}
+
+    def load(self, img_name):
+        if self.arrays is None:
+            self.open_arrays()
+        row = self.rows[img_name]
+        # same values as ToTensor + Normalize in PreProcess.transform
+        image = torch.from_numpy(self.arrays['images'][row]).permute(2, 0, 1)
+        image = image.float().div_(255).sub_(0.5).div_(0.5)
+        mask = self.preprocessor.mask_process(torch.from_numpy(self.arrays['segs'][row]).unsqueeze(0))
+        lms = torch.from_numpy(self.arrays['lms'][row]).int()
+        if self.diff_on_device:
+            return [image, mask, lms]
+        return [image, mask, self.preprocessor.diff_process(lms), lms]
+
+
+class PairSampler(Sampler):
+    '''
+    Draws the (source, reference) pairs of an epoch at random, as MakeupDataset did per sample.
+    They are drawn when the epoch's iteration starts, from a seed taken from the torch rng
+    (like RandomSampler), so restoring the rng state of the epoch start draws them again;
+    `skip` then starts the epoch after its first pairs without loading them.
+    With num_replicas, every rank draws its own len(dataset) / num_replicas pairs,
+    init_distributed seeds the ranks apart.
+    '''
+    def __init__(self, dataset, num_replicas=1):
+        self.num_sources = len(dataset.non_makeup_names)
+        self.num_references = len(dataset.makeup_names)
+        self.num_samples = math.ceil(len(dataset) / num_replicas)
+        self.start = 0
+
+    def skip(self, num_samples):
+        '''
+        The next iteration leaves out the first `num_samples` pairs, e.g. to resume an epoch.
+        '''
+        self.start = num_samples
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        generator = torch.Generator().manual_seed(seed)
+        sources = torch.randint(0, self.num_sources, (self.num_samples, ), generator=generator).tolist()
+        references = torch.randint(0, self.num_references, (self.num_samples, ), generator=generator).tolist()
+        start, self.start = self.start, 0
+        return iter(list(zip(sources, references))[start:])
+
+
+def get_dataset(config):
+    if config.DATA.PACKED_PATH:
+        return PackedMakeupDataset(config)
+    return MakeupDataset(config)
+
 def get_loader(config):
-    dataset = MakeupDataset(config)
+    dataset = get_dataset(config)
     dataloader = DataLoader(dataset=dataset,
                             batch_size=config.DATA.BATCH_SIZE,
+                            sampler=PairSampler(dataset),
                             num_workers=config.DATA.NUM_WORKERS)
     return dataloader
 
@@ -50,5 +188,5 @@ if __name__ == "__main__":
     dataset = MakeupDataset()
     dataloader = DataLoader(dataset, batch_size=1, num_workers=16)
     for e in range(10):
-        for i, (point_s, point_r) in enumerate(dataloader):
+        for i, (point_s, point_r, *pgts) in enumerate(dataloader):
             pass
\ No newline at end of file
@@ -0,0 +1,110 @@
+import os
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def init_distributed(backend='gloo'):
+    """
+    Join the process group described by the torchrun environment (RANK, WORLD_SIZE, ...).
+    Without it, or with a single process, nothing is initialized.
+    return: (rank, world_size, local_rank)
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1, 0
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    rank = dist.get_rank()
+    # every rank draws its own training pairs, PairSampler draws them from the torch rng
+    torch.manual_seed(torch.initial_seed() + rank)
+    return rank, dist.get_world_size(), int(os.environ.get('LOCAL_RANK', 0))
+
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def _bucketed(tensors, bucket_mb=25):
+    bucket, size = [], 0
+    for tensor in tensors:
+        bucket.append(tensor)
+        size += tensor.numel() * tensor.element_size()
+        if size >= bucket_mb * 1024 ** 2:
+            yield bucket
+            bucket, size = [], 0
+    if bucket:
+        yield bucket
+
+
+def broadcast_parameters(module, src=0):
+    """
+    Copy the parameters and buffers of `module` on rank `src` to every rank.
+    """
+    if get_world_size() == 1:
+        return
+    tensors = [t.data for t in list(module.parameters()) + list(module.buffers())]
+    for bucket in _bucketed(tensors):
+        flat = _flatten_dense_tensors(bucket)
+        dist.broadcast(flat, src)
+        for t, synced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+            t.copy_(synced)
+
+
+def all_reduce_gradients(module):
+    """
+    Average the gradients of `module` over all ranks, call between backward and the optimizer step.
+    The generator is run several times per step through its stage methods rather than forward,
+    which DistributedDataParallel cannot follow, so the gradients are reduced here explicitly.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    grads = [p.grad.data for p in module.parameters() if p.grad is not None]
+    for bucket in _bucketed(grads):
+        flat = _flatten_dense_tensors(bucket)
+        dist.all_reduce(flat)
+        flat /= world_size
+        for g, synced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+            g.copy_(synced)
+
+
+def all_gather_object(obj):
+    """
+    return: list with the `obj` of every rank, in rank order
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return [obj]
+    objects = [None] * world_size
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def all_reduce_mean(values: dict):
+    """
+    values: dict of floats, e.g. the logged losses of this rank
+    return: dict with the mean of each value over all ranks
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return values
+    keys = list(values.keys())
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    flat = torch.tensor([float(values[k]) for k in keys], dtype=torch.float64, device=device)
+    dist.all_reduce(flat)
+    flat /= world_size
+    return dict(zip(keys, flat.tolist()))
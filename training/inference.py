@@ -6,8 +6,10 @@ import torch
 import torch.nn.functional as F
 from torchvision.transforms import ToPILImage
 
+from concern.track import span
 from training.solver import Solver
 from training.preprocess import PreProcess
+from training.optimization import compile_generator
 from models.modules.pseudo_gt import expand_area, mask_blend
 
 class InputSample:
@@ -33,6 +35,11 @@ class Inference:
         self.device = args.device
         self.solver = Solver(config, args, inference=model_path)
         self.preprocess = PreProcess(config, args.device)
+        self.compile_status = None
+        if config.MODEL.COMPILE and config.MODEL.BACKEND == 'torch':
+            self.compile_status = compile_generator(
+                self.solver.G, config.DATA.IMG_SIZE, config.MODEL.COMPILE_BATCH_SIZES,
+                config.MODEL.COMPILE_CACHE, config.MODEL.COMPILE_MODE)
         self.denoise = config.POSTPROCESS.WILL_DENOISE
         self.img_size = config.DATA.IMG_SIZE
         # TODO: can be a hyper-parameter
@@ -57,16 +64,18 @@ class Inference:
         result = np.array(result)
 
         height, width = source.shape[:2]
-        small_source = cv2.resize(source, (self.img_size, self.img_size))
-        laplacian_diff = source.astype(
-            np.float64) - cv2.resize(small_source, (width, height)).astype(np.float64)
-        result = (cv2.resize(result, (width, height)) +
-                  laplacian_diff).round().clip(0, 255)
+        with span('postprocess', crop_size=(width, height)):
+            small_source = cv2.resize(source, (self.img_size, self.img_size))
+            laplacian_diff = source.astype(
+                np.float64) - cv2.resize(small_source, (width, height)).astype(np.float64)
+            result = (cv2.resize(result, (width, height)) +
+                      laplacian_diff).round().clip(0, 255)
 
-        result = result.astype(np.uint8)
+            result = result.astype(np.uint8)
 
         if self.denoise:
-            result = cv2.fastNlMeansDenoisingColored(result)
+            with span('denoise', crop_size=(width, height)):
+                result = cv2.fastNlMeansDenoisingColored(result)
         result = Image.fromarray(result).convert('RGB')
         return result
 
@@ -194,8 +203,10 @@ class Inference:
         # Store original image for full image output
         original_source = source.copy()
         
-        source_input, face, crop_face = self.preprocess(source)
-        reference_input, _, _ = self.preprocess(reference)
+        with span('preprocess', role='source'):
+            source_input, face, crop_face = self.preprocess(source)
+        with span('preprocess', role='reference'):
+            reference_input, _, _ = self.preprocess(reference)
         if not (source_input and reference_input):
             return None if not return_full_image else (None, None)
 
@@ -204,7 +215,8 @@ class Inference:
         #result = self.interface_transfer(source_sample, reference_samples)
         source_input = self.prepare_input(*source_input)
         reference_input = self.prepare_input(*reference_input)
-        result = self.solver.test(*source_input, *reference_input)
+        with span('generator'):
+            result = self.solver.test(*source_input, *reference_input)
         
         if not postprocess:
             face_result = result
@@ -246,41 +258,55 @@ class Inference:
         original_source = source.copy()
         
         # Preprocess reference ONCE (same makeup for all faces)
-        reference_input, _, _ = self.preprocess(reference)
+        with span('preprocess', role='reference'):
+            reference_input, _, _ = self.preprocess(reference)
         if not reference_input:
             return None if not return_full_image else (None, None)
         
-        source_faces = self.preprocess.preprocess_all_faces(source)
+        with span('preprocess', role='source'):
+            source_faces = self.preprocess.preprocess_all_faces(source)
         
         if source_faces is None:
             return None if not return_full_image else (None, None)
         
-        # Single face: use existing transfer() for compatibility
+        # Single face: the same result as transfer(), reusing the detection and the reference input above
         if isinstance(source_faces, tuple):
-            return self.transfer(source, reference, postprocess, return_full_image)
+            face_data, _, crop_face = source_faces
+            source_input = self.prepare_input(*self.preprocess.process(*face_data))
+            reference_prepared = self.prepare_input(*reference_input)
+            with span('generator'):
+                result = self.solver.test(*source_input, *reference_prepared)
+            face_result = self.postprocess(source, crop_face, result) if postprocess else result
+            if not return_full_image:
+                return face_result
+            if crop_face is not None:
+                return face_result, self.paste_face_to_full_image(original_source, face_result, crop_face)
+            return face_result, face_result
         
         result_image = original_source.copy()
-        for face_data, face_on_image, crop_face in source_faces:
+        for face_index, (face_data, face_on_image, crop_face) in enumerate(source_faces):
             try:
-                processed_face = self.preprocess.process(*face_data)
-                source_input = self.prepare_input(*processed_face)
-                reference_prepared = self.prepare_input(*reference_input)
-                face_result = self.solver.test(*source_input, *reference_prepared)
+                with span('face', face=face_index):
+                    processed_face = self.preprocess.process(*face_data)
+                    source_input = self.prepare_input(*processed_face)
+                    reference_prepared = self.prepare_input(*reference_input)
+                    with span('generator'):
+                        face_result = self.solver.test(*source_input, *reference_prepared)
+                
+                    if postprocess:
+                        # For postprocessing, we need the cropped source image
+                        if crop_face is not None:
+                            cropped_source = source.crop(
+                                (crop_face.left(), crop_face.top(), crop_face.right(), crop_face.bottom()))
+                        else:
+                            cropped_source = source
+                        face_result = self.postprocess(cropped_source, crop_face, face_result)
                 
-                if postprocess:
-                    # For postprocessing, we need the cropped source image
                     if crop_face is not None:
-                        cropped_source = source.crop(
-                            (crop_face.left(), crop_face.top(), crop_face.right(), crop_face.bottom()))
+                        result_image = self.paste_face_to_full_image(result_image, face_result, crop_face)
                     else:
-                        cropped_source = source
-                    face_result = self.postprocess(cropped_source, crop_face, face_result)
-                
-                if crop_face is not None:
-                    result_image = self.paste_face_to_full_image(result_image, face_result, crop_face)
-                else:
-                    # If no crop_face, the entire image is the face
-                    result_image = face_result
+                        # If no crop_face, the entire image is the face
+                        result_image = face_result
                     
             except Exception as e:
                 # All-or-nothing: if any face fails, return None
@@ -311,8 +337,10 @@ class Inference:
         """
         original_source = source.copy()
         
-        source_input, face, crop_face = self.preprocess(source)
-        reference_input, _, _ = self.preprocess(reference)
+        with span('preprocess', role='source'):
+            source_input, face, crop_face = self.preprocess(source)
+        with span('preprocess', role='reference'):
+            reference_input, _, _ = self.preprocess(reference)
         if not (source_input and reference_input):
             return None if not return_full_image else (None, None)
 
@@ -329,7 +357,8 @@ class Inference:
                                          mask_area='eye', saturation=eye_intensity)
         ]
         
-        result = self.interface_transfer(source_sample, reference_samples)
+        with span('generator'):
+            result = self.interface_transfer(source_sample, reference_samples)
         
         if not postprocess:
             face_result = result
@@ -360,8 +389,10 @@ class Inference:
             Uses direct pixel assignment which may cause visual artifacts when processing
             overlapping faces in multi-face scenarios.
         """
-        import cv2
-        
+        with span('paste', image_size=original_image.size):
+            return self._paste_face_to_full_image(original_image, face_result, crop_face)
+
+    def _paste_face_to_full_image(self, original_image: Image, face_result: Image, crop_face):
         # Convert to numpy arrays
         original_np = np.array(original_image)
         face_result_np = np.array(face_result)
@@ -437,7 +468,8 @@ class Inference:
             return self.postprocess(source, crop_face, result)
 
     def cache_reference(self, reference: Image):
-        reference_input, _, _ = self.preprocess(reference)
+        with span('preprocess', role='reference'):
+            reference_input, _, _ = self.preprocess(reference)
         if not reference_input:
             return None
         return self.prepare_input(*reference_input)
@@ -447,7 +479,8 @@ class Inference:
             return None if not return_full_image else (None, None)
         
         original_source = source.copy()
-        source_faces = self.preprocess.preprocess_all_faces(source)
+        with span('preprocess', role='source'):
+            source_faces = self.preprocess.preprocess_all_faces(source)
         
         if source_faces is None:
             return None if not return_full_image else (None, None)
@@ -455,7 +488,8 @@ class Inference:
         if isinstance(source_faces, tuple):
             processed_face = self.preprocess.process(*source_faces[0])
             source_input = self.prepare_input(*processed_face)
-            face_result = self.solver.test(*source_input, *cached_reference)
+            with span('generator', face=0):
+                face_result = self.solver.test(*source_input, *cached_reference)
             
             crop_face = source_faces[2]
             if postprocess:
@@ -476,24 +510,26 @@ class Inference:
             return face_result, full_result
         
         result_image = original_source.copy()
-        for face_data, face_on_image, crop_face in source_faces:
+        for face_index, (face_data, face_on_image, crop_face) in enumerate(source_faces):
             try:
-                processed_face = self.preprocess.process(*face_data)
-                source_input = self.prepare_input(*processed_face)
-                face_result = self.solver.test(*source_input, *cached_reference)
+                with span('face', face=face_index):
+                    processed_face = self.preprocess.process(*face_data)
+                    source_input = self.prepare_input(*processed_face)
+                    with span('generator'):
+                        face_result = self.solver.test(*source_input, *cached_reference)
+                
+                    if postprocess:
+                        if crop_face is not None:
+                            cropped_source = source.crop(
+                                (crop_face.left(), crop_face.top(), crop_face.right(), crop_face.bottom()))
+                        else:
+                            cropped_source = source
+                        face_result = self.postprocess(cropped_source, crop_face, face_result)
                 
-                if postprocess:
                     if crop_face is not None:
-                        cropped_source = source.crop(
-                            (crop_face.left(), crop_face.top(), crop_face.right(), crop_face.bottom()))
+                        result_image = self.paste_face_to_full_image(result_image, face_result, crop_face)
                     else:
-                        cropped_source = source
-                    face_result = self.postprocess(cropped_source, crop_face, face_result)
-                
-                if crop_face is not None:
-                    result_image = self.paste_face_to_full_image(result_image, face_result, crop_face)
-                else:
-                    result_image = face_result
+                        result_image = face_result
                     
             except Exception as e:
                 print(f"Face processing failed: {e}")
@@ -0,0 +1,86 @@
+import os
+import torch
+
+try:
+    from torch.utils.tensorboard import SummaryWriter
+    TENSORBOARD_AVAILABLE = True
+except ImportError:
+    TENSORBOARD_AVAILABLE = False
+
+
+class MetricAccumulator:
+    """
+    Running sums of scalar losses, kept on the training device.
+    `add` only queues device work; the values reach the host in `means` / `flush`,
+    so reading them every N steps costs one sync instead of one per loss per step.
+    """
+    def __init__(self, names, device):
+        self.names = list(names)
+        self.device = device
+        self.sums = torch.zeros(len(self.names), dtype=torch.float64, device=device)
+        self.steps = 0
+        self._last_sums = [0.0] * len(self.names)
+        self._last_steps = 0
+
+    def add(self, values: dict):
+        '''
+        values: name -> 0-dim tensor or number, for this step; missing names count as 0
+        '''
+        step = [values.get(name, 0.0) for name in self.names]
+        step = torch.stack([torch.as_tensor(v, device=self.device).detach().to(torch.float64).reshape(())
+                            for v in step])
+        self.sums += step
+        self.steps += 1
+
+    def means(self):
+        '''
+        return: dict, name -> mean since the last reset
+        '''
+        sums = self.sums.tolist()
+        return {name: value / max(self.steps, 1) for name, value in zip(self.names, sums)}
+
+    def flush(self):
+        '''
+        return: (means since the last reset, means over the steps since the previous flush)
+        '''
+        sums = self.sums.tolist()
+        means = {name: value / max(self.steps, 1) for name, value in zip(self.names, sums)}
+        steps = max(self.steps - self._last_steps, 1)
+        window = {name: (value - last) / steps for name, value, last in zip(self.names, sums, self._last_sums)}
+        self._last_sums, self._last_steps = sums, self.steps
+        return means, window
+
+    def state_dict(self):
+        return {'names': self.names, 'sums': self.sums, 'steps': self.steps}
+
+    def load_state_dict(self, state):
+        assert list(state['names']) == self.names
+        self.sums.copy_(state['sums'])
+        self.steps = state['steps']
+        self._last_sums = self.sums.tolist()
+        self._last_steps = self.steps
+
+    def reset(self):
+        self.sums.zero_()
+        self.steps = 0
+        self._last_sums = [0.0] * len(self.names)
+        self._last_steps = 0
+
+
+class EventWriter:
+    """
+    Scalar curves as TensorBoard event files, written in the background by SummaryWriter.
+    """
+    def __init__(self, log_dir):
+        if not TENSORBOARD_AVAILABLE:
+            raise ImportError('Event files need tensorboard, install it with: pip install tensorboard')
+        os.makedirs(log_dir, exist_ok=True)
+        self.writer = SummaryWriter(log_dir)
+
+    def write(self, values: dict, step, prefix=''):
+        for name, value in values.items():
+            self.writer.add_scalar(prefix + name, value, step)
+
+    def close(self):
+        self.writer.flush()
+        self.writer.close()
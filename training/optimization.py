@@ -1,4 +1,5 @@
 import os
+import warnings
 import torch
 
 
@@ -28,3 +29,139 @@ def get_optimization_status():
         "kmp_blocktime": os.environ.get("KMP_BLOCKTIME", "not set"),
         "kmp_affinity": os.environ.get("KMP_AFFINITY", "not set")
     }
+
+
+############################## Compiled Generator ##############################
+def enable_compile_cache(cache_dir):
+    '''
+    Keep the torch.compile artifacts (FX graphs, generated kernels) in `cache_dir`,
+    so a restarted process loads them instead of compiling again.
+    return: path of the portable artifact bundle, None if this torch cannot write one
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+
+    if not hasattr(torch.compiler, "load_cache_artifacts"):
+        return None
+    bundle = os.path.join(cache_dir, "artifacts.bin")
+    if os.path.exists(bundle):
+        try:
+            with open(bundle, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+        except Exception as e:
+            warnings.warn("Ignoring unreadable compile cache {}: {}".format(bundle, e))
+    return bundle
+
+
+def save_compile_cache(bundle):
+    if bundle is None:
+        return
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None:
+        return
+    tmp_path = bundle + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(artifacts[0])
+    os.replace(tmp_path, bundle)
+
+
+def compile_errors():
+    '''
+    return: tuple of the exception types raised when compiling fails, not when the inputs are wrong:
+    dynamo's (BackendCompilerFailed is one of them), and Inductor's, e.g. a missing C++ compiler
+    '''
+    from torch._dynamo.exc import TorchDynamoException
+    errors = (TorchDynamoException,)
+    try:
+        from torch._inductor.exc import InductorError
+        errors += (InductorError,)
+    except ImportError: # torch before 2.7 wraps Inductor failures in BackendCompilerFailed
+        pass
+    return errors
+
+
+class CompiledStage:
+    """
+    A compiled Generator stage that falls back to the eager one, for good,
+    the first time compiling fails in dynamo or the compiler backend.
+    Stages are pure functions of their inputs at inference, so retrying eagerly is safe;
+    any other error, e.g. from inputs of the wrong shape, is raised as the eager stage would.
+    """
+    def __init__(self, name, eager, mode="default"):
+        self.name = name
+        self.eager = eager
+        self.compiled = torch.compile(eager, mode=mode, dynamic=False, fullgraph=False)
+        self.error = None
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except compile_errors() as e:
+                self.compiled, self.error = None, "{}: {}".format(type(e).__name__, e)
+                warnings.warn("Compiled {} failed, running it eagerly: {}".format(self.name, self.error))
+        return self.eager(*args, **kwargs)
+
+
+def generator_example_inputs(image_size, batch_size=1, device="cpu", seed=0):
+    '''
+    Synthetic (image, mask, diff, lms) in the layout Inference.prepare_input produces,
+    for warming up, tracing and checking the Generator stages.
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    image = torch.rand(batch_size, 3, image_size, image_size, generator=generator) * 2 - 1
+    # lip box inside a face box, so the attention masks bias some pairs and not others
+    mask = torch.zeros(batch_size, 2, image_size, image_size)
+    lo, hi = image_size // 8, image_size - image_size // 8
+    mask[:, 1, lo:hi, lo:hi] = 1
+    mask[:, 0, image_size * 5 // 8:image_size * 3 // 4, image_size * 3 // 8:image_size * 5 // 8] = 1
+    mask[:, 1] *= 1 - mask[:, 0]
+    # 68 distinct landmarks on a jittered lattice keep the TPS system well conditioned
+    ys, xs = torch.meshgrid(torch.linspace(0.25, 0.75, 9), torch.linspace(0.25, 0.75, 8), indexing="ij")
+    lattice = torch.stack([ys.reshape(-1), xs.reshape(-1)], dim=1)[:68] * (image_size - 1)
+    lms = (lattice + (torch.rand(batch_size, 68, 2, generator=generator) - 0.5) * image_size / 64).round()
+    # as PreProcess.diff_process, without building a PreProcess
+    ys, xs = torch.meshgrid(torch.arange(image_size, dtype=torch.float32),
+                            torch.arange(image_size, dtype=torch.float32), indexing="ij")
+    fix = torch.cat([ys.expand(68, -1, -1), xs.expand(68, -1, -1)], dim=0) # (136, h, w)
+    diff = fix - lms.transpose(-1, -2).reshape(batch_size, -1, 1, 1)
+    return [x.to(device) for x in (image, mask, diff, lms)]
+
+
+def warmup_generator(G, image_size, batch_sizes, device):
+    '''
+    Run the three stages once per batch size on synthetic inputs,
+    so compiling happens at start-up instead of on the first requests.
+    '''
+    with torch.no_grad():
+        for b in batch_sizes:
+            inputs = generator_example_inputs(image_size, b, device)
+            input_c = G.get_transfer_input(*inputs)
+            input_s = G.get_transfer_input(*inputs, True)
+            attn_out_list = G.get_transfer_output(*input_c, *input_s)
+            G.decode(input_c[0], attn_out_list)
+
+
+def compile_generator(G, image_size, batch_sizes=(1,), cache_dir=None, mode="default"):
+    '''
+    Compile the encode / transfer / decode stages of an eval-mode Generator in place.
+    The stages are specialized to `image_size` and each of `batch_sizes` (warmed up here);
+    other batch sizes compile on first use. Spans and autocast stay outside the compiled code.
+    return: dict, stage -> 'compiled' or the error that made it fall back to eager
+    '''
+    bundle = enable_compile_cache(cache_dir) if cache_dir else None
+    stages = {}
+    for name in ("_get_transfer_input", "_get_transfer_output", "_decode"):
+        stages[name] = CompiledStage(name.lstrip("_"), getattr(G, name), mode)
+        setattr(G, name, stages[name])
+
+    device = next(G.parameters()).device
+    warmup_generator(G, image_size, batch_sizes, device)
+    try:
+        save_compile_cache(bundle)
+    except Exception as e:
+        warnings.warn("Could not save the compile cache: {}".format(e))
+    return {stage.name: stage.error or "compiled" for stage in stages.values()}
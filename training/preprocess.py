@@ -10,6 +10,7 @@ from torchvision.transforms import functional
 sys.path.append('.')
 
 import faceutils as futils
+from concern.track import span
 from training.config import get_config
 
 class PreProcess:
@@ -33,7 +34,15 @@ class PreProcess:
         fix = np.concatenate([ys, xs], axis=0) 
         self.fix = torch.Tensor(fix) #(136, h, w)
         if need_parser:
-            self.face_parse = futils.mask.FaceParser(device=device)
+            self.face_parse = futils.mask.FaceParser(
+                device=device, channels_last=config.MODEL.CHANNELS_LAST, input_size=config.PREPROCESS.PARSER_SIZE,
+                fuse_bn=config.PREPROCESS.PARSER_FUSE_BN, weights=config.PREPROCESS.PARSER_WEIGHTS)
+        self.parser_batch_size = config.PREPROCESS.PARSER_BATCH_SIZE
+        # detectors are built on the first detect; the datasets and the solver never detect,
+        # and need no detector model files
+        self.detector_config = config
+        self._detector = None
+        self._group_detector = None
 
         self.up_ratio    = config.PREPROCESS.UP_RATIO
         self.down_ratio  = config.PREPROCESS.DOWN_RATIO
@@ -85,7 +94,7 @@ class PreProcess:
     
     ############################## Landmarks Process ##############################
     def lms_process(self, image:Image):
-        face = futils.dlib.detect(image)
+        face = self.detector.detect(image)
         # face: rectangles, List of rectangles of face region: [(left, top), (right, bottom)]
         if not face:
             return None
@@ -107,13 +116,15 @@ class PreProcess:
     
     def diff_process(self, lms: torch.Tensor, normalize=False):
         '''
-        lms:(68, 2)
+        lms:(68, 2), or (b, 68, 2) for a batch, on any device
         '''
-        lms = lms.transpose(1, 0).reshape(-1, 1, 1) # (136, 1, 1)
-        diff = self.fix - lms # (136, h, w)
+        if self.fix.device != lms.device:
+            self.fix = self.fix.to(lms.device)
+        lms = lms.transpose(-1, -2).reshape(*lms.shape[:-2], -1, 1, 1) # ([b,] 136, 1, 1)
+        diff = self.fix - lms # ([b,] 136, h, w)
 
         if normalize:
-            norm = torch.norm(diff, dim=0, keepdim=True).repeat(diff.shape[0], 1, 1)
+            norm = torch.norm(diff, dim=-3, keepdim=True).expand_as(diff)
             norm = torch.where(norm == 0, torch.tensor(1e10), norm)
             diff /= norm
         return diff
@@ -126,12 +137,58 @@ class PreProcess:
         lms = np.load(path)
         return torch.IntTensor(lms)
 
+    ############################## Parsing ##############################
+    def parse_faces(self, images):
+        '''
+        images: list of cropped faces, Image
+        return: list of masks, tensor, (1, H, W); the faces are parsed parser_batch_size at a time
+        '''
+        size = self.face_parse.input_size
+        masks = []
+        for i in range(0, len(images), self.parser_batch_size):
+            batch = [cv2.resize(np.array(image), (size, size)) for image in images[i:i + self.parser_batch_size]]
+            masks.append(self.face_parse.parse_batch(batch).cpu())
+        # mask: Tensor, (N, size, size)
+        masks = F.interpolate(
+            torch.cat(masks).unsqueeze(1),
+            (self.img_size, self.img_size),
+            mode="nearest").long() #(N, 1, H, W)
+        return list(masks)
+
+    ############################## Detection ##############################
+    @property
+    def detector(self):
+        if self._detector is None:
+            self._detector = futils.detector.get_detector(self.detector_config)
+        return self._detector
+
+    @property
+    def group_detector(self):
+        name = self.detector_config.PREPROCESS.GROUP_DETECTOR
+        if not name:
+            return self.detector
+        if self._group_detector is None:
+            self._group_detector = futils.detector.get_detector(self.detector_config, name)
+        return self._group_detector
+
+    def detect(self, image: Image, group=False):
+        '''
+        group: use the group photo detector, for images whose faces are all transferred
+        return: faces: rectangles, in image coordinates
+        '''
+        detector = self.group_detector if group else self.detector
+        with span('detect', image_size=image.size, detector=detector.name) as s:
+            faces = detector.detect(image)
+            s.tag(faces=len(faces))
+        return faces
+
     ############################## Compose Process ##############################
-    def preprocess(self, image: Image, is_crop=True):
+    def preprocess(self, image: Image, is_crop=True, faces=None):
         '''
+        faces: detections of image from detect, detected here if None
         return: image: Image, (H, W), mask: tensor, (1, H, W)
         '''
-        face = futils.dlib.detect(image)
+        face = self.detect(image) if faces is None else faces
         # face: rectangles, List of rectangles of face region: [(left, top), (right, bottom)]
         if not face:
             return None, None, None
@@ -145,17 +202,11 @@ class PreProcess:
         # image: Image, cropped face
         # face: the same as above
         # crop face: rectangle, face region in cropped face
-        np_image = np.array(image) # (h', w', 3)
-
-        mask = self.face_parse.parse(cv2.resize(np_image, (512, 512))).cpu()
-        # obtain face parsing result
-        # mask: Tensor, (512, 512)
-        mask = F.interpolate(
-            mask.view(1, 1, 512, 512),
-            (self.img_size, self.img_size),
-            mode="nearest").squeeze(0).long() #(1, H, W)
+        with span('parse', crop_size=image.size):
+            mask = self.parse_faces([image])[0] #(1, H, W)
 
-        lms = futils.dlib.landmarks(image, face) * self.img_size / image.width # scale to fit self.img_size
+        with span('landmarks'):
+            lms = futils.dlib.landmarks(image, face) * self.img_size / image.width # scale to fit self.img_size
         # lms: narray, the position of 68 key points, (68 ,2)
         lms = torch.IntTensor(lms.round()).clamp_max_(self.img_size - 1)
         # distinguish upper and lower lips 
@@ -184,17 +235,17 @@ class PreProcess:
             - If multiple faces in reference image, only first face's makeup is used
             - Overlapping faces may have blending artifacts
         """
-        faces = futils.dlib.detect(image)
+        faces = self.detect(image, group=True)
         
         if not faces:
             return None
         
         if len(faces) == 1:
-            # Backward compatible: single face uses existing path
-            return self.preprocess(image, is_crop)
+            # Backward compatible: single face uses existing path, without detecting again
+            return self.preprocess(image, is_crop, faces)
         
-        results = []
-        for face_on_image in faces:
+        crops = []
+        for face_index, face_on_image in enumerate(faces):
             if is_crop:
                 cropped_image, face, crop_face = futils.dlib.crop(
                     image, face_on_image, self.up_ratio, self.down_ratio, self.width_ratio)
@@ -202,21 +253,19 @@ class PreProcess:
                 cropped_image = image
                 face = face_on_image
                 crop_face = None
-            
             # image: Image, cropped face
             # face: the same as above
             # crop face: rectangle, face region in cropped face
-            np_image = np.array(cropped_image)  # (h', w', 3)
-            
-            mask = self.face_parse.parse(cv2.resize(np_image, (512, 512))).cpu()
-            # obtain face parsing result
-            # mask: Tensor, (512, 512)
-            mask = F.interpolate(
-                mask.view(1, 1, 512, 512),
-                (self.img_size, self.img_size),
-                mode="nearest").squeeze(0).long()  # (1, H, W)
-            
-            lms = futils.dlib.landmarks(cropped_image, face) * self.img_size / cropped_image.width  # scale to fit self.img_size
+            crops.append((cropped_image, face, crop_face))
+
+        # all faces go through the parser together
+        with span('parse', faces=len(crops)):
+            masks = self.parse_faces([cropped_image for cropped_image, _, _ in crops])
+
+        results = []
+        for face_index, (face_on_image, (cropped_image, face, crop_face), mask) in enumerate(zip(faces, crops, masks)):
+            with span('landmarks', face=face_index):
+                lms = futils.dlib.landmarks(cropped_image, face) * self.img_size / cropped_image.width  # scale to fit self.img_size
             # lms: narray, the position of 68 key points, (68, 2)
             lms = torch.IntTensor(lms.round()).clamp_max_(self.img_size - 1)
             # distinguish upper and lower lips
@@ -233,9 +282,10 @@ class PreProcess:
         return results
     
     def process(self, image: Image, mask: torch.Tensor, lms: torch.Tensor):
-        image = self.transform(image)
-        mask = self.mask_process(mask)
-        diff = self.diff_process(lms)
+        with span('process'):
+            image = self.transform(image)
+            mask = self.mask_process(mask)
+            diff = self.diff_process(lms)
         return [image, mask, diff, lms]
     
     def __call__(self, image:Image, is_crop=True):
@@ -246,33 +296,6 @@ class PreProcess:
 
 
 if __name__ == "__main__":
-    config = get_config()
-    preprocessor = PreProcess(config, device='cuda:0')
-    if not os.path.exists(os.path.join(config.DATA.PATH, 'lms')):
-        os.makedirs(os.path.join(config.DATA.PATH, 'lms', 'makeup'))
-        os.makedirs(os.path.join(config.DATA.PATH, 'lms', 'non-makeup'))
-    
-    # process makeup images
-    print("Processing makeup images...")
-    with open(os.path.join(config.DATA.PATH, 'makeup.txt'), 'r') as f:
-        for line in f.readlines():
-            img_name = line.strip()
-            raw_image = Image.open(os.path.join(config.DATA.PATH, 'images', img_name)).convert('RGB')
-            lms = preprocessor.lms_process(raw_image)
-            if lms is not None:
-                base_name = os.path.splitext(img_name)[0]
-                preprocessor.save_lms(lms, os.path.join(config.DATA.PATH, 'lms', f'{base_name}.npy'))
-    print("Done.")
-
-    # process non-makeup images
-    print("Processing non-makeup images...")
-    with open(os.path.join(config.DATA.PATH, 'non-makeup.txt'), 'r') as f:
-        for line in f.readlines():
-            img_name = line.strip()
-            raw_image = Image.open(os.path.join(config.DATA.PATH, 'images', img_name)).convert('RGB')
-            lms = preprocessor.lms_process(raw_image)
-            if lms is not None:
-                base_name = os.path.splitext(img_name)[0]
-                preprocessor.save_lms(lms, os.path.join(config.DATA.PATH, 'lms', f'{base_name}.npy'))
-    print("Done.")
-    
\ No newline at end of file
+    # writes lms/ and segs/ in parallel and resumes interrupted runs, see the script for options
+    from scripts.preprocess_dataset import main
+    main()
@@ -11,18 +11,40 @@ from tqdm import tqdm
 
 from models.modules.pseudo_gt import expand_area
 from models.model import get_discriminator, get_generator, vgg16
+from models.elegant import swap_transfer_input
 from models.loss import GANLoss, MakeupLoss, ComposePGT, AnnealingComposePGT
-
+from models.onnx_stages import OnnxGenerator
+from models.quantization import is_quantized_checkpoint, load_quantized_generator
+
+from training.checkpoint import CheckpointWriter, get_rng_state, set_rng_state
+from training.distributed import all_gather_object, all_reduce_gradients, all_reduce_mean, broadcast_parameters, \
+    get_rank, get_world_size
+from training.metrics import MetricAccumulator, EventWriter
+from training.preprocess import PreProcess
 from training.utils import plot_curves
 
 class Solver():
     def __init__(self, config, args, logger=None, inference=False):
+        if inference and config.MODEL.BACKEND == 'onnxruntime':
+            # the stages exported by scripts/export_onnx.py replace the torch weights
+            if torch.device(args.device).type != 'cpu':
+                raise ValueError('The onnxruntime backend runs on the CPU, got device {}'.format(args.device))
+            self.G = OnnxGenerator(config.MODEL.ONNX_DIR, torch.get_num_threads())
+            return
         self.G = get_generator(config)
         if inference:
-            self.G.load_state_dict(torch.load(inference, map_location=args.device, weights_only=False))
+            state = torch.load(inference, map_location='cpu', weights_only=False)
+            if is_quantized_checkpoint(state):
+                # written by scripts/quantize_generator.py
+                if torch.device(args.device).type != 'cpu':
+                    raise ValueError('Quantized generators run on the CPU, got device {}'.format(args.device))
+                self.G = load_quantized_generator(self.G, state)
+            else:
+                self.G.load_state_dict(state)
             self.G = self.G.to(args.device).eval()
             return
         self.double_d = config.TRAINING.DOUBLE_D
+        self.channels_last = config.MODEL.CHANNELS_LAST
         self.D_A = get_discriminator(config)
         if self.double_d:
             self.D_B = get_discriminator(config)
@@ -30,10 +52,18 @@ class Solver():
         self.load_folder = args.load_folder
         self.save_folder = args.save_folder
         self.vis_folder = os.path.join(args.save_folder, 'visualization')
-        if not os.path.exists(self.vis_folder):
+        # with distributed training only rank 0 logs, visualizes and saves checkpoints
+        self.rank, self.world_size = get_rank(), get_world_size()
+        self.is_main = self.rank == 0
+        if self.is_main and not os.path.exists(self.vis_folder):
             os.makedirs(self.vis_folder)
         self.vis_freq = config.LOG.VIS_FREQ
         self.save_freq = config.LOG.SAVE_FREQ
+        self.flush_freq = config.LOG.FLUSH_FREQ
+        self.event_file = config.LOG.EVENT_FILE
+        self.checkpoint_freq = config.LOG.CHECKPOINT_FREQ
+        self.checkpointer = CheckpointWriter(os.path.join(args.save_folder, 'checkpoints'), config.LOG.CHECKPOINT_KEEP)
+        self.resume = getattr(args, 'resume', None)
 
         # Data & PGT
         self.img_size = config.DATA.IMG_SIZE
@@ -53,6 +83,9 @@ class Solver():
                 config.PGT.LIP_ALPHA
             )
         self.pgt_maker.eval()
+        # packed datasets may leave diff to be built here, on the training device
+        if config.DATA.DIFF_ON_DEVICE:
+            self.diff_maker = PreProcess(config, need_parser=False)
 
         # Hyper-param
         self.num_epochs = config.TRAINING.NUM_EPOCHS
@@ -142,27 +175,74 @@ class Solver():
                     T_max=self.num_epochs, eta_min=self.d_lr * self.lr_decay_factor)
 
         # Print networks
-        self.print_network(self.G, 'G')
-        self.print_network(self.D_A, 'D_A')
-        if self.double_d: self.print_network(self.D_B, 'D_B')
+        if self.is_main:
+            self.print_network(self.G, 'G')
+            self.print_network(self.D_A, 'D_A')
+            if self.double_d: self.print_network(self.D_B, 'D_B')
 
         self.G.to(self.device)
         self.vgg.to(self.device)
+        if self.channels_last:
+            self.vgg.to(memory_format=torch.channels_last)
         self.D_A.to(self.device)
         if self.double_d: self.D_B.to(self.device)
 
+        # start every rank from the weights of rank 0, the vgg is pretrained and frozen
+        broadcast_parameters(self.G)
+        broadcast_parameters(self.D_A)
+        if self.double_d: broadcast_parameters(self.D_B)
+
+    def add_diff(self, sample):
+        image, mask, lms = sample
+        lms = lms.to(self.device)
+        return [image, mask, self.diff_maker.diff_process(lms), lms]
+
     def train(self, data_loader):
         self.len_dataset = len(data_loader)
+        # losses stay on the device and are read every flush_freq steps and at epoch end
+        metrics = MetricAccumulator(self.loss_logger.keys(), self.device)
+        event_writer = None
+        if self.is_main and self.event_file:
+            event_writer = EventWriter(os.path.join(self.save_folder, 'events'))
+
+        self.global_step = 0
+        start_epoch, skip_steps, resume_state = 1, 0, None
+        if self.resume:
+            resume_state = self.load_training_state(self.resume)
+            start_epoch, skip_steps = resume_state['epoch'], resume_state['step']
         
-        for self.epoch in range(1, self.num_epochs + 1):
+        for self.epoch in range(start_epoch, self.num_epochs + 1):
             self.start_time = time.time()
-            loss_tmp = self.get_loss_tmp()
+            metrics.reset()
+            if resume_state is not None and skip_steps > 0:
+                # the sampler draws the pairs of the interrupted epoch again, see the step loop
+                set_rng_state(resume_state['epoch_rng'])
+                metrics.load_state_dict(resume_state['metrics'])
+            elif resume_state is not None:
+                set_rng_state(resume_state['rng'])
+            # sampling is random, the rng state at the start of the epoch determines its batches
+            self.epoch_rng = get_rng_state()
             self.G.train(); self.D_A.train(); 
             if self.double_d: self.D_B.train()
-            losses_G = []; losses_D_A = []; losses_D_B = []
+            # workers making the pgt need this epoch's alphas before the first batch is fetched
+            if getattr(data_loader.dataset, 'with_pgt', False):
+                data_loader.dataset.set_pgt_alphas(self.pgt_maker.blend_alphas)
+            if hasattr(data_loader.sampler, 'set_epoch'):
+                data_loader.sampler.set_epoch(self.epoch)
+            if skip_steps > 0:
+                # the steps trained before the checkpoint are not loaded again
+                if not hasattr(data_loader.sampler, 'skip'):
+                    raise ValueError('resuming mid-epoch needs a data loader with a PairSampler')
+                data_loader.sampler.skip(skip_steps * data_loader.batch_size)
             
-            with tqdm(data_loader, desc="training") as pbar:
-                for step, (source, reference) in enumerate(pbar):
+            with tqdm(data_loader, desc="training", initial=skip_steps, disable=not self.is_main) as pbar:
+                for step, (source, reference, *pgts) in enumerate(pbar, skip_steps):
+                    if skip_steps > 0 and step == skip_steps:
+                        # the pairs are drawn once the first batch is fetched, training goes on from the saved rng
+                        set_rng_state(resume_state['rng'])
+                    # image, mask, [diff,] lms
+                    if len(source) == 3:
+                        source, reference = self.add_diff(source), self.add_diff(reference)
                     # image, mask, diff, lms
                     image_s, image_r = source[0].to(self.device), reference[0].to(self.device) # (b, c, h, w)
                     mask_s_full, mask_r_full = source[1].to(self.device), reference[1].to(self.device) # (b, c', h, w) 
@@ -175,12 +255,29 @@ class Solver():
                     #mask_s = mask_s_full[:,:2]; mask_r = mask_r_full[:,:2]
 
                     # ================= Generate ================== #
-                    fake_A = self.G(image_s, image_r, mask_s, mask_r, diff_s, diff_r, lms_s, lms_r)
-                    fake_B = self.G(image_r, image_s, mask_r, mask_s, diff_r, diff_s, lms_r, lms_s)
+                    # encode A and B once, batched, and share the encodings between the
+                    # fake, identity and cycle passes; G is not updated until the G step
+                    # and every layer works per sample, so the results are unchanged
+                    b = image_s.shape[0]
+                    image_sr = torch.cat((image_s, image_r), dim=0)
+                    mask_sr = torch.cat((mask_s, mask_r), dim=0)
+                    diff_sr = torch.cat((diff_s, diff_r), dim=0)
+                    lms_sr = torch.cat((lms_s, lms_r), dim=0)
+                    input_c = self.G.get_transfer_input(image_sr, mask_sr, diff_sr, lms_sr)
+                    if self.G.double_encoder:
+                        input_s = self.G.get_transfer_input(image_sr, mask_sr, diff_sr, lms_sr, True)
+                    else:
+                        input_s = input_c
+
+                    # fake_A: content A, style B; fake_B: content B, style A
+                    fake_A, fake_B = self.G.transfer(input_c, swap_transfer_input(input_s)).split(b, dim=0)
 
                     # generate pseudo ground truth
-                    pgt_A = self.pgt_maker(image_s, image_r, mask_s_full, mask_r_full, lms_s, lms_r)
-                    pgt_B = self.pgt_maker(image_r, image_s, mask_r_full, mask_s_full, lms_r, lms_s)
+                    if pgts:
+                        pgt_A, pgt_B = pgts[0].to(self.device), pgts[1].to(self.device)
+                    else:
+                        pgt_A = self.pgt_maker(image_s, image_r, mask_s_full, mask_r_full, lms_s, lms_r)
+                        pgt_B = self.pgt_maker(image_r, image_s, mask_r_full, mask_s_full, lms_r, lms_s)
                     
                     # ================== Train D ================== #
                     # training D_A, D_A aims to distinguish class B
@@ -195,12 +292,11 @@ class Solver():
                     d_loss = (d_loss_real + d_loss_fake) * 0.5
                     self.d_A_optimizer.zero_grad()
                     d_loss.backward()
+                    all_reduce_gradients(self.D_A)
                     self.d_A_optimizer.step()                   
 
                     # Logging
-                    loss_tmp['D-A-loss_real'] += d_loss_real.item()
-                    loss_tmp['D-A-loss_fake'] += d_loss_fake.item()
-                    losses_D_A.append(d_loss.item())
+                    step_losses = {'D-A-loss_real': d_loss_real, 'D-A-loss_fake': d_loss_fake, 'D-A-loss': d_loss}
 
                     # training D_B, D_B aims to distinguish class A
                     # Real
@@ -221,22 +317,21 @@ class Solver():
                     if self.double_d:
                         self.d_B_optimizer.zero_grad()
                         d_loss.backward()
+                        all_reduce_gradients(self.D_B)
                         self.d_B_optimizer.step()
                     else:
                         self.d_A_optimizer.zero_grad()
                         d_loss.backward()
+                        all_reduce_gradients(self.D_A)
                         self.d_A_optimizer.step()
 
                     # Logging
-                    loss_tmp['D-B-loss_real'] += d_loss_real.item()
-                    loss_tmp['D-B-loss_fake'] += d_loss_fake.item()
-                    losses_D_B.append(d_loss.item())
+                    step_losses.update({'D-B-loss_real': d_loss_real, 'D-B-loss_fake': d_loss_fake, 'D-B-loss': d_loss})
 
                     # ================== Train G ================== #
                     
                     # G should be identity if ref_B or org_A is fed
-                    idt_A = self.G(image_s, image_s, mask_s, mask_s, diff_s, diff_s, lms_s, lms_s)
-                    idt_B = self.G(image_r, image_r, mask_r, mask_r, diff_r, diff_r, lms_r, lms_r)
+                    idt_A, idt_B = self.G.transfer(input_c, input_s).split(b, dim=0)
                     loss_idt_A = self.criterionL1(idt_A, image_s) * self.lambda_A * self.lambda_idt
                     loss_idt_B = self.criterionL1(idt_B, image_r) * self.lambda_B * self.lambda_idt
                     # loss_idt
@@ -278,8 +373,8 @@ class Solver():
                     g_B_loss_pgt += g_B_skin_loss_pgt
                     
                     # cycle loss
-                    rec_A = self.G(fake_A, image_s, mask_s, mask_s, diff_s, diff_s, lms_s, lms_s)
-                    rec_B = self.G(fake_B, image_r, mask_r, mask_r, diff_r, diff_r, lms_r, lms_r)
+                    input_fake = self.G.get_transfer_input(torch.cat((fake_A, fake_B), dim=0), mask_sr, diff_sr, lms_sr)
+                    rec_A, rec_B = self.G.transfer(input_fake, input_s).split(b, dim=0)
 
                     # cycle loss v2
                     # rec_A = self.G(fake_A, fake_B, mask_s, mask_r, diff_s, diff_r, lms_s, lms_r)
@@ -304,31 +399,45 @@ class Solver():
 
                     self.g_optimizer.zero_grad()
                     g_loss.backward()
+                    all_reduce_gradients(self.G)
                     self.g_optimizer.step()
 
                     # Logging
-                    loss_tmp['G-A-loss-adv'] += g_A_loss_adv.item()
-                    loss_tmp['G-B-loss-adv'] += g_B_loss_adv.item()
-                    loss_tmp['G-loss-idt'] += loss_idt.item()
-                    loss_tmp['G-loss-img-rec'] += (g_loss_rec_A + g_loss_rec_B).item() * 0.5
-                    loss_tmp['G-loss-vgg-rec'] += (g_loss_A_vgg + g_loss_B_vgg).item() * 0.5
-                    loss_tmp['G-loss-rec'] += loss_rec.item()
-                    loss_tmp['G-loss-skin-pgt'] += (g_A_skin_loss_pgt + g_B_skin_loss_pgt).item()
-                    loss_tmp['G-loss-eye-pgt'] += (g_A_eye_loss_pgt + g_B_eye_loss_pgt).item()
-                    loss_tmp['G-loss-lip-pgt'] += (g_A_lip_loss_pgt + g_B_lip_loss_pgt).item()
-                    loss_tmp['G-loss-pgt'] += (g_A_loss_pgt + g_B_loss_pgt).item()
-                    losses_G.append(g_loss.item())
-                    pbar.set_description("Epoch: %d, Step: %d, Loss_G: %0.4f, Loss_A: %0.4f, Loss_B: %0.4f" % \
-                                (self.epoch, step + 1, np.mean(losses_G), np.mean(losses_D_A), np.mean(losses_D_B)))
+                    step_losses.update({
+                        'G-A-loss-adv': g_A_loss_adv,
+                        'G-B-loss-adv': g_B_loss_adv,
+                        'G-loss-idt': loss_idt,
+                        'G-loss-img-rec': (g_loss_rec_A + g_loss_rec_B) * 0.5,
+                        'G-loss-vgg-rec': (g_loss_A_vgg + g_loss_B_vgg) * 0.5,
+                        'G-loss-rec': loss_rec,
+                        'G-loss-skin-pgt': g_A_skin_loss_pgt + g_B_skin_loss_pgt,
+                        'G-loss-eye-pgt': g_A_eye_loss_pgt + g_B_eye_loss_pgt,
+                        'G-loss-lip-pgt': g_A_lip_loss_pgt + g_B_lip_loss_pgt,
+                        'G-loss-pgt': g_A_loss_pgt + g_B_loss_pgt,
+                        'G-loss': g_loss
+                    })
+                    metrics.add(step_losses)
+                    if self.is_main and ((step + 1) % self.flush_freq == 0 or step + 1 == self.len_dataset):
+                        means, window = metrics.flush()
+                        pbar.set_description("Epoch: %d, Step: %d, Loss_G: %0.4f, Loss_A: %0.4f, Loss_B: %0.4f" % \
+                                    (self.epoch, step + 1, means['G-loss'], means['D-A-loss'], means['D-B-loss']))
+                        if event_writer is not None:
+                            event_writer.write(window, (self.epoch - 1) * self.len_dataset + step + 1, 'step/')
+
+                    self.global_step += 1
+                    # the last step of an epoch is covered by the checkpoint at the end of the epoch
+                    if self.checkpoint_freq and self.global_step % self.checkpoint_freq == 0 \
+                            and step + 1 < self.len_dataset:
+                        self.save_checkpoint(metrics, self.epoch, step + 1)
 
             self.end_time = time.time()
-            for k, v in loss_tmp.items():
-                loss_tmp[k] = v / self.len_dataset  
-            loss_tmp['G-loss'] = np.mean(losses_G)
-            loss_tmp['D-A-loss'] = np.mean(losses_D_A)
-            loss_tmp['D-B-loss'] = np.mean(losses_D_B)
-            self.log_loss(loss_tmp)
-            self.plot_loss()
+            loss_tmp = all_reduce_mean(metrics.means())
+            if self.is_main:
+                self.log_loss(loss_tmp)
+                if event_writer is not None:
+                    event_writer.write(loss_tmp, self.epoch, 'epoch/')
+                if event_writer is None or self.epoch == self.num_epochs:
+                    self.plot_loss()
 
             # Decay learning rate
             self.g_scheduler.step()
@@ -340,7 +449,7 @@ class Solver():
                 self.pgt_maker.step()
 
             #save the images
-            if (self.epoch) % self.vis_freq == 0:
+            if self.is_main and (self.epoch) % self.vis_freq == 0:
                 self.vis_train([image_s.detach().cpu(), 
                                 image_r.detach().cpu(), 
                                 fake_A.detach().cpu(), 
@@ -348,28 +457,16 @@ class Solver():
             #                   rec_A.detach().cpu()])
 
             # Save model checkpoints
-            if (self.epoch) % self.save_freq == 0:
+            if self.is_main and (self.epoch) % self.save_freq == 0:
                 self.save_models()
-   
 
-    def get_loss_tmp(self):
-        loss_tmp = {
-            'D-A-loss_real':0.0,
-            'D-A-loss_fake':0.0,
-            'D-B-loss_real':0.0,
-            'D-B-loss_fake':0.0,
-            'G-A-loss-adv':0.0,
-            'G-B-loss-adv':0.0,
-            'G-loss-idt':0.0,
-            'G-loss-img-rec':0.0,
-            'G-loss-vgg-rec':0.0,
-            'G-loss-rec':0.0,
-            'G-loss-skin-pgt':0.0,
-            'G-loss-eye-pgt':0.0,
-            'G-loss-lip-pgt':0.0,
-            'G-loss-pgt':0.0,
-        }
-        return loss_tmp
+            skip_steps, resume_state = 0, None
+            self.save_checkpoint(metrics, self.epoch + 1, 0)
+
+        self.checkpointer.wait()
+        if event_writer is not None:
+            event_writer.close()
+   
 
     def log_loss(self, loss_tmp):
         if self.logger is not None:
@@ -427,10 +524,82 @@ class Solver():
         save_dir = os.path.join(self.save_folder, 'epoch_{:d}'.format(self.epoch))
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
-        torch.save(self.G.state_dict(), os.path.join(save_dir, 'G.pth'))
-        torch.save(self.D_A.state_dict(), os.path.join(save_dir, 'D_A.pth'))
+        files = {os.path.join(save_dir, 'G.pth'): self.G.state_dict(),
+                 os.path.join(save_dir, 'D_A.pth'): self.D_A.state_dict()}
+        if self.double_d:
+            files[os.path.join(save_dir, 'D_B.pth')] = self.D_B.state_dict()
+        self.checkpointer.save_files(files)
+
+    def training_state(self):
+        state = {
+            'G': self.G.state_dict(),
+            'D_A': self.D_A.state_dict(),
+            'g_optimizer': self.g_optimizer.state_dict(),
+            'd_A_optimizer': self.d_A_optimizer.state_dict(),
+            'g_scheduler': self.g_scheduler.state_dict(),
+            'd_A_scheduler': self.d_A_scheduler.state_dict(),
+            'pgt_maker': self.pgt_maker.state_dict(),
+            'loss_logger': {k: list(v) for k, v in self.loss_logger.items()}
+        }
+        if self.double_d:
+            state.update({'D_B': self.D_B.state_dict(),
+                          'd_B_optimizer': self.d_B_optimizer.state_dict(),
+                          'd_B_scheduler': self.d_B_scheduler.state_dict()})
+        return state
+
+    def save_checkpoint(self, metrics, epoch, step):
+        '''
+        Full training state to resume `epoch` after its first `step` steps.
+        Called by every rank, the rng states of all ranks are stored; rank 0 writes.
+        '''
+        rng = all_gather_object({'rng': get_rng_state(), 'epoch_rng': self.epoch_rng})
+        if not self.is_main:
+            return
+        state = self.training_state()
+        state.update({
+            'epoch': epoch,
+            'step': step,
+            'global_step': self.global_step,
+            'metrics': metrics.state_dict(),
+            'rng': [r['rng'] for r in rng],
+            'epoch_rng': [r['epoch_rng'] for r in rng]
+        })
+        self.checkpointer.save(state, self.global_step)
+
+    def load_training_state(self, path):
+        '''
+        path: checkpoint written by save_checkpoint, or 'latest'
+        return: dict with 'epoch', 'step', 'metrics' and this rank's 'rng' / 'epoch_rng'
+        '''
+        if path == 'latest':
+            path = self.checkpointer.latest()
+            if path is None:
+                raise FileNotFoundError('No checkpoint in {}'.format(self.checkpointer.folder))
+        state = torch.load(path, map_location='cpu', weights_only=True)
+        self.G.load_state_dict(state['G'])
+        self.D_A.load_state_dict(state['D_A'])
+        self.g_optimizer.load_state_dict(state['g_optimizer'])
+        self.d_A_optimizer.load_state_dict(state['d_A_optimizer'])
+        self.g_scheduler.load_state_dict(state['g_scheduler'])
+        self.d_A_scheduler.load_state_dict(state['d_A_scheduler'])
         if self.double_d:
-            torch.save(self.D_B.state_dict(), os.path.join(save_dir, 'D_B.pth'))
+            self.D_B.load_state_dict(state['D_B'])
+            self.d_B_optimizer.load_state_dict(state['d_B_optimizer'])
+            self.d_B_scheduler.load_state_dict(state['d_B_scheduler'])
+        self.pgt_maker.load_state_dict(state['pgt_maker'])
+        self.loss_logger = state['loss_logger']
+        self.global_step = state['global_step']
+
+        rng, epoch_rng = None, None
+        if len(state['rng']) == self.world_size:
+            rng, epoch_rng = state['rng'][self.rank], state['epoch_rng'][self.rank]
+        if rng is None:
+            # another number of processes: the rng states do not apply, the data order will differ
+            print('checkpoint {} was written by {:d} processes, resuming with {:d}'.format(
+                path, len(state['rng']), self.world_size))
+        print('resuming from {} (epoch {:d}, step {:d})..!'.format(path, state['epoch'], state['step']))
+        return {'epoch': state['epoch'], 'step': state['step'], 'metrics': state['metrics'],
+                'rng': rng, 'epoch_rng': epoch_rng}
 
     def de_norm(self, x):
         out = (x + 1) / 2